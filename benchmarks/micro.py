@@ -0,0 +1,170 @@
+from .results import RESULTS_PATH, check, load_results, record
+from .server import LOGS_DIR
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+# microbenchmarks of the pipeline's hot functions
+#   python -m benchmarks.micro [--db-uri postgresql+psycopg://...]
+# the batch writers only run with a --db-uri, their rows go to a chart name no real chart uses
+
+# chart name of the rows written by the batch writer benchmarks
+MICRO_CHART: str = "benchmark-micro"
+
+
+def time_sync(fn: Callable[[], object], repeat: int) -> float:
+    # best of 3 timings of repeat calls, in seconds per call
+    best: float = float("inf")
+    for _ in range(3):
+        start_time: float = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        best = min(best, (time.perf_counter() - start_time) / repeat)
+    return best
+
+
+async def time_async(fn: Callable[[], Awaitable[object]], repeat: int) -> float:
+    best: float = float("inf")
+    for _ in range(3):
+        start_time: float = time.perf_counter()
+        for _ in range(repeat):
+            await fn()
+        best = min(best, (time.perf_counter() - start_time) / repeat)
+    return best
+
+
+def micro_result(name: str, seconds: float, unit: str) -> dict:
+    return {
+        "benchmark": f"micro:{name}",
+        "seconds_per_op": round(seconds, 6),
+        "ops_per_sec": round(1 / seconds, 1),
+        "unit": unit,
+    }
+
+
+def bench_parse_html(repeat: int) -> dict:
+    from billboard_fetch.etl.html_parser import parse_html
+
+    body: bytes = (LOGS_DIR / "norm_html.html").read_bytes()
+    return micro_result(
+        "parse_html", time_sync(lambda: parse_html(body), repeat), "chart"
+    )
+
+
+def bench_date_generator(repeat: int) -> dict:
+    from billboard_fetch.configs import OLDEST_CHART_DATE
+    from billboard_fetch.utils import date_generator
+
+    # every week from the oldest chart to today, the widest plan a run can make
+    today: date = date.today()
+    return micro_result(
+        "date_generator",
+        time_sync(lambda: list(date_generator(OLDEST_CHART_DATE, today)), repeat),
+        "full range",
+    )
+
+
+async def bench_loaders(db_uri: str, repeat: int, batch_size: int) -> list[dict]:
+    # one batch of batch_size 100 row charts per call, cleared again after every call
+    from billboard_fetch.database import (
+        Chart,
+        ChartRecord,
+        SongStats,
+        dispose_engine,
+        get_engine,
+        init_schema,
+    )
+    from billboard_fetch.database.deltas import clear_charts
+    from billboard_fetch.database.write import LOADERS
+    from billboard_fetch.etl.html_parser import parse_html
+    from sqlalchemy import delete, select
+
+    positions, titles, artists = parse_html((LOGS_DIR / "norm_html.html").read_bytes())
+
+    async def clear():
+        async with get_engine().begin() as conn:
+            stale = select(Chart.id).where(Chart.chart_name == MICRO_CHART)
+            await clear_charts(conn, stale)
+            await conn.execute(delete(Chart).where(Chart.id.in_(stale)))
+            await conn.execute(
+                delete(SongStats).where(SongStats.chart_name == MICRO_CHART)
+            )
+
+    results: list[dict] = []
+    try:
+        await init_schema()
+        await clear()
+        for name, loader in LOADERS.items():
+
+            async def write_batch():
+                await loader(
+                    [
+                        ChartRecord(
+                            MICRO_CHART,
+                            date(2000, 1, 1) + timedelta(weeks=i),
+                            positions,
+                            titles,
+                            artists,
+                        )
+                        for i in range(batch_size)
+                    ]
+                )
+                await clear()
+
+            results.append(
+                micro_result(
+                    f"loader_{name}",
+                    await time_async(write_batch, repeat) / batch_size,
+                    "chart",
+                )
+            )
+    finally:
+        await dispose_engine()
+    return results
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Pipeline microbenchmarks")
+    parser.add_argument(
+        "--db-uri",
+        default=None,
+        help="database for the batch writer benchmarks, skipped when not passed",
+    )
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--results", type=Path, default=RESULTS_PATH)
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args(argv)
+    if args.db_uri is not None:
+        # set before anything imports billboard_fetch.configs, which reads it once
+        os.environ["DB_URI"] = args.db_uri
+
+    results: list[dict] = [
+        bench_parse_html(args.repeat),
+        bench_date_generator(args.repeat),
+    ]
+    if args.db_uri is not None:
+        results += asyncio.run(bench_loaders(args.db_uri, args.repeat, args.batch_size))
+
+    history: list[dict] = load_results(args.results)
+    regressions: list[str] = []
+    for result in results:
+        regressions += check(result, history, args.tolerance)
+        record(result, args.results)
+        print(
+            f"{result['benchmark']}: {result['seconds_per_op'] * 1000:.3f} ms "
+            f"per {result['unit']}, {result['ops_per_sec']}/s"
+        )
+    for line in regressions:
+        print(f"regression {line}")
+    return 1 if args.check and regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
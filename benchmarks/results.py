@@ -0,0 +1,79 @@
+from datetime import datetime
+from pathlib import Path
+from statistics import median
+from typing import Optional
+import json
+import subprocess
+
+# default results log, one json line per benchmark result
+RESULTS_PATH: Path = Path(__file__).resolve().parent / "results.jsonl"
+
+# result fields compared by --check, True when higher is better
+CHECKED_FIELDS: dict[str, bool] = {
+    "charts_per_sec": True,
+    "rows_per_sec": True,
+    "ops_per_sec": True,
+    "peak_rss_mib": False,
+}
+
+# previous results of the same benchmark the baseline is the median of
+BASELINE_RUNS: int = 5
+
+# fields that must match for two results to be compared
+IDENTITY_FIELDS: tuple[str, ...] = ("benchmark", "loader", "charts", "weeks")
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).resolve().parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_results(path: Path) -> list[dict]:
+    if not path.exists():
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def record(result: dict, path: Path) -> dict:
+    # stamps the result with the time and commit and appends it to the results log
+    result = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        **result,
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(result) + "\n")
+    return result
+
+
+def check(result: dict, history: list[dict], tolerance: float) -> list[str]:
+    # compares a result against the median of the last runs of the same benchmark
+    # and returns a line per field that regressed by more than tolerance
+    previous: list[dict] = [
+        r for r in history if all(r.get(f) == result.get(f) for f in IDENTITY_FIELDS)
+    ][-BASELINE_RUNS:]
+    if not previous:
+        return []
+    regressions: list[str] = []
+    for field, higher_is_better in CHECKED_FIELDS.items():
+        values: list[float] = [r[field] for r in previous if field in r]
+        if field not in result or not values:
+            continue
+        baseline: float = median(values)
+        change: float = (result[field] - baseline) / baseline if baseline else 0.0
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append(
+                f"{result['benchmark']}: {field} {result[field]:.1f} vs baseline "
+                f"{baseline:.1f} ({change:+.1%})"
+            )
+    return regressions
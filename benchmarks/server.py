@@ -0,0 +1,132 @@
+from aiohttp import web
+from collections import Counter
+from pathlib import Path
+from typing import Optional
+import argparse
+import asyncio
+import hashlib
+import random
+
+# recorded billboard responses, a full 100 row chart and a paywalled shell page
+LOGS_DIR: Path = Path(__file__).resolve().parent.parent / "logs"
+
+
+class StandInServer:
+    # local stand-in for billboard.com/charts serving recorded pages for every chart and week
+    #   latency +- jitter seconds is slept before every response
+    #   throttle_rate, error_rate and shell_rate are the chances of a 429 with Retry-After,
+    #   a 503 and a shell page instead of the full chart
+    # every chart gets the same 100 row page, so only charts of up to 100 rows parse in full
+    # full pages carry an ETag and a matching If-None-Match is answered with a 304
+    def __init__(
+        self,
+        latency: float = 0.05,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        throttle_rate: float = 0.0,
+        shell_rate: float = 0.0,
+        retry_after: float = 1.0,
+        seed: Optional[int] = None,
+    ):
+        self.latency: float = latency
+        self.jitter: float = jitter
+        self.error_rate: float = error_rate
+        self.throttle_rate: float = throttle_rate
+        self.shell_rate: float = shell_rate
+        self.retry_after: float = retry_after
+        self.random: random.Random = random.Random(seed)
+        self.full_page: bytes = (LOGS_DIR / "norm_html.html").read_bytes()
+        self.shell_page: bytes = (LOGS_DIR / "paywall_html.html").read_bytes()
+        self.etag: str = f'"{hashlib.sha256(self.full_page).hexdigest()[:16]}"'
+        self.stats: Counter = Counter()
+        self.runner: Optional[web.AppRunner] = None
+
+    async def chart(self, request: web.Request) -> web.Response:
+        self.stats["requests"] += 1
+        await asyncio.sleep(
+            max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+        )
+        roll: float = self.random.random()
+        if roll < self.throttle_rate:
+            self.stats["throttled"] += 1
+            return web.Response(
+                status=429, headers={"Retry-After": str(self.retry_after)}
+            )
+        roll -= self.throttle_rate
+        if roll < self.error_rate:
+            self.stats["errors"] += 1
+            return web.Response(status=503)
+        roll -= self.error_rate
+        if roll < self.shell_rate:
+            self.stats["shell_pages"] += 1
+            return web.Response(body=self.shell_page, content_type="text/html")
+        if request.headers.get("If-None-Match") == self.etag:
+            self.stats["not_modified"] += 1
+            return web.Response(status=304, headers={"ETag": self.etag})
+        self.stats["charts"] += 1
+        return web.Response(
+            body=self.full_page, content_type="text/html", headers={"ETag": self.etag}
+        )
+
+    async def stats_handler(self, request: web.Request) -> web.Response:
+        return web.json_response(dict(self.stats))
+
+    def app(self) -> web.Application:
+        app: web.Application = web.Application()
+        app.router.add_get("/charts/{chart}/{date}/", self.chart)
+        app.router.add_get("/stats", self.stats_handler)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        # returns the bound port, port 0 lets the os pick a free one
+        self.runner = web.AppRunner(self.app(), access_log=None)
+        await self.runner.setup()
+        site: web.TCPSite = web.TCPSite(self.runner, host, port)
+        await site.start()
+        return self.runner.addresses[0][1]
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+def add_server_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--shell-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=None)
+
+
+async def serve_forever(server: StandInServer, host: str, port: int):
+    port = await server.start(host, port)
+    print(f"serving charts at http://{host}:{port}/charts/, stats at /stats")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    # standalone server, point fetchers at it with BILLBOARD_URL=http://127.0.0.1:<port>/charts/
+    parser = argparse.ArgumentParser(description="Local billboard stand-in server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8777)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    server = StandInServer(
+        args.latency,
+        args.jitter,
+        args.error_rate,
+        args.throttle_rate,
+        args.shell_rate,
+        args.retry_after,
+        args.seed,
+    )
+    try:
+        asyncio.run(serve_forever(server, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -1,2 +1,11 @@
-from .config import DB_USER, DB_PASSWORD, DB_NAME, DB_URI
+from .config import (
+    DB_USER,
+    DB_PASSWORD,
+    DB_NAME,
+    DB_URI,
+    BILLBOARD_URL,
+    ARCHIVE_DIR,
+    JOURNAL_DIR,
+    PARQUET_DIR,
+)
 from .constants import OLDEST_CHART_DATE, CHARTS, CHART_INFO
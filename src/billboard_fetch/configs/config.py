@@ -12,5 +12,19 @@ DB_USER = os.getenv("POSTGRES_USER")
 DB_PASSWORD = os.getenv("POSTGRES_PASSWORD")
 DB_NAME = os.getenv("POSTGRES_DB")
 
-# Database connection string
-DB_URI = f"postgresql+psycopg://{DB_USER}:{DB_PASSWORD}@db:5432/{DB_NAME}"
+# Database connection string, DB_URI overrides the one built from the compose variables
+DB_URI = os.getenv(
+    "DB_URI", f"postgresql+psycopg://{DB_USER}:{DB_PASSWORD}@db:5432/{DB_NAME}"
+)
+
+# Base url of the chart pages, pointed at a local stand-in server by the benchmarks
+BILLBOARD_URL = os.getenv("BILLBOARD_URL", "https://www.billboard.com/charts/")
+
+# Directory of the local archive of raw chart html
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join("/billboard-fetch", "archive"))
+
+# Directory of the per-run checkpoint journals
+JOURNAL_DIR = os.getenv("JOURNAL_DIR", os.path.join("/billboard-fetch", "journal"))
+
+# Directory of the partitioned parquet files written by --sink parquet, --export and --import
+PARQUET_DIR = os.getenv("PARQUET_DIR", os.path.join("/billboard-fetch", "parquet"))
@@ -1,5 +1,8 @@
 from datetime import date
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+
+# Date of the first billboard hot100 charts
+OLDEST_CHART_DATE: date = date(1958, 8, 2)
 
 
 @dataclass
@@ -7,19 +10,26 @@ class CHART_INFO:
     name: str
     length: int
     alt_names: list[str]
+    # publication calendar, the weeks a chart can exist in
+    #   the date of its first chart, it is never planned before it
+    inception: date = OLDEST_CHART_DATE
+    #   billboard dates every chart week by the same weekday, 5 is saturday
+    weekday: int = 5
+    #   weeks within the chart's run billboard never published, gaps learned while fetching
+    #   are kept in the database's chart_gaps table
+    gaps: frozenset[date] = field(default_factory=frozenset)
 
 
-# Date of the first billboard hot100 charts
-OLDEST_CHART_DATE: date = date(1958, 8, 2)
-
 CHARTS: list[CHART_INFO] = [
-    CHART_INFO("hot-100", 100, []),
-    CHART_INFO("billboard-200", 200, []),
-    CHART_INFO("artist-100", 100, []),
-    CHART_INFO("streaming-songs", 50, []),
-    CHART_INFO("radio-songs", 50, []),
-    CHART_INFO("digital-song-sales", 25, ["song-sales", "digital-sales"]),
-    CHART_INFO("top-album-sales", 50, ["album-sales"]),
-    CHART_INFO("top-streaming-albums", 50, ["streaming-albums"]),
-    CHART_INFO("emerging-artists", 50, []),
+    CHART_INFO("hot-100", 100, [], OLDEST_CHART_DATE),
+    CHART_INFO("billboard-200", 200, [], date(1963, 8, 17)),
+    CHART_INFO("artist-100", 100, [], date(2014, 7, 19)),
+    CHART_INFO("streaming-songs", 50, [], date(2013, 1, 19)),
+    CHART_INFO("radio-songs", 50, [], date(1990, 12, 8)),
+    CHART_INFO(
+        "digital-song-sales", 25, ["song-sales", "digital-sales"], date(2004, 10, 30)
+    ),
+    CHART_INFO("top-album-sales", 50, ["album-sales"], date(1991, 5, 25)),
+    CHART_INFO("top-streaming-albums", 50, ["streaming-albums"], date(2014, 12, 13)),
+    CHART_INFO("emerging-artists", 50, [], date(2014, 7, 19)),
 ]
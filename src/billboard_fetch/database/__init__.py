@@ -1,2 +1,33 @@
-from .models import Base, Chart, Entry
-from .write import async_writer
+from .models import (
+    Base,
+    Artist,
+    ArtistScore,
+    Chart,
+    ChartDelta,
+    ChartGap,
+    Entry,
+    Job,
+    SchemaVersion,
+    SearchTerm,
+    Song,
+    SongArtist,
+    SongScore,
+    SongStats,
+    TransformedChart,
+)
+from .records import ChartRecord
+from .deltas import DeltaEncoder, chart_entries
+from .engine import dispose_engine, get_engine, init_schema, size_pool
+from .write import Sink, async_writer
+from .jobs import JobQueue
+from .query import (
+    Page,
+    artist_history,
+    chart_changes,
+    chart_week,
+    load_chart,
+    query_cache,
+    song_trajectory,
+    top_songs,
+)
+from .search import fuzzy_search
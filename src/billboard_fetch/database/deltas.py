@@ -0,0 +1,216 @@
+from .models import Chart, ChartDelta, Entry
+from .records import ChartRecord
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from sqlalchemy import (
+    Select,
+    Subquery,
+    all_,
+    delete,
+    exists,
+    func,
+    insert,
+    select,
+    true,
+    union_all,
+)
+from sqlalchemy.ext.asyncio import AsyncConnection
+from typing import Collection, Optional, Union
+
+# chart weeks stored as deltas, written with --storage delta
+#   most weeks keep no entries rows, only one chart_deltas row with the songs whose position
+#   differs from the chart's last full week before them, its keyframe. every week is one
+#   keyframe away from its full chart, so any week is rebuilt from two reads and rewriting a
+#   week never touches the weeks after it
+#   readers never see the difference, they read chart_entries in place of entries
+
+# a week is stored in full once the chart's last keyframe is this many weeks older
+KEYFRAME_WEEKS: int = 26
+KEYFRAME_SPAN: timedelta = timedelta(weeks=KEYFRAME_WEEKS)
+
+# position of a keyframe song the week no longer lists
+EXIT: int = 0
+
+# chart ids, either listed or selected
+ChartIds = Union[Collection[int], Select]
+
+_changes = (
+    func.unnest(ChartDelta.song_ids, ChartDelta.positions)
+    .table_valued("song_id", "position")
+    .render_derived()
+)
+
+# (chart_id, position, song_id) of every stored week, full or delta, what entries holds in
+# full storage
+chart_entries: Subquery = union_all(
+    select(Entry.chart_id, Entry.position, Entry.song_id),
+    # songs of a delta week that moved or entered since the keyframe
+    select(ChartDelta.chart_id, _changes.c.position, _changes.c.song_id)
+    .select_from(ChartDelta)
+    .join(_changes, true())
+    .where(_changes.c.position != EXIT),
+    # songs of the keyframe still at the same position
+    select(ChartDelta.chart_id, Entry.position, Entry.song_id)
+    .join(Entry, Entry.chart_id == ChartDelta.keyframe_id)
+    .where(Entry.song_id != all_(ChartDelta.song_ids)),
+).subquery("chart_entries")
+
+
+@dataclass(slots=True)
+class Keyframe:
+    chart_id: int
+    date: date
+    positions: dict[int, int]  # song id -> position
+
+
+@dataclass
+class Encoded:
+    # one batch's charts split into the weeks stored in full and the deltas of the others
+    chart_ids: list[int] = field(default_factory=list)  # weeks stored in full
+    records: list[ChartRecord] = field(default_factory=list)
+    deltas: list[dict] = field(default_factory=list)  # chart_deltas rows
+    keyframes: dict[str, Keyframe] = field(default_factory=dict)  # newest per chart
+    rewritten: Collection[int] = ()  # stored weeks the batch replaced
+
+
+class DeltaEncoder:
+    # encodes charts against the last keyframe of their chart, the keyframes the writer stored
+    # or read are held so the weeks after them are encoded without reading them again
+    def __init__(self):
+        self.keyframes: dict[str, Keyframe] = {}
+
+    async def find_keyframe(
+        self,
+        conn: AsyncConnection,
+        record: ChartRecord,
+        staged: dict[str, Keyframe],
+        rewritten: Collection[int],
+    ) -> Optional[Keyframe]:
+        # the newest full week of the chart less than KEYFRAME_SPAN before the record
+        #   keyframes staged by this batch hold their new content, held ones may be stale
+        kept: Optional[Keyframe] = self.keyframes.get(record.chart_name)
+        if kept is not None and kept.chart_id in rewritten:
+            kept = None
+        for keyframe in (staged.get(record.chart_name), kept):
+            if (
+                keyframe is not None
+                and keyframe.date < record.date <= keyframe.date + KEYFRAME_SPAN
+            ):
+                return keyframe
+        # backfilled weeks, and the first week of every chart in a run, look it up
+        row = (
+            await conn.execute(
+                select(Chart.id, Chart.date)
+                .where(
+                    Chart.chart_name == record.chart_name,
+                    Chart.date >= record.date - KEYFRAME_SPAN,
+                    Chart.date < record.date,
+                    Chart.id.not_in(rewritten),
+                    ~exists().where(ChartDelta.chart_id == Chart.id),
+                )
+                .order_by(Chart.date.desc())
+                .limit(1)
+            )
+        ).first()
+        if row is None:
+            return None
+        entries: list[tuple[int, int]] = list(
+            await conn.execute(
+                select(Entry.song_id, Entry.position).where(Entry.chart_id == row.id)
+            )
+        )
+        if not entries or len(dict(entries)) < len(entries):
+            return None  # a song listed twice has no single position to move from
+        keyframe: Keyframe = Keyframe(row.id, row.date, dict(entries))
+        if record.chart_name not in staged:
+            staged[record.chart_name] = keyframe
+        return keyframe
+
+    async def encode(
+        self,
+        conn: AsyncConnection,
+        chart_ids: list[int],
+        records: list[ChartRecord],
+        rewritten: Collection[int] = (),
+    ) -> Encoded:
+        # records need their song ids, rewritten weeks are never used as keyframes since their
+        # stored entries are about to be replaced
+        encoded: Encoded = Encoded(rewritten=rewritten)
+        for chart_id, record in sorted(
+            zip(chart_ids, records), key=lambda pair: pair[1].date
+        ):
+            keyframe: Optional[Keyframe] = None
+            if len(set(record.song_ids)) == len(record):
+                keyframe = await self.find_keyframe(
+                    conn, record, encoded.keyframes, rewritten
+                )
+            if keyframe is None:
+                encoded.chart_ids.append(chart_id)
+                encoded.records.append(record)
+                encoded.keyframes[record.chart_name] = Keyframe(
+                    chart_id, record.date, dict(zip(record.song_ids, record.positions))
+                )
+                continue
+            changes: dict[int, int] = {
+                song_id: position
+                for song_id, position in zip(record.song_ids, record.positions)
+                if keyframe.positions.get(song_id) != position
+            }
+            for song_id in keyframe.positions.keys() - set(record.song_ids):
+                changes[song_id] = EXIT
+            encoded.deltas.append(
+                {
+                    "chart_id": chart_id,
+                    "keyframe_id": keyframe.chart_id,
+                    "song_ids": list(changes),
+                    "positions": list(changes.values()),
+                }
+            )
+        return encoded
+
+    def keep(self, encoded: Encoded):
+        # called once the batch committed, a rolled back batch leaves no keyframes behind
+        for chart_name, keyframe in list(self.keyframes.items()):
+            if keyframe.chart_id in encoded.rewritten:
+                del self.keyframes[chart_name]
+        for chart_name, keyframe in encoded.keyframes.items():
+            kept: Optional[Keyframe] = self.keyframes.get(chart_name)
+            if kept is None or kept.date <= keyframe.date:
+                self.keyframes[chart_name] = keyframe
+
+
+async def write_deltas(conn: AsyncConnection, encoded: Encoded):
+    if encoded.deltas:
+        await conn.execute(insert(ChartDelta), encoded.deltas)
+
+
+async def clear_charts(
+    conn: AsyncConnection, chart_ids: ChartIds
+) -> list[tuple[int, int]]:
+    # removes what is stored of charts about to be rewritten or deleted, however they are
+    # stored, returns their (song id, chart id) rows
+    #   weeks stored as deltas from one of them are stored in full first
+    dependents = select(ChartDelta.chart_id).where(
+        ChartDelta.keyframe_id.in_(chart_ids), ChartDelta.chart_id.not_in(chart_ids)
+    )
+    await conn.execute(
+        insert(Entry).from_select(
+            ["chart_id", "position", "song_id"],
+            select(
+                chart_entries.c.chart_id,
+                chart_entries.c.position,
+                chart_entries.c.song_id,
+            ).where(chart_entries.c.chart_id.in_(dependents)),
+        )
+    )
+    await conn.execute(delete(ChartDelta).where(ChartDelta.chart_id.in_(dependents)))
+    removed: list[tuple[int, int]] = list(
+        await conn.execute(
+            select(chart_entries.c.song_id, chart_entries.c.chart_id).where(
+                chart_entries.c.chart_id.in_(chart_ids)
+            )
+        )
+    )
+    await conn.execute(delete(ChartDelta).where(ChartDelta.chart_id.in_(chart_ids)))
+    await conn.execute(delete(Entry).where(Entry.chart_id.in_(chart_ids)))
+    return removed
@@ -0,0 +1,313 @@
+from .models import (
+    Artist,
+    ArtistScore,
+    SearchTerm,
+    Song,
+    SongArtist,
+    TransformedChart,
+)
+from .records import ChartRecord
+from billboard_fetch.etl.credits import search_term, split_credit
+from collections import OrderedDict
+from sqlalchemy import (
+    and_,
+    bindparam,
+    delete,
+    exists,
+    inspect,
+    select,
+    text,
+    tuple_,
+    update,
+)
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+from typing import Hashable, Iterator, Optional
+
+# songs and artists whose ids are kept in memory, a few weeks of every chart fit many times over
+SONG_CACHE_SIZE: int = 200_000
+ARTIST_CACHE_SIZE: int = 100_000
+
+# keys resolved per statement, bounds the VALUES and IN lists
+RESOLVE_CHUNK: int = 1000
+
+# moves entries written before the dimension tables existed onto songs, in one transaction
+ENTRY_UPGRADE_SQL: tuple[str, ...] = (
+    "ALTER TABLE entries ADD COLUMN song_id INTEGER REFERENCES songs (id)",
+    "INSERT INTO songs (title, artist_credit) "
+    "SELECT DISTINCT song_title, artist FROM entries ON CONFLICT DO NOTHING",
+    "UPDATE entries SET song_id = songs.id FROM songs "
+    "WHERE songs.title = entries.song_title AND songs.artist_credit = entries.artist",
+    "ALTER TABLE entries ALTER COLUMN song_id SET NOT NULL, "
+    "DROP COLUMN song_title, DROP COLUMN artist",
+    "CREATE INDEX ix_entries_song_id ON entries (song_id)",
+)
+
+
+# trigram index of the search terms, the % and <% operators of pg_trgm use it
+SEARCH_INDEX_SQL: str = (
+    "CREATE INDEX IF NOT EXISTS ix_search_terms_term_trgm "
+    "ON search_terms USING gin (term gin_trgm_ops)"
+)
+
+
+class LRUCache:
+    # least recently used mapping of natural keys to database ids
+    def __init__(self, maxsize: int):
+        self.maxsize: int = maxsize
+        self.data: OrderedDict[Hashable, int] = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def get(self, key: Hashable) -> Optional[int]:
+        id_: Optional[int] = self.data.get(key)
+        if id_ is None:
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return id_
+
+    def put(self, key: Hashable, id_: int):
+        self.data[key] = id_
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)  # evict the least recently used key
+
+
+# shared by every batch of the process, ids only enter them once their rows are committed
+song_cache: LRUCache = LRUCache(SONG_CACHE_SIZE)
+artist_cache: LRUCache = LRUCache(ARTIST_CACHE_SIZE)
+
+
+def chunked(items: list, size: int = RESOLVE_CHUNK) -> Iterator[list]:
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+async def add_search_terms(
+    conn: AsyncConnection, kind: str, rows: list[tuple[int, str]]
+):
+    # indexes the text of new (id, title) songs or (id, name) artists for fuzzy search
+    terms: list[dict] = [
+        {"kind": kind, "ref_id": id_, "term": search_term(text_, kind == "artist")}
+        for id_, text_ in rows
+    ]
+    for chunk in chunked(terms):
+        await conn.execute(insert(SearchTerm).values(chunk).on_conflict_do_nothing())
+
+
+async def resolve_artists(conn: AsyncConnection, names: set[str]) -> dict[str, int]:
+    ids: dict[str, int] = {}
+    misses: list[str] = []
+    for name in names:
+        id_: Optional[int] = artist_cache.get(name)
+        if id_ is None:
+            misses.append(name)
+        else:
+            ids[name] = id_
+    misses.sort()  # concurrent writers lock new keys in the same order, never deadlocking
+    for chunk in chunked(misses):
+        # artists created concurrently by another node are picked up by the select
+        created = await conn.execute(
+            insert(Artist)
+            .values([{"name": n} for n in chunk])
+            .on_conflict_do_nothing()
+            .returning(Artist.id, Artist.name)
+        )
+        await add_search_terms(conn, "artist", list(created))
+        for id_, name in await conn.execute(
+            select(Artist.id, Artist.name).where(Artist.name.in_(chunk))
+        ):
+            ids[name] = id_
+    return ids
+
+
+async def link_artists(
+    conn: AsyncConnection, songs: list[tuple[int, str]]
+) -> dict[str, int]:
+    # splits the credit of every new (song id, credit) into its artists and links them,
+    # returns the ids of the artists involved
+    credits: dict[int, list[tuple[str, str]]] = {
+        song_id: split_credit(credit) for song_id, credit in songs
+    }
+    ids: dict[str, int] = await resolve_artists(
+        conn, {name for artists in credits.values() for name, _ in artists}
+    )
+    rows: list[dict] = [
+        {"song_id": song_id, "artist_id": ids[name], "role": role, "billing": i}
+        for song_id, artists in credits.items()
+        for i, (name, role) in enumerate(artists)
+    ]
+    for chunk in chunked(rows):
+        await conn.execute(insert(SongArtist).values(chunk).on_conflict_do_nothing())
+    return ids
+
+
+async def relink_artists(conn: AsyncConnection):
+    # songs linked by an older split_credit are linked again, e.g. every credit with a comma
+    # was once split on it, the artists only those splits made up are removed
+    songs: list[tuple[int, str]] = list(
+        await conn.execute(select(Song.id, Song.artist_credit))
+    )
+    linked: dict[int, list[tuple[str, str]]] = {}
+    for song_id, name, role in await conn.execute(
+        select(SongArtist.song_id, Artist.name, SongArtist.role)
+        .join(Artist, Artist.id == SongArtist.artist_id)
+        .order_by(SongArtist.song_id, SongArtist.billing)
+    ):
+        linked.setdefault(song_id, []).append((name, role))
+    stale: list[tuple[int, str]] = [
+        (song_id, credit)
+        for song_id, credit in songs
+        if linked.get(song_id, []) != split_credit(credit)
+    ]
+    if not stale:
+        return
+    print(f"linking the artists of {len(stale)} songs again")
+    for chunk in chunked(stale):
+        await conn.execute(
+            delete(SongArtist).where(
+                SongArtist.song_id.in_([song_id for song_id, _ in chunk])
+            )
+        )
+    await link_artists(conn, stale)
+    orphans = select(Artist.id).where(
+        ~exists().where(SongArtist.artist_id == Artist.id)
+    )
+    await conn.execute(
+        delete(SearchTerm).where(
+            SearchTerm.kind == "artist", SearchTerm.ref_id.in_(orphans)
+        )
+    )
+    await conn.execute(delete(ArtistScore).where(ArtistScore.artist_id.in_(orphans)))
+    await conn.execute(delete(Artist).where(Artist.id.in_(orphans)))
+    # artist scores were split among the old artists, the next transform is a full one
+    await conn.execute(delete(TransformedChart))
+
+
+async def resolve_songs(
+    conn: AsyncConnection, keys: list[tuple[str, str]]
+) -> tuple[dict[tuple[str, str], int], dict[str, int]]:
+    # returns the id of every (title, credit), creating the songs and artists that are new,
+    # along with the ids of the artists of the new songs
+    ids: dict[tuple[str, str], int] = {}
+    artist_ids: dict[str, int] = {}
+    for chunk in chunked(keys):
+        created = await conn.execute(
+            insert(Song)
+            .values([{"title": t, "artist_credit": a} for t, a in chunk])
+            .on_conflict_do_nothing()
+            .returning(Song.id, Song.title, Song.artist_credit)
+        )
+        created = list(created)
+        await add_search_terms(
+            conn, "song", [(id_, title) for id_, title, _ in created]
+        )
+        artist_ids |= await link_artists(
+            conn, [(id_, credit) for id_, _, credit in created]
+        )
+        for id_, title, credit in await conn.execute(
+            select(Song.id, Song.title, Song.artist_credit).where(
+                tuple_(Song.title, Song.artist_credit).in_(chunk)
+            )
+        ):
+            ids[(title, credit)] = id_
+    return ids, artist_ids
+
+
+async def intern_songs(engine: AsyncEngine, records: list[ChartRecord]):
+    # fills the song ids of every record, only songs missing from the cache reach the database
+    keys: dict[tuple[str, str], Optional[int]] = dict.fromkeys(
+        key for record in records for key in zip(record.titles, record.artists)
+    )
+    misses: list[tuple[str, str]] = []
+    for key in keys:
+        keys[key] = song_cache.get(key)
+        if keys[key] is None:
+            misses.append(key)
+    if misses:
+        misses.sort()  # concurrent writers lock new keys in the same order, never deadlocking
+        # committed on its own, before the batch, so a cached id never points at a
+        # song rolled back with a failed batch
+        async with engine.begin() as conn:
+            resolved, artist_ids = await resolve_songs(conn, misses)
+        for key, id_ in resolved.items():
+            keys[key] = id_
+            song_cache.put(key, id_)
+        for name, id_ in artist_ids.items():
+            artist_cache.put(name, id_)
+    for record in records:
+        record.song_ids = [keys[key] for key in zip(record.titles, record.artists)]
+
+
+async def upgrade_entries(conn: AsyncConnection):
+    # entries tables created before songs and artists existed still hold the raw strings
+    columns: set[str] = await conn.run_sync(
+        lambda c: {column["name"] for column in inspect(c).get_columns("entries")}
+    )
+    if "song_title" not in columns:
+        return
+    print("moving entry titles and artists into the songs and artists tables")
+    for statement in ENTRY_UPGRADE_SQL:
+        await conn.execute(text(statement))
+    unlinked = await conn.execute(
+        select(Song.id, Song.artist_credit).where(
+            ~exists().where(SongArtist.song_id == Song.id)
+        )
+    )
+    await link_artists(conn, list(unlinked))
+
+
+async def build_search_terms(conn: AsyncConnection):
+    # backs search_terms with a pg_trgm trigram index where the server has the extension,
+    # search falls back to an in-memory n-gram index otherwise
+    try:
+        async with conn.begin_nested():
+            await conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            await conn.execute(text(SEARCH_INDEX_SQL))
+    except DBAPIError:
+        pass  # not installed on the server, or not ours to install
+    # songs and artists written before search_terms existed
+    for kind, table, column in (
+        ("song", Song, Song.title),
+        ("artist", Artist, Artist.name),
+    ):
+        missing = await conn.stream(
+            select(table.id, column)
+            .where(
+                ~exists().where(SearchTerm.kind == kind, SearchTerm.ref_id == table.id)
+            )
+            .execution_options(yield_per=RESOLVE_CHUNK)
+        )
+        num_terms: int = 0
+        async for rows in missing.partitions():
+            await add_search_terms(conn, kind, list(rows))
+            num_terms += len(rows)
+        if num_terms:
+            print(f"indexed {num_terms} {kind} names for search")
+        # terms an older search_term normalized differently, e.g. "Lil Nas X" without its "x"
+        stored = await conn.stream(
+            select(table.id, column, SearchTerm.term)
+            .join(
+                SearchTerm,
+                and_(SearchTerm.kind == kind, SearchTerm.ref_id == table.id),
+            )
+            .execution_options(yield_per=RESOLVE_CHUNK)
+        )
+        stale: list[dict] = []
+        async for rows in stored.partitions():
+            for id_, text_, term in rows:
+                normalized: str = search_term(text_, kind == "artist")
+                if normalized != term:
+                    stale.append({"ref": id_, "new_term": normalized})
+        for chunk in chunked(stale):
+            await conn.execute(
+                update(SearchTerm)
+                .where(SearchTerm.kind == kind, SearchTerm.ref_id == bindparam("ref"))
+                .values(term=bindparam("new_term")),
+                chunk,
+            )
+        if stale:
+            print(f"normalized {len(stale)} {kind} names for search again")
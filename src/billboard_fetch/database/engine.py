@@ -0,0 +1,134 @@
+from .dimensions import build_search_terms, relink_artists, upgrade_entries
+from .models import Base, SchemaVersion
+from .stats import build_stats
+from billboard_fetch.configs import DB_URI
+from sqlalchemy import Connection, delete, func, insert, inspect, select, text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, create_async_engine
+from typing import Optional
+
+# the one connection pool of the process, shared by planning, writing and the jobs table
+_engine: Optional[AsyncEngine] = None
+_schema_ready: bool = False
+# connections the pool keeps open, sized by size_pool for the run's concurrent writers
+_pool_size: int = 5
+
+# connections needed next to the writers, by planning, job leases and the scrapers' gap records
+SPARE_CONNECTIONS: int = 4
+
+# raised whenever a migration or backfill is added to init_schema, databases already at this
+# version skip them
+SCHEMA_VERSION: int = 4
+# key of the advisory lock processes take while migrating, so nodes starting together
+# migrate once
+MIGRATION_LOCK: int = 0x62696C6C
+
+# columns added to a table after its first release, create_all never alters an existing table
+ADDED_COLUMNS: dict[str, list[str]] = {"charts": ["content_hash"]}
+# indexes added to a table after its first release, create_all only indexes tables it creates
+ADDED_INDEXES: dict[str, list[str]] = {"entries": ["ix_entries_chart_id_position"]}
+
+
+def get_engine() -> AsyncEngine:
+    # created on first use so commands that never reach the database never connect
+    global _engine
+    if _engine is None:
+        _engine = create_async_engine(DB_URI, pool_size=_pool_size)
+    return _engine
+
+
+def size_pool(num_writers: int):
+    # every writer holds a connection while it writes, call before the engine is first used
+    global _pool_size
+    _pool_size = num_writers + SPARE_CONNECTIONS
+
+
+async def init_schema():
+    # creates any missing tables defined in models.py and migrates databases an older release
+    # created, once per process
+    #   a database already at SCHEMA_VERSION costs one query
+    global _schema_ready
+    if _schema_ready:
+        return
+    async with get_engine().begin() as conn:
+        if await schema_version(conn) != SCHEMA_VERSION:
+            await conn.execute(select(func.pg_advisory_xact_lock(MIGRATION_LOCK)))
+            # another process may have migrated while this one waited on the lock
+            if await schema_version(conn) != SCHEMA_VERSION:
+                await migrate(conn)
+    _schema_ready = True
+
+
+async def schema_version(conn: AsyncConnection) -> Optional[int]:
+    # None for a database created before versions were kept, or an empty one
+    if not await conn.scalar(text("SELECT to_regclass('schema_version') IS NOT NULL")):
+        return None
+    return await conn.scalar(select(func.max(SchemaVersion.version)))
+
+
+async def migrate(conn: AsyncConnection):
+    print(f"migrating the database schema to version {SCHEMA_VERSION}")
+    await conn.run_sync(Base.metadata.create_all)
+    await conn.run_sync(add_missing_columns)
+    await conn.run_sync(upgrade_chart_key)
+    await upgrade_entries(conn)
+    await relink_artists(conn)
+    await conn.run_sync(add_missing_indexes)
+    await build_stats(conn)
+    await build_search_terms(conn)
+    await conn.execute(delete(SchemaVersion))
+    await conn.execute(insert(SchemaVersion).values(version=SCHEMA_VERSION))
+
+
+def add_missing_columns(conn: Connection):
+    # brings tables created by an older release up to date with models.py
+    inspector = inspect(conn)
+    for table_name, column_names in ADDED_COLUMNS.items():
+        existing: set[str] = {c["name"] for c in inspector.get_columns(table_name)}
+        for name in column_names:
+            if name not in existing:
+                column = Base.metadata.tables[table_name].c[name]
+                conn.execute(
+                    text(
+                        f"ALTER TABLE {table_name} ADD COLUMN {name} "
+                        f"{column.type.compile(conn.dialect)}"
+                    )
+                )
+
+
+def upgrade_chart_key(conn: Connection):
+    # charts tables created before several charts were kept allow one chart per week,
+    # a week is unique per chart name now
+    inspector = inspect(conn)
+    unique: list[dict] = inspector.get_unique_constraints("charts")
+    for constraint in unique:
+        if constraint["column_names"] == ["date"]:
+            print(f"dropping constraint {constraint['name']}")
+            conn.execute(
+                text(f'ALTER TABLE charts DROP CONSTRAINT "{constraint["name"]}"')
+            )
+    if not any(c["column_names"] == ["chart_name", "date"] for c in unique):
+        print("adding constraint charts_chart_name_date_key")
+        conn.execute(
+            text(
+                "ALTER TABLE charts ADD CONSTRAINT charts_chart_name_date_key "
+                "UNIQUE (chart_name, date)"
+            )
+        )
+
+
+def add_missing_indexes(conn: Connection):
+    inspector = inspect(conn)
+    for table_name, index_names in ADDED_INDEXES.items():
+        existing: set[str] = {i["name"] for i in inspector.get_indexes(table_name)}
+        for index in Base.metadata.tables[table_name].indexes:
+            if index.name in index_names and index.name not in existing:
+                print(f"creating index {index.name}")
+                index.create(conn)
+
+
+async def dispose_engine():
+    global _engine, _schema_ready
+    if _engine is not None:
+        await _engine.dispose()  # close every pooled connection
+        _engine = None
+        _schema_ready = False
@@ -0,0 +1,39 @@
+from .models import Chart, ChartGap
+from .engine import get_engine
+from sqlalchemy import Select, exists, or_, select
+from sqlalchemy.dialects.postgresql import insert
+from datetime import date
+
+# a week that only ever served shell pages is taken for a gap once this many runs gave up on it,
+# a missing page is a gap right away
+GAP_STRIKES: int = 3
+
+
+def gap_weeks(chart_name: str) -> Select:
+    # the learned gaps of one chart, a week stored since is no longer a gap whatever was learned
+    return select(ChartGap.date).where(
+        ChartGap.chart_name == chart_name,
+        or_(ChartGap.reason == "missing", ChartGap.strikes >= GAP_STRIKES),
+        ~exists().where(
+            Chart.chart_name == ChartGap.chart_name, Chart.date == ChartGap.date
+        ),
+    )
+
+
+async def load_gaps(chart_name: str) -> set[date]:
+    async with get_engine().connect() as conn:
+        return set(await conn.scalars(gap_weeks(chart_name)))
+
+
+async def record_gap(chart_name: str, date_: date, reason: str):
+    # counts one more run that found no chart for the week
+    stmt = insert(ChartGap).values(
+        chart_name=chart_name, date=date_, reason=reason, strikes=1
+    )
+    async with get_engine().begin() as conn:
+        await conn.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[ChartGap.chart_name, ChartGap.date],
+                set_={"reason": stmt.excluded.reason, "strikes": ChartGap.strikes + 1},
+            )
+        )
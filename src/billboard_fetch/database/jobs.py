@@ -0,0 +1,158 @@
+from .models import Job
+from .records import ChartRecord
+from .engine import get_engine
+from sqlalchemy import Update, and_, case, func, or_, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncConnection
+from datetime import date, timedelta
+from typing import AsyncIterable, Optional
+import asyncio
+import os
+import socket
+
+# jobs inserted per statement while enqueueing a plan
+ENQUEUE_CHUNK: int = 1000
+
+# a chart week is given up on once it has been claimed this many times
+MAX_JOB_ATTEMPTS: int = 5
+
+
+class JobQueue:
+    # work queue of chart weeks kept in the jobs table and shared by any number of nodes
+    #   claims lock rows with FOR UPDATE SKIP LOCKED so concurrent nodes never wait on
+    #   or double claim a week, every claim carries a lease its owner keeps renewing
+    #   a node that dies stops renewing and its weeks are claimed again once the lease runs out
+    def __init__(self, lease_seconds: float = 300.0, owner: Optional[str] = None):
+        self.lease: timedelta = timedelta(seconds=lease_seconds)
+        self.owner: str = owner or f"{socket.gethostname()}-{os.getpid()}"
+
+    async def enqueue(self, plans: dict[str, AsyncIterable[date]]) -> int:
+        num_jobs: int = 0
+        async with get_engine().begin() as conn:
+            for chart_name, dates in plans.items():
+                # plans are streamed into the table in chunks instead of materialized
+                chunk: list[date] = []
+                async for date_ in dates:
+                    chunk.append(date_)
+                    if len(chunk) == ENQUEUE_CHUNK:
+                        num_jobs += await self.insert_jobs(conn, chart_name, chunk)
+                        chunk.clear()
+                if chunk:
+                    num_jobs += await self.insert_jobs(conn, chart_name, chunk)
+        return num_jobs
+
+    async def insert_jobs(
+        self, conn: AsyncConnection, chart_name: str, dates: list[date]
+    ) -> int:
+        stmt = insert(Job).values(
+            [{"chart_name": chart_name, "date": d, "state": "pending"} for d in dates]
+        )
+        # weeks queued before are reset unless a node is working on them right now
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Job.chart_name, Job.date],
+            set_={
+                "state": "pending",
+                "owner": None,
+                "lease_until": None,
+                "attempts": 0,
+            },
+            where=Job.state != "claimed",
+        )
+        result = await conn.execute(stmt.returning(Job.id))
+        return len(result.all())
+
+    async def claim(self, n: int) -> list[tuple[str, date]]:
+        # pending weeks and weeks whose owner stopped renewing its lease can be claimed
+        claimable = (
+            select(Job.id)
+            .where(
+                Job.attempts < MAX_JOB_ATTEMPTS,
+                or_(
+                    Job.state == "pending",
+                    and_(Job.state == "claimed", Job.lease_until < func.now()),
+                ),
+            )
+            .order_by(Job.id)
+            .limit(n)
+            .with_for_update(skip_locked=True)
+        )
+        async with get_engine().begin() as conn:
+            result = await conn.execute(
+                update(Job)
+                .where(Job.id.in_(claimable.scalar_subquery()))
+                .values(
+                    state="claimed",
+                    owner=self.owner,
+                    lease_until=func.now() + self.lease,
+                    attempts=Job.attempts + 1,
+                )
+                .returning(Job.id, Job.chart_name, Job.date)
+            )
+            # returned rows are unordered, hand them out in the order they were queued
+            return [(name, date_) for _, name, date_ in sorted(result.all())]
+
+    async def pending(self) -> int:
+        # weeks still waiting for a node, claims held by live nodes are theirs to finish
+        async with get_engine().connect() as conn:
+            return await conn.scalar(
+                select(func.count())
+                .select_from(Job)
+                .where(Job.attempts < MAX_JOB_ATTEMPTS, Job.state == "pending")
+            )
+
+    def complete(self, records: list[ChartRecord]) -> Update:
+        # executed in the transaction that writes the batch, so a week is done exactly when it is stored
+        return (
+            update(Job)
+            .where(
+                tuple_(Job.chart_name, Job.date).in_(
+                    [(record.chart_name, record.date) for record in records]
+                )
+            )
+            .values(state="done", owner=None, lease_until=None)
+        )
+
+    async def settle(self, chart_name: str, date_: date, state: str = "done"):
+        # weeks a worker is done with without writing them, a week with nothing to write is
+        # done and one that kept serving shell pages is failed until it is queued again
+        async with get_engine().begin() as conn:
+            await conn.execute(
+                update(Job)
+                .where(Job.chart_name == chart_name, Job.date == date_)
+                .values(state=state, owner=None, lease_until=None)
+            )
+
+    async def renew(self):
+        async with get_engine().begin() as conn:
+            await conn.execute(
+                update(Job)
+                .where(Job.owner == self.owner, Job.state == "claimed")
+                .values(lease_until=func.now() + self.lease)
+            )
+
+    async def keep_leases(self):
+        # renews every lease this node holds well before it runs out
+        while True:
+            await asyncio.sleep(self.lease.total_seconds() / 3)
+            await self.renew()
+
+    async def close(self) -> dict[str, int]:
+        # weeks claimed but never written go straight back to the queue for other nodes
+        # unless they have used up their attempts
+        async with get_engine().begin() as conn:
+            await conn.execute(
+                update(Job)
+                .where(Job.owner == self.owner, Job.state == "claimed")
+                .values(
+                    state=case(
+                        (Job.attempts >= MAX_JOB_ATTEMPTS, "failed"), else_="pending"
+                    ),
+                    owner=None,
+                    lease_until=None,
+                )
+            )
+            result = await conn.execute(
+                select(Job.state, func.count()).group_by(Job.state)
+            )
+            counts: dict[str, int] = dict(result.all())
+        return counts
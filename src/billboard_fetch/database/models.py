@@ -1,5 +1,14 @@
 import datetime
-from sqlalchemy import ForeignKey
+from typing import Optional
+from sqlalchemy import (
+    ARRAY,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    SmallInteger,
+    UniqueConstraint,
+)
 from sqlalchemy.orm import DeclarativeBase, relationship, Mapped, mapped_column
 from sqlalchemy.ext.asyncio import AsyncAttrs
 
@@ -10,10 +19,14 @@ class Base(AsyncAttrs, DeclarativeBase):
 
 class Chart(Base):
     __tablename__ = "charts"
+    # one chart per name and week, the constraint's index also serves per-chart date lookups
+    __table_args__ = (UniqueConstraint("chart_name", "date"),)
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     chart_name: Mapped[str] = mapped_column(nullable=False, unique=False)
-    date: Mapped[datetime.date] = mapped_column(nullable=False, unique=True)
+    date: Mapped[datetime.date] = mapped_column(nullable=False, unique=False)
+    # digest of the entries, lets the upsert loader skip weeks whose content did not change
+    content_hash: Mapped[Optional[str]] = mapped_column(nullable=True)
 
     entries: Mapped[list["Entry"]] = relationship(
         back_populates="chart", cascade="all, delete-orphan"
@@ -22,11 +35,171 @@ class Chart(Base):
 
 class Entry(Base):
     __tablename__ = "entries"
+    # serves reading a chart's entries in order and replacing them by chart id
+    __table_args__ = (Index("ix_entries_chart_id_position", "chart_id", "position"),)
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     position: Mapped[int] = mapped_column(nullable=False, unique=False)
     chart_id: Mapped[int] = mapped_column(ForeignKey("charts.id"), unique=False)
-    song_title: Mapped[str] = mapped_column(nullable=False, unique=False)
-    artist: Mapped[str] = mapped_column(nullable=False, unique=False)
+    # the title and credit are stored once in songs, every week of a song shares its id
+    song_id: Mapped[int] = mapped_column(
+        ForeignKey("songs.id"), nullable=False, index=True
+    )
 
     chart: Mapped["Chart"] = relationship(back_populates="entries")
+    song: Mapped["Song"] = relationship()
+
+
+class ChartDelta(Base):
+    __tablename__ = "chart_deltas"
+    # a chart week stored as its changes from an earlier full week of the same chart, its
+    # keyframe, in place of entries rows, see deltas.py
+
+    chart_id: Mapped[int] = mapped_column(ForeignKey("charts.id"), primary_key=True)
+    # indexed so rewriting or deleting a keyframe finds the weeks built on it
+    keyframe_id: Mapped[int] = mapped_column(
+        ForeignKey("charts.id"), nullable=False, index=True
+    )
+    # the songs whose position differs from the keyframe and their position, 0 for a song of
+    # the keyframe the week no longer lists
+    song_ids: Mapped[list[int]] = mapped_column(ARRAY(Integer), nullable=False)
+    positions: Mapped[list[int]] = mapped_column(ARRAY(SmallInteger), nullable=False)
+
+
+class Song(Base):
+    __tablename__ = "songs"
+    # a song is its title together with the credit exactly as billboard bills it
+    __table_args__ = (UniqueConstraint("title", "artist_credit"),)
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    title: Mapped[str] = mapped_column(nullable=False)
+    artist_credit: Mapped[str] = mapped_column(nullable=False)
+
+    artists: Mapped[list["SongArtist"]] = relationship(
+        back_populates="song", order_by="SongArtist.billing"
+    )
+
+
+class Artist(Base):
+    __tablename__ = "artists"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    name: Mapped[str] = mapped_column(nullable=False, unique=True)
+
+    songs: Mapped[list["SongArtist"]] = relationship(back_populates="artist")
+
+
+class SongArtist(Base):
+    __tablename__ = "song_artists"
+    # every artist of a song's credit, split into main and featured artists
+
+    song_id: Mapped[int] = mapped_column(ForeignKey("songs.id"), primary_key=True)
+    # indexed for artist history lookups, song lookups use the primary key
+    artist_id: Mapped[int] = mapped_column(
+        ForeignKey("artists.id"), primary_key=True, index=True
+    )
+    role: Mapped[str] = mapped_column(nullable=False)  # main or featured
+    billing: Mapped[int] = mapped_column(nullable=False)  # order within the credit
+
+    song: Mapped["Song"] = relationship(back_populates="artists")
+    artist: Mapped["Artist"] = relationship(back_populates="songs")
+
+
+class SearchTerm(Base):
+    __tablename__ = "search_terms"
+    # normalized text of every song title and artist name, what fuzzy search matches against
+    #   with pg_trgm installed the term has a trigram index, see dimensions.build_search_terms
+
+    kind: Mapped[str] = mapped_column(primary_key=True)  # song or artist
+    ref_id: Mapped[int] = mapped_column(primary_key=True)  # id in songs or artists
+    term: Mapped[str] = mapped_column(nullable=False)
+
+
+class SongStats(Base):
+    __tablename__ = "song_stats"
+    # running aggregates of a song on one chart, kept up to date by the writer as weeks arrive
+
+    song_id: Mapped[int] = mapped_column(ForeignKey("songs.id"), primary_key=True)
+    chart_name: Mapped[str] = mapped_column(primary_key=True)
+    debut: Mapped[datetime.date] = mapped_column(nullable=False)
+    last_week: Mapped[datetime.date] = mapped_column(nullable=False)
+    peak: Mapped[int] = mapped_column(nullable=False)
+    weeks: Mapped[int] = mapped_column(nullable=False)  # weeks on chart
+    # returns to the chart after at least one week off it
+    re_entries: Mapped[int] = mapped_column(nullable=False)
+
+
+class SongScore(Base):
+    __tablename__ = "song_scores"
+    # chart scores of a song on one chart, derived in bulk by the transform command
+
+    song_id: Mapped[int] = mapped_column(ForeignKey("songs.id"), primary_key=True)
+    chart_name: Mapped[str] = mapped_column(primary_key=True)
+    debut: Mapped[datetime.date] = mapped_column(nullable=False)
+    weeks: Mapped[int] = mapped_column(nullable=False)
+    position_score: Mapped[float] = mapped_column(nullable=False)  # sum of 1 / position
+    # sum of the share of the chart ranked below the song
+    longevity_score: Mapped[float] = mapped_column(nullable=False)
+    # sum of log(length + 1) - log(position + 1)
+    overall_score: Mapped[float] = mapped_column(nullable=False)
+
+
+class ArtistScore(Base):
+    __tablename__ = "artist_scores"
+    # chart scores of an artist on one chart, a song's scores are split evenly among its artists
+
+    artist_id: Mapped[int] = mapped_column(ForeignKey("artists.id"), primary_key=True)
+    chart_name: Mapped[str] = mapped_column(primary_key=True)
+    debut: Mapped[datetime.date] = mapped_column(nullable=False)
+    songs: Mapped[int] = mapped_column(nullable=False)
+    weeks: Mapped[int] = mapped_column(nullable=False)  # chart weeks of all its songs
+    position_score: Mapped[float] = mapped_column(nullable=False)
+    longevity_score: Mapped[float] = mapped_column(nullable=False)
+    overall_score: Mapped[float] = mapped_column(nullable=False)
+
+
+class TransformedChart(Base):
+    __tablename__ = "transformed_charts"
+    # every chart the scores were last derived from, a chart missing here is picked up by the
+    # next incremental transform, one whose hash changed since or that was deleted makes the
+    # next transform a full one
+
+    # no foreign key, rows of deleted charts are dropped by the next transform
+    chart_id: Mapped[int] = mapped_column(primary_key=True)
+    content_hash: Mapped[Optional[str]] = mapped_column(nullable=True)
+
+
+class ChartGap(Base):
+    __tablename__ = "chart_gaps"
+    # chart weeks billboard had no chart for when fetched, the planner learns from these
+    # so later runs skip them
+
+    chart_name: Mapped[str] = mapped_column(primary_key=True)
+    date: Mapped[datetime.date] = mapped_column(primary_key=True)
+    # missing when the page was not found, shell when every attempt served a shell page
+    reason: Mapped[str] = mapped_column(nullable=False)
+    strikes: Mapped[int] = mapped_column(nullable=False, default=1)  # runs that gave up
+
+
+class Job(Base):
+    __tablename__ = "jobs"
+    # one fetch job per chart week, shared by every --work node through the database
+    __table_args__ = (UniqueConstraint("chart_name", "date"),)
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    chart_name: Mapped[str] = mapped_column(nullable=False, unique=False)
+    date: Mapped[datetime.date] = mapped_column(nullable=False, unique=False)
+    # pending -> claimed -> done, or failed once a week has used up its attempts
+    state: Mapped[str] = mapped_column(nullable=False, default="pending", index=True)
+    owner: Mapped[Optional[str]] = mapped_column(nullable=True)
+    lease_until: Mapped[Optional[datetime.datetime]] = mapped_column(
+        DateTime(timezone=True), nullable=True
+    )
+    attempts: Mapped[int] = mapped_column(nullable=False, default=0)
+
+
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+    # the schema version the database was last migrated to, a single row
+
+    version: Mapped[int] = mapped_column(primary_key=True)
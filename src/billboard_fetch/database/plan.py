@@ -0,0 +1,41 @@
+from .engine import get_engine
+from .gaps import gap_weeks
+from .models import Chart
+from sqlalchemy import Date, Select, cast, exists, func, select
+from datetime import date, timedelta
+from typing import Collection, Optional
+
+
+def missing_weeks(
+    chart_name: str,
+    start_date: date,
+    end_date: date,
+    gaps: Collection[date] = (),
+) -> Select:
+    # every week between two chart weeks with no stored chart, computed inside postgres
+    # generate_series builds the weeks and the anti-join only reads this chart's rows through
+    # the (chart_name, date) index, so the python side never loads stored dates
+    #   the chart's known gaps and the gaps learned while fetching are left out
+    weeks = (
+        func.generate_series(start_date, end_date, timedelta(days=7))
+        .table_valued("week")
+        .render_derived()
+    )
+    week = cast(weeks.c.week, Date)
+    stmt = select(week).where(
+        ~exists().where(Chart.chart_name == chart_name, Chart.date == week),
+        week.not_in(gap_weeks(chart_name).scalar_subquery()),
+    )
+    if gaps:
+        stmt = stmt.where(week.not_in(sorted(gaps)))
+    return stmt.order_by(weeks.c.week)
+
+
+async def stored_hash(chart_name: str, date_: date) -> Optional[str]:
+    # content hash of the stored week, None if the week is not stored or predates the hashes
+    async with get_engine().connect() as conn:
+        return await conn.scalar(
+            select(Chart.content_hash).where(
+                Chart.chart_name == chart_name, Chart.date == date_
+            )
+        )
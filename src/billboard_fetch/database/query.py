@@ -0,0 +1,453 @@
+from billboard_fetch.configs import CHARTS
+from .deltas import chart_entries
+from .engine import get_engine
+from .models import Artist, Chart, Song, SongArtist
+from .records import ChartRecord
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import date
+from sqlalchemy import Row, Select, and_, case, func, or_, select, tuple_
+from typing import Callable, Hashable, Optional
+import json
+import time
+
+# read path over the stored charts, every query returns one page of rows together with the
+# cursor of the next page
+#   pages continue from the last row of the previous one (keyset pagination) so a late page
+#   costs the same as the first, and recent pages are answered from an in-memory cache
+
+# pages held by the cache, and seconds a page is served before it is read again
+QUERY_CACHE_SIZE: int = 10_000
+QUERY_CACHE_TTL: float = 60.0
+
+# rows per page when no limit is passed
+DEFAULT_LIMITS: dict[str, int] = {
+    "chart": 200,
+    "artist": 100,
+    "song": 100,
+    "top": 10,
+    "changes": 200,
+}
+
+# how the values of each query's cursor are read back from the command line
+CURSOR_TYPES: dict[str, tuple[Callable, ...]] = {
+    "chart": (int,),
+    "artist": (date.fromisoformat, str, int),
+    "song": (int, str, date.fromisoformat),
+    "top": (int, int),
+    "changes": (int,),
+}
+
+CHART_LENGTHS: dict[str, int] = {chart.name: chart.length for chart in CHARTS}
+
+
+@dataclass(frozen=True)
+class Page:
+    columns: tuple[str, ...]
+    rows: tuple[tuple, ...]
+    cursor: Optional[tuple]  # pass as after to get the next page, None on the last page
+
+
+class QueryCache:
+    # least recently used pages by query and arguments
+    #   cleared whenever this process commits charts, pages also expire after ttl seconds so
+    #   a process that only reads still sees the charts other processes write
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize: int = maxsize
+        self.ttl: float = ttl
+        self.data: OrderedDict[Hashable, tuple[float, Page]] = OrderedDict()
+        # bumped by every invalidation, pages read before it are not stored after it
+        self.generation: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def get(self, key: Hashable) -> Optional[Page]:
+        entry: Optional[tuple[float, Page]] = self.data.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: Hashable, page: Page, generation: int):
+        if generation != self.generation:
+            return  # charts were committed while the page was read, it may be stale
+        self.data[key] = (time.monotonic(), page)
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)  # evict the least recently used page
+
+    def invalidate(self):
+        self.data.clear()
+        self.generation += 1
+
+
+# shared by every query of the process, invalidated by the writer after each commit
+query_cache: QueryCache = QueryCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+
+
+async def fetch_page(
+    key: Hashable,
+    build: Callable[[], Select],
+    limit: int,
+    cursor_of: Callable[[Row], tuple],
+) -> Page:
+    # a cache hit returns before any statement is built
+    page: Optional[Page] = query_cache.get(key)
+    if page is not None:
+        return page
+    generation: int = query_cache.generation
+    stmt: Select = build()
+    async with get_engine().connect() as conn:
+        # one row past the page tells whether another page follows
+        result = await conn.execute(stmt.limit(limit + 1))
+        rows: list[Row] = result.all()
+    page = Page(
+        tuple(result.keys()),
+        tuple(tuple(row) for row in rows[:limit]),
+        cursor_of(rows[limit - 1]) if len(rows) > limit else None,
+    )
+    query_cache.put(key, page, generation)
+    return page
+
+
+async def chart_week(
+    chart_name: str,
+    week: date,
+    limit: int = DEFAULT_LIMITS["chart"],
+    after: Optional[tuple[int]] = None,
+) -> Page:
+    # the chart published on or before week, so any day of a chart's week finds it
+    def build() -> Select:
+        chart_id = (
+            select(Chart.id)
+            .where(Chart.chart_name == chart_name, Chart.date <= week)
+            .order_by(Chart.date.desc())
+            .limit(1)
+            .scalar_subquery()
+        )
+        stmt = (
+            select(Chart.date, chart_entries.c.position, Song.title, Song.artist_credit)
+            .join(chart_entries, chart_entries.c.chart_id == Chart.id)
+            .join(Song, Song.id == chart_entries.c.song_id)
+            .where(Chart.id == chart_id)
+            .order_by(chart_entries.c.position)
+        )
+        if after is not None:
+            stmt = stmt.where(chart_entries.c.position > after[0])
+        return stmt
+
+    return await fetch_page(
+        ("chart", chart_name, week, limit, after),
+        build,
+        limit,
+        lambda row: (row.position,),
+    )
+
+
+async def artist_history(
+    name: str,
+    chart_names: Optional[tuple[str, ...]] = None,
+    limit: int = DEFAULT_LIMITS["artist"],
+    after: Optional[tuple[date, str, int]] = None,
+) -> Page:
+    # every week an artist charted with any of their songs, lead or featured, oldest first
+    #   name is matched as billed, one artist of a credit
+    def build() -> Select:
+        stmt = (
+            select(
+                Chart.date,
+                Chart.chart_name,
+                chart_entries.c.position,
+                Song.title,
+                Song.artist_credit,
+                SongArtist.role,
+            )
+            .select_from(Artist)
+            .join(SongArtist, SongArtist.artist_id == Artist.id)
+            .join(Song, Song.id == SongArtist.song_id)
+            .join(chart_entries, chart_entries.c.song_id == Song.id)
+            .join(Chart, Chart.id == chart_entries.c.chart_id)
+            .where(Artist.name == name)
+            .order_by(Chart.date, Chart.chart_name, chart_entries.c.position)
+        )
+        if chart_names:
+            stmt = stmt.where(Chart.chart_name.in_(chart_names))
+        if after is not None:
+            stmt = stmt.where(
+                tuple_(Chart.date, Chart.chart_name, chart_entries.c.position)
+                > tuple_(*after)
+            )
+        return stmt
+
+    return await fetch_page(
+        ("artist", name, chart_names, limit, after),
+        build,
+        limit,
+        lambda row: (row.date, row.chart_name, row.position),
+    )
+
+
+async def song_trajectory(
+    title: str,
+    artist_credit: Optional[str] = None,
+    chart_names: Optional[tuple[str, ...]] = None,
+    limit: int = DEFAULT_LIMITS["song"],
+    after: Optional[tuple[int, str, date]] = None,
+) -> Page:
+    # every week of every song with the title, or only of the one billed as artist_credit,
+    # week by week on each chart
+    def build() -> Select:
+        stmt = (
+            select(
+                Song.id.label("song_id"),
+                Song.artist_credit,
+                Chart.chart_name,
+                Chart.date,
+                chart_entries.c.position,
+            )
+            .select_from(Song)
+            .join(chart_entries, chart_entries.c.song_id == Song.id)
+            .join(Chart, Chart.id == chart_entries.c.chart_id)
+            .where(Song.title == title)
+            .order_by(Song.id, Chart.chart_name, Chart.date)
+        )
+        if artist_credit is not None:
+            stmt = stmt.where(Song.artist_credit == artist_credit)
+        if chart_names:
+            stmt = stmt.where(Chart.chart_name.in_(chart_names))
+        if after is not None:
+            stmt = stmt.where(
+                tuple_(Song.id, Chart.chart_name, Chart.date) > tuple_(*after)
+            )
+        return stmt
+
+    return await fetch_page(
+        ("song", title, artist_credit, chart_names, limit, after),
+        build,
+        limit,
+        lambda row: (row.song_id, row.chart_name, row.date),
+    )
+
+
+async def top_songs(
+    chart_name: str,
+    start_date: date,
+    end_date: date,
+    limit: int = DEFAULT_LIMITS["top"],
+    after: Optional[tuple[int, int]] = None,
+) -> Page:
+    # songs ranked by their points over the range, a week at position p scores
+    # length + 1 - p, the number one of a week scores the chart's length
+    def build() -> Select:
+        length: int = CHART_LENGTHS.get(chart_name, 100)
+        ranked = (
+            select(
+                Song.id.label("song_id"),
+                Song.title,
+                Song.artist_credit,
+                func.sum(length + 1 - chart_entries.c.position).label("points"),
+                func.min(chart_entries.c.position).label("peak"),
+                func.count().label("weeks"),
+            )
+            .select_from(Chart)
+            .join(chart_entries, chart_entries.c.chart_id == Chart.id)
+            .join(Song, Song.id == chart_entries.c.song_id)
+            .where(
+                Chart.chart_name == chart_name,
+                Chart.date.between(start_date, end_date),
+            )
+            .group_by(Song.id)
+            .subquery()
+        )
+        stmt = select(
+            ranked.c.points,
+            ranked.c.title,
+            ranked.c.artist_credit,
+            ranked.c.peak,
+            ranked.c.weeks,
+            ranked.c.song_id,
+        ).order_by(ranked.c.points.desc(), ranked.c.song_id)
+        if after is not None:
+            points, song_id = after
+            stmt = stmt.where(
+                or_(
+                    ranked.c.points < points,
+                    and_(ranked.c.points == points, ranked.c.song_id > song_id),
+                )
+            )
+        return stmt
+
+    return await fetch_page(
+        ("top", chart_name, start_date, end_date, limit, after),
+        build,
+        limit,
+        lambda row: (row.points, row.song_id),
+    )
+
+
+async def chart_changes(
+    chart_name: str,
+    week: date,
+    limit: int = DEFAULT_LIMITS["changes"],
+    after: Optional[tuple[int]] = None,
+) -> Page:
+    # what changed on the chart published on or before week since the chart before it, the
+    # songs that entered or moved by their new position, then the songs that left
+    #   two chart reads whether the weeks are stored in full or as deltas
+    length: int = CHART_LENGTHS.get(chart_name, 100)
+
+    def build() -> Select:
+        current = (
+            select(Chart.id, Chart.date)
+            .where(Chart.chart_name == chart_name, Chart.date <= week)
+            .order_by(Chart.date.desc())
+            .limit(1)
+            .cte("current")
+        )
+        previous = (
+            select(Chart.id)
+            .join(current, Chart.date < current.c.date)
+            .where(Chart.chart_name == chart_name)
+            .order_by(Chart.date.desc())
+            .limit(1)
+            .cte("previous")
+        )
+        now = (
+            select(chart_entries.c.song_id, chart_entries.c.position)
+            .where(chart_entries.c.chart_id == select(current.c.id).scalar_subquery())
+            .subquery("now")
+        )
+        before = (
+            select(chart_entries.c.song_id, chart_entries.c.position)
+            .where(chart_entries.c.chart_id == select(previous.c.id).scalar_subquery())
+            .subquery("before")
+        )
+        changed = (
+            select(
+                func.coalesce(now.c.song_id, before.c.song_id).label("song_id"),
+                now.c.position,
+                before.c.position.label("previous"),
+            )
+            .select_from(now.join(before, now.c.song_id == before.c.song_id, full=True))
+            .where(now.c.position.is_distinct_from(before.c.position))
+            .subquery()
+        )
+        # songs that left are ranked below the chart by their previous position
+        rank = func.coalesce(changed.c.position, length + changed.c.previous)
+        stmt = (
+            select(
+                case(
+                    (changed.c.previous.is_(None), "entry"),
+                    (changed.c.position.is_(None), "exit"),
+                    else_="move",
+                ).label("change"),
+                changed.c.position,
+                changed.c.previous,
+                Song.title,
+                Song.artist_credit,
+            )
+            .join(Song, Song.id == changed.c.song_id)
+            .order_by(rank)
+        )
+        if after is not None:
+            stmt = stmt.where(rank > after[0])
+        return stmt
+
+    return await fetch_page(
+        ("changes", chart_name, week, limit, after),
+        build,
+        limit,
+        lambda row: (
+            row.position if row.position is not None else length + row.previous,
+        ),
+    )
+
+
+async def load_chart(chart_name: str, week: date) -> Optional[ChartRecord]:
+    # materializes the chart published on or before week, stored in full or as a delta
+    async with get_engine().connect() as conn:
+        chart: Optional[Row] = (
+            await conn.execute(
+                select(Chart.id, Chart.date)
+                .where(Chart.chart_name == chart_name, Chart.date <= week)
+                .order_by(Chart.date.desc())
+                .limit(1)
+            )
+        ).first()
+        if chart is None:
+            return None
+        rows: list[Row] = (
+            await conn.execute(
+                select(
+                    chart_entries.c.position,
+                    Song.title,
+                    Song.artist_credit,
+                    Song.id,
+                )
+                .join(Song, Song.id == chart_entries.c.song_id)
+                .where(chart_entries.c.chart_id == chart.id)
+                .order_by(chart_entries.c.position)
+            )
+        ).all()
+    return ChartRecord(
+        chart_name,
+        chart.date,
+        [row.position for row in rows],
+        [row.title for row in rows],
+        [row.artist_credit for row in rows],
+        [row.id for row in rows],
+    )
+
+
+def encode_cursor(cursor: tuple) -> str:
+    return json.dumps(cursor, default=str)
+
+
+def decode_cursor(kind: str, text: str) -> tuple:
+    types: tuple[Callable, ...] = CURSOR_TYPES[kind]
+    try:
+        values: list = json.loads(text)
+        if len(values) != len(types):
+            raise ValueError
+        return tuple(parse(value) for parse, value in zip(types, values))
+    except (ValueError, TypeError):
+        raise Exception(f"{text} is not a cursor of a --query {kind} page")
+
+
+async def run_query(
+    kind: str,
+    chart_names: Optional[list[str]] = None,
+    week: Optional[date] = None,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    artist: Optional[str] = None,
+    song: Optional[str] = None,
+    limit: Optional[int] = None,
+    after: Optional[str] = None,
+):
+    # prints one page of a query as tab separated rows, followed by how to get the next one
+    start_time: float = time.perf_counter()
+    limit = limit or DEFAULT_LIMITS[kind]
+    cursor: Optional[tuple] = None if after is None else decode_cursor(kind, after)
+    charts: Optional[tuple[str, ...]] = tuple(chart_names) if chart_names else None
+    page: Page
+    if kind == "chart":
+        page = await chart_week(chart_names[0], week, limit, cursor)
+    elif kind == "artist":
+        page = await artist_history(artist, charts, limit, cursor)
+    elif kind == "song":
+        page = await song_trajectory(song, artist, charts, limit, cursor)
+    elif kind == "changes":
+        page = await chart_changes(chart_names[0], week, limit, cursor)
+    else:
+        page = await top_songs(chart_names[0], start_date, end_date, limit, cursor)
+    print("\t".join(page.columns))
+    for row in page.rows:
+        print("\t".join(map(str, row)))
+    print(
+        f"{len(page.rows)} rows in {round((time.perf_counter() - start_time) * 1000, 1)} ms"
+    )
+    if page.cursor is not None:
+        print(f"next page: --after '{encode_cursor(page.cursor)}'")
@@ -0,0 +1,47 @@
+import datetime
+import hashlib
+from dataclasses import dataclass, field
+from .models import Chart, Entry
+
+
+@dataclass(slots=True)
+class ChartRecord:
+    # lightweight columnar chart passed between pipeline stages in place of orm objects
+    chart_name: str
+    date: datetime.date
+    positions: list[int]
+    titles: list[str]
+    artists: list[str]
+    # filled in by the writer from the interning cache right before the chart is written
+    song_ids: list[int] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def nbytes(self) -> int:
+        # rough size of the chart's rows, bounds how much a write batch holds
+        return (
+            sum(map(len, self.titles))
+            + sum(map(len, self.artists))
+            + 8 * len(self.positions)
+        )
+
+    def to_chart(self) -> Chart:
+        # orm objects are only built when the chart is about to be written
+        return Chart(
+            chart_name=self.chart_name,
+            date=self.date,
+            content_hash=self.content_hash(),
+            entries=[
+                Entry(position=p, song_id=s)
+                for p, s in zip(self.positions, self.song_ids)
+            ],
+        )
+
+    def content_hash(self) -> str:
+        # digest of the chart rows only, equal for two fetches of an unchanged week
+        digest = hashlib.blake2b(digest_size=16)
+        for row in zip(self.positions, self.titles, self.artists):
+            digest.update("\x1f".join(map(str, row)).encode())
+            digest.update(b"\x1e")
+        return digest.hexdigest()
@@ -0,0 +1,213 @@
+from billboard_fetch.etl.credits import search_term
+from .deltas import chart_entries
+from .engine import get_engine
+from .models import Artist, SearchTerm, Song, SongArtist
+from .query import Page
+from collections import Counter
+from sqlalchemy import (
+    Float,
+    Integer,
+    Numeric,
+    Select,
+    cast,
+    column,
+    func,
+    literal,
+    literal_column,
+    or_,
+    select,
+    text,
+    values,
+)
+from sqlalchemy.ext.asyncio import AsyncConnection
+from typing import Optional
+import heapq
+import time
+
+# fuzzy search over song titles and artist names
+#   both the stored terms and the searched text are normalized by search_term, then matched
+#   by the trigrams they share, ranked the way pg_trgm ranks them
+#   servers with pg_trgm answer from the trigram index on search_terms, the others from an
+#   n-gram index this process builds in memory from the same table
+
+# matches below both thresholds are left out, pg_trgm's defaults for % and <%
+SIMILARITY_THRESHOLD: float = 0.3
+WORD_SIMILARITY_THRESHOLD: float = 0.6
+
+# matches returned when no limit is passed
+DEFAULT_SEARCH_LIMIT: int = 10
+
+# whether the server has pg_trgm, looked up once per process
+_trigram: Optional[bool] = None
+
+
+def trigrams(term: str) -> set[str]:
+    # the trigrams pg_trgm extracts from a single word, padded by two spaces before and one after
+    padded: str = f"  {term} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class NgramIndex:
+    # in-memory trigram index of the search terms for servers without pg_trgm
+    #   terms are read once, later searches only read the terms added since
+    def __init__(self):
+        self.terms: list[tuple[str, int, str]] = []  # (kind, ref id, term)
+        self.postings: dict[str, list[int]] = {}  # trigram -> positions in terms
+        self.sizes: list[int] = []  # trigrams per term
+        self.last_ids: dict[str, int] = {"song": 0, "artist": 0}
+
+    async def refresh(self, conn: AsyncConnection):
+        # ids only grow so the terms of every new song and artist have a greater ref id
+        for kind, last_id in self.last_ids.items():
+            result = await conn.stream(
+                select(SearchTerm.ref_id, SearchTerm.term)
+                .where(SearchTerm.kind == kind, SearchTerm.ref_id > last_id)
+                .order_by(SearchTerm.ref_id)
+                .execution_options(yield_per=10_000)
+            )
+            async for rows in result.partitions():
+                for ref_id, term in rows:
+                    grams: set[str] = trigrams(term)
+                    for gram in grams:
+                        self.postings.setdefault(gram, []).append(len(self.terms))
+                    self.terms.append((kind, ref_id, term))
+                    self.sizes.append(len(grams))
+                self.last_ids[kind] = rows[-1][0]
+
+    def search(self, kind: str, term: str, limit: int) -> list[tuple[float, int]]:
+        # returns (score, ref id) of the best matches, best first
+        grams: set[str] = trigrams(term)
+        shared: Counter[int] = Counter()
+        for gram in grams:
+            shared.update(self.postings.get(gram, ()))
+        matches: list[tuple[float, int]] = []
+        for i, count in shared.items():
+            if self.terms[i][0] != kind:
+                continue
+            similarity: float = count / (len(grams) + self.sizes[i] - count)
+            # the share of the searched trigrams found in the term, pg_trgm's word
+            # similarity without its ordering of the trigrams
+            word_similarity: float = count / len(grams)
+            if (
+                similarity >= SIMILARITY_THRESHOLD
+                or word_similarity >= WORD_SIMILARITY_THRESHOLD
+            ):
+                matches.append((max(similarity, word_similarity), self.terms[i][1]))
+        return heapq.nlargest(limit, matches)
+
+
+# shared by every search of the process
+ngram_index: NgramIndex = NgramIndex()
+
+
+async def has_trigram(conn: AsyncConnection) -> bool:
+    global _trigram
+    if _trigram is None:
+        _trigram = bool(
+            await conn.scalar(
+                text(
+                    "SELECT EXISTS (SELECT FROM pg_extension WHERE extname = 'pg_trgm')"
+                )
+            )
+        )
+    return _trigram
+
+
+def matched(kind: str, term: str) -> Select:
+    # (score, ref id) of the best matches through the trigram index
+    score = func.greatest(
+        func.similarity(SearchTerm.term, term),
+        func.word_similarity(term, SearchTerm.term),
+    )
+    return select(score.label("score"), SearchTerm.ref_id).where(
+        SearchTerm.kind == kind,
+        or_(
+            SearchTerm.term.op("%")(term),
+            literal(term).op("<%")(SearchTerm.term),
+        ),
+    )
+
+
+def described(kind: str, matches: Select) -> Select:
+    # joins the matches back to what they name, with the weeks a song charted or the songs
+    # an artist is billed on
+    m = matches.subquery()
+    if kind == "song":
+        weeks = (
+            select(func.count())
+            .where(chart_entries.c.song_id == m.c.ref_id)
+            .scalar_subquery()
+        )
+        return (
+            select(
+                func.round(cast(m.c.score, Numeric), 3).label("score"),
+                Song.title,
+                Song.artist_credit,
+                weeks.label("weeks"),
+                Song.id.label("song_id"),
+            )
+            .select_from(m)
+            .join(Song, Song.id == m.c.ref_id)
+            .order_by(m.c.score.desc(), Song.id)
+        )
+    songs = (
+        select(func.count()).where(SongArtist.artist_id == m.c.ref_id).scalar_subquery()
+    )
+    return (
+        select(
+            func.round(cast(m.c.score, Numeric), 3).label("score"),
+            Artist.name,
+            songs.label("songs"),
+            Artist.id.label("artist_id"),
+        )
+        .select_from(m)
+        .join(Artist, Artist.id == m.c.ref_id)
+        .order_by(m.c.score.desc(), Artist.id)
+    )
+
+
+async def fuzzy_search(
+    kind: str, text_: str, limit: int = DEFAULT_SEARCH_LIMIT
+) -> Page:
+    # the songs whose title, or the artists whose name, best match text_, best first
+    term: str = search_term(text_, kind == "artist")
+    if not term:
+        return Page((), (), None)
+    async with get_engine().connect() as conn:
+        if await has_trigram(conn):
+            matches: Select = (
+                matched(kind, term)
+                .order_by(literal_column("score").desc(), SearchTerm.ref_id)
+                .limit(limit)
+            )
+        else:
+            await ngram_index.refresh(conn)
+            found: list[tuple[float, int]] = ngram_index.search(kind, term, limit)
+            if not found:
+                return Page((), (), None)
+            # the scores ride along as a VALUES list so both paths share the query below
+            matches = select(
+                values(
+                    column("score", Float),
+                    column("ref_id", Integer),
+                    name="found",
+                ).data(found)
+            )
+        result = await conn.execute(described(kind, matches))
+        return Page(tuple(result.keys()), tuple(tuple(row) for row in result), None)
+
+
+async def run_search(kind: str, text_: str, limit: Optional[int] = None):
+    # prints the best matches as tab separated rows
+    start_time: float = time.perf_counter()
+    page: Page = await fuzzy_search(kind, text_, limit or DEFAULT_SEARCH_LIMIT)
+    if not page.rows:
+        print(f"no {kind} matches {text_!r}")
+        return
+    print("\t".join(page.columns))
+    for row in page.rows:
+        print("\t".join(map(str, row)))
+    print(
+        f"{len(page.rows)} matches in "
+        f"{round((time.perf_counter() - start_time) * 1000, 1)} ms"
+    )
@@ -0,0 +1,161 @@
+from .deltas import chart_entries
+from .dimensions import chunked
+from .models import Chart, Entry, SongStats
+from .records import ChartRecord
+from datetime import timedelta
+from sqlalchemy import (
+    ColumnElement,
+    Date,
+    Select,
+    case,
+    delete,
+    distinct,
+    exists,
+    func,
+    select,
+    tuple_,
+)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncConnection
+from typing import Iterable, Optional
+
+# (song id, chart name), the key of one row of song_stats
+StatsKey = tuple[int, str]
+
+# a song that skips more than one week left the chart and re-entered it
+WEEK: timedelta = timedelta(days=7)
+
+# song_stats columns in the order both the batch rows and stats_select produce them
+STATS_COLUMNS: list[str] = [
+    "song_id",
+    "chart_name",
+    "debut",
+    "last_week",
+    "peak",
+    "weeks",
+    "re_entries",
+]
+
+
+def stats_select(where: Optional[ColumnElement[bool]] = None) -> Select:
+    # aggregates song_stats rows from the stored entries, used whenever the running
+    # aggregates cannot be advanced from a batch alone
+    gap = Chart.date - func.lag(Chart.date, type_=Date).over(
+        partition_by=(chart_entries.c.song_id, Chart.chart_name), order_by=Chart.date
+    )
+    weeks = select(
+        chart_entries.c.song_id,
+        Chart.chart_name,
+        Chart.date,
+        chart_entries.c.position,
+        gap.label("gap"),
+    ).join(Chart, Chart.id == chart_entries.c.chart_id)
+    if where is not None:
+        weeks = weeks.where(where)
+    weeks = weeks.subquery()
+    return select(
+        weeks.c.song_id,
+        weeks.c.chart_name,
+        func.min(weeks.c.date),
+        func.max(weeks.c.date),
+        func.min(weeks.c.position),
+        func.count(distinct(weeks.c.date)),
+        func.count().filter(weeks.c.gap > WEEK.days),
+    ).group_by(weeks.c.song_id, weeks.c.chart_name)
+
+
+def upsert_stats(stmt):
+    # replaces stats rows outright with freshly aggregated ones
+    return stmt.on_conflict_do_update(
+        index_elements=[SongStats.song_id, SongStats.chart_name],
+        set_={c: stmt.excluded[c] for c in STATS_COLUMNS[2:]},
+    )
+
+
+async def recompute_stats(conn: AsyncConnection, keys: Iterable[StatsKey]):
+    # rebuilds the stats of only the given songs from their stored entries
+    for chunk in chunked(sorted(set(keys))):
+        # songs left with no entries on a chart lose their row there
+        await conn.execute(
+            delete(SongStats).where(
+                tuple_(SongStats.song_id, SongStats.chart_name).in_(chunk)
+            )
+        )
+        await conn.execute(
+            upsert_stats(
+                insert(SongStats).from_select(
+                    STATS_COLUMNS,
+                    stats_select(
+                        tuple_(chart_entries.c.song_id, Chart.chart_name).in_(chunk)
+                    ),
+                )
+            )
+        )
+
+
+def batch_stats(records: list[ChartRecord]) -> dict[StatsKey, list]:
+    # aggregates a batch on its own, walking its charts in date order
+    #   stats[key] = [debut, last week, peak, weeks, re-entries]
+    stats: dict[StatsKey, list] = {}
+    for record in sorted(records, key=lambda x: x.date):
+        for position, song_id in zip(record.positions, record.song_ids):
+            key: StatsKey = (song_id, record.chart_name)
+            row: Optional[list] = stats.get(key)
+            if row is None:
+                stats[key] = [record.date, record.date, position, 1, 0]
+                continue
+            if record.date - row[1] > WEEK:
+                row[4] += 1
+            if record.date > row[1]:
+                row[1] = record.date
+                row[3] += 1
+            row[2] = min(row[2], position)
+    return stats
+
+
+async def update_stats(
+    conn: AsyncConnection,
+    records: list[ChartRecord],
+    stale: Iterable[StatsKey] = (),
+):
+    # advances the stats of every song in the batch inside the batch's transaction
+    #   stale are songs that lost entries the batch replaced, they are always recomputed
+    stats: dict[StatsKey, list] = batch_stats(records)
+    advanced: set[StatsKey] = set()
+    stmt = insert(SongStats)
+    new = stmt.excluded
+    # a stored row only advances when the whole batch comes after its last week,
+    # otherwise nothing is returned for it
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[SongStats.song_id, SongStats.chart_name],
+        set_={
+            "last_week": new.last_week,
+            "peak": func.least(SongStats.peak, new.peak),
+            "weeks": SongStats.weeks + new.weeks,
+            "re_entries": SongStats.re_entries
+            + new.re_entries
+            + case((new.debut - SongStats.last_week > WEEK.days, 1), else_=0),
+        },
+        where=new.debut > SongStats.last_week,
+    ).returning(SongStats.song_id, SongStats.chart_name)
+    # sorted so concurrent writers lock stats rows in the same order, sent as
+    # multi-row pages of one cached statement
+    rows: list[dict] = [
+        dict(zip(STATS_COLUMNS, (*key, *stats[key]))) for key in sorted(stats)
+    ]
+    if rows:
+        advanced.update(tuple(key) for key in await conn.execute(stmt, rows))
+    # out of order backfills and rewritten weeks are rebuilt from the entries
+    await recompute_stats(conn, (set(stats) - advanced) | set(stale))
+
+
+async def build_stats(conn: AsyncConnection):
+    # fills song_stats from every stored entry when the table is new to a populated database
+    if await conn.scalar(select(exists().select_from(SongStats))):
+        return
+    if not await conn.scalar(select(exists().select_from(Entry))):
+        return
+    print("computing song stats from the stored entries")
+    await conn.execute(
+        upsert_stats(insert(SongStats).from_select(STATS_COLUMNS, stats_select()))
+    )
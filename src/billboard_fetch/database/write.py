@@ -1,48 +1,411 @@
+from .deltas import (
+    KEYFRAME_SPAN,
+    DeltaEncoder,
+    Encoded,
+    clear_charts,
+    write_deltas,
+)
+from .dimensions import artist_cache, intern_songs, song_cache
+from .engine import get_engine
+from .stats import StatsKey, update_stats
 from .models import Chart
-from billboard_fetch.configs import DB_URI
-from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from .query import query_cache
+from .records import ChartRecord
+from sqlalchemy import Executable, insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession, async_sessionmaker
+from billboard_fetch.utils import Metrics
+from datetime import date
+from functools import partial
+from typing import Awaitable, Callable, Collection, Optional, Protocol
 import asyncio
+import random
+import time
 
 
-engine = create_async_engine(DB_URI)
+# sessions are bound to the shared engine when opened, not at import
+async_session: async_sessionmaker[AsyncSession] = async_sessionmaker()
 
-async_session: async_sessionmaker[AsyncSession] = async_sessionmaker(engine)
+# column order used when streaming entry rows through COPY
+ENTRY_COPY_SQL: str = "COPY entries (chart_id, position, song_id) FROM STDIN"
 
+# bounds of the charts per batch and the size batches start at
+MIN_BATCH: int = 10
+START_BATCH: int = 100
+MAX_BATCH: int = 1000
+# a batch is written once its titles and credits take this many bytes, however few charts
+MAX_BATCH_BYTES: int = 4 * 2**20
+# commit latency the batch size is tuned towards
+TARGET_COMMIT_SECONDS: float = 0.5
 
-async def async_add_batch(batch: list[Chart]):
+# deadlocks and serialization failures between concurrent writers, the aborted batch is
+# written again up to WRITE_ATTEMPTS times
+RETRY_SQLSTATES: set[str] = {"40P01", "40001"}
+WRITE_ATTEMPTS: int = 4
+
+
+async def async_add_batch(
+    batch: list[ChartRecord], in_transaction: Optional[Executable] = None
+) -> list[ChartRecord]:
     batch.sort(key=lambda x: x.date)  # sort charts by date ascending
-    async with async_session() as session:
+    await intern_songs(get_engine(), batch)
+    written: list[ChartRecord] = list(batch)
+    async with async_session(bind=get_engine()) as session:
         async with session.begin():
-            session.add_all(batch)
+            # orm objects are built here, at the write stage, from the chart records
+            session.add_all([record.to_chart() for record in batch])
+            await session.flush()
+            await update_stats(await session.connection(), batch)
+            if in_transaction is not None:
+                await session.execute(in_transaction)
+    batch.clear()  # clear buffer
+    return written
+
+
+async def copy_entries(
+    conn: AsyncConnection, chart_ids: list[int], records: list[ChartRecord]
+):
+    # streams the entry rows of every record through a single COPY on the connection's transaction
+    raw_conn = await conn.get_raw_connection()
+    async with raw_conn.driver_connection.cursor() as cur:
+        async with cur.copy(ENTRY_COPY_SQL) as copy:
+            for chart_id, record in zip(chart_ids, records):
+                for row in zip(record.positions, record.song_ids):
+                    await copy.write_row((chart_id, *row))
+
+
+async def write_entries(
+    conn: AsyncConnection,
+    chart_ids: list[int],
+    records: list[ChartRecord],
+    deltas: Optional[DeltaEncoder],
+    rewritten: Collection[int] = (),
+) -> Optional[Encoded]:
+    # writes the entries of the inserted charts, with delta storage only the keyframes are
+    # written in full and the other weeks as their changes from them
+    if deltas is None:
+        await copy_entries(conn, chart_ids, records)
+        return None
+    encoded: Encoded = await deltas.encode(conn, chart_ids, records, rewritten)
+    await copy_entries(conn, encoded.chart_ids, encoded.records)
+    await write_deltas(conn, encoded)
+    return encoded
+
+
+async def async_copy_batch(
+    batch: list[ChartRecord],
+    in_transaction: Optional[Executable] = None,
+    deltas: Optional[DeltaEncoder] = None,
+) -> list[ChartRecord]:
+    batch.sort(key=lambda x: x.date)  # sort charts by date ascending
+    await intern_songs(get_engine(), batch)
+    written: list[ChartRecord] = list(batch)
+    async with get_engine().begin() as conn:
+        # assign every chart id in the batch with one multi-row INSERT ... RETURNING
+        result = await conn.execute(
+            insert(Chart).returning(Chart.id, sort_by_parameter_order=True),
+            [
+                {
+                    "chart_name": r.chart_name,
+                    "date": r.date,
+                    "content_hash": r.content_hash(),
+                }
+                for r in batch
+            ],
+        )
+        encoded: Optional[Encoded] = await write_entries(
+            conn, list(result.scalars()), batch, deltas
+        )
+        await update_stats(conn, batch)
+        if in_transaction is not None:
+            await conn.execute(in_transaction)
+    if encoded is not None:
+        deltas.keep(encoded)
     batch.clear()  # clear buffer
+    return written
+
+
+async def async_upsert_batch(
+    batch: list[ChartRecord],
+    in_transaction: Optional[Executable] = None,
+    deltas: Optional[DeltaEncoder] = None,
+) -> list[ChartRecord]:
+    # writes new weeks and overwrites stored weeks whose content changed, skipping the rest
+    batch.sort(key=lambda x: x.date)  # sort charts by date ascending
+    await intern_songs(get_engine(), batch)
+    records: dict[tuple[str, date], ChartRecord] = {
+        (r.chart_name, r.date): r for r in batch
+    }
+    stmt = pg_insert(Chart).values(
+        [
+            {
+                "chart_name": r.chart_name,
+                "date": r.date,
+                "content_hash": r.content_hash(),
+            }
+            for r in records.values()
+        ]
+    )
+    # an existing week is only touched, and only returned, when its hash differs
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Chart.chart_name, Chart.date],
+        set_={"content_hash": stmt.excluded.content_hash},
+        where=Chart.content_hash.is_distinct_from(stmt.excluded.content_hash),
+    ).returning(Chart.id, Chart.chart_name, Chart.date)
+    encoded: Optional[Encoded] = None
+    async with get_engine().begin() as conn:
+        changed: list[tuple[int, str, date]] = list(await conn.execute(stmt))
+        chart_ids: list[int] = [chart_id for chart_id, _, _ in changed]
+        written: list[ChartRecord] = [records[(n, d)] for _, n, d in changed]
+        if written:
+            # the entries of every changed week are replaced as one set
+            replaced: list[tuple[int, int]] = await clear_charts(conn, chart_ids)
+            chart_names: dict[int, str] = {id_: n for id_, n, _ in changed}
+            # songs that held a replaced week may have lost it
+            stale: set[StatsKey] = {(s, chart_names[c]) for s, c in replaced}
+            encoded = await write_entries(conn, chart_ids, written, deltas, chart_ids)
+            await update_stats(conn, written, stale)
+        if in_transaction is not None:
+            await conn.execute(in_transaction)
+    if encoded is not None:
+        deltas.keep(encoded)
+    batch.clear()  # clear buffer
+    return written
+
+
+# a batch writer, returns the charts it actually wrote
+#   in_transaction is an extra statement committed atomically with the batch
+WriteBatch = Callable[
+    [list[ChartRecord], Optional[Executable]], Awaitable[list[ChartRecord]]
+]
+
+
+class Sink(Protocol):
+    # a batch writer the pipeline writes to in place of the database, selected with --sink
+    name: str
+
+    async def __call__(
+        self, batch: list[ChartRecord], in_transaction: Optional[Executable] = None
+    ) -> list[ChartRecord]: ...
+
 
+# batch writers selectable with --loader
+LOADERS: dict[str, WriteBatch] = {
+    "orm": async_add_batch,
+    "copy": async_copy_batch,
+    "upsert": async_upsert_batch,
+}
 
-async def async_writer(queue2: asyncio.Queue, num_producers: int):
-    batch: list[Chart] = []  # buffer
 
-    async def async_stream():
-        # defines streaming behavior from the captured queue
+class BatchSizer:
+    # charts per batch, tuned from how long batches take to commit
+    #   full batches that commit well under the target grow the next ones, any batch over it
+    #   shrinks them to what would have committed in time, so batches stay large without
+    #   holding charts for long
+    def __init__(self, size: int = START_BATCH):
+        self.size: int = size
+
+    def observe(self, num_charts: int, seconds: float):
+        if seconds > TARGET_COMMIT_SECONDS:
+            fitting: int = int(num_charts * TARGET_COMMIT_SECONDS / seconds)
+            self.size = max(MIN_BATCH, min(self.size, fitting))
+        elif num_charts >= self.size and seconds < TARGET_COMMIT_SECONDS / 2:
+            self.size = min(MAX_BATCH, int(self.size * 1.5))
+
+
+def is_retryable(e: DBAPIError) -> bool:
+    return getattr(e.orig, "sqlstate", None) in RETRY_SQLSTATES
+
+
+# first and last week of every chart in a batch
+Spans = dict[str, tuple[date, date]]
+
+
+def batch_spans(batch: list[ChartRecord]) -> Spans:
+    spans: Spans = {}
+    for record in batch:
+        first, last = spans.get(record.chart_name, (record.date, record.date))
+        spans[record.chart_name] = (min(first, record.date), max(last, record.date))
+    return spans
+
+
+def share_keyframes(a: Spans, b: Spans) -> bool:
+    # whether a week of one batch may be the keyframe of a week of the other
+    return any(
+        chart_name in b
+        and first - KEYFRAME_SPAN <= b[chart_name][1]
+        and b[chart_name][0] - KEYFRAME_SPAN <= last
+        for chart_name, (first, last) in a.items()
+    )
+
+
+async def async_writer(
+    queue2: asyncio.Queue,
+    num_producers: int,
+    loader: str = "orm",
+    on_commit: Optional[Callable[[list[ChartRecord]], None]] = None,
+    in_transaction: Optional[Callable[[list[ChartRecord]], Executable]] = None,
+    metrics: Optional[Metrics] = None,
+    sink: Optional[Sink] = None,
+    num_writers: int = 4,
+    max_age: float = 2.0,
+    storage: str = "full",
+):
+    # gathers parsed charts into batches and writes them through num_writers concurrent
+    # transactions, a batch is handed off once it holds enough charts or bytes or once its
+    # oldest chart has waited max_age seconds, whichever comes first
+    #   whichever writer is free takes the next batch, concurrent batches of the same chart
+    #   are safe since song_stats rows are locked in one order and recomputed from the
+    #   committed entries whenever a batch lands out of order
+    if storage == "delta" and loader == "orm":
+        loader = "copy"  # the orm loader only writes full weeks
+    write_batch: WriteBatch = LOADERS[loader] if sink is None else sink
+    target: str = f"loader={loader}" if sink is None else f"sink={sink.name}"
+    # deltas written while the keyframe they point at is rewritten would decode against its
+    # new content, batches of the upsert loader that share keyframes are written in turn
+    serialize: bool = sink is None and storage == "delta" and loader == "upsert"
+    if sink is None and storage == "delta":
+        # one encoder for every writer, keyframes are only kept once their batch committed
+        write_batch = partial(write_batch, deltas=DeltaEncoder())
+        target += ", storage=delta"
+    sizer: BatchSizer = BatchSizer()
+    # one batch waiting for a free writer, the collector stops reading queue2 while it waits
+    batches: asyncio.Queue = asyncio.Queue(maxsize=1)
+    # spans of the batches being written, only tracked when batches are serialized
+    in_flight: list[Spans] = []
+    turn: asyncio.Condition = asyncio.Condition()
+    num_rows: int = 0
+    num_unchanged: int = 0
+    num_retries: int = 0
+    write_time: float = 0.0
+
+    async def collect():
+        loop = asyncio.get_running_loop()
         num_sentinels: int = 0
+        batch: list[ChartRecord] = []  # buffer
+        num_bytes: int = 0
+        deadline: Optional[float] = None  # when the oldest chart in the buffer is due
+
+        async def hand_off(trigger: str):
+            nonlocal batch, num_bytes, deadline
+            if metrics is not None:
+                metrics.inc("write_flushes_total", trigger=trigger)
+            await batches.put(batch)
+            batch, num_bytes, deadline = [], 0, None
 
         while (
             num_sentinels < num_producers
         ):  # while there is at least one active producer
-            item = await queue2.get()
+            wait_start: float = time.perf_counter()
             try:
-                if item is None:
-                    num_sentinels += 1
-                    continue
-                yield item
-            finally:
-                queue2.task_done()
+                async with asyncio.timeout_at(deadline):
+                    item: Optional[ChartRecord] = await queue2.get()
+            except TimeoutError:
+                await hand_off("age")
+                continue
+            queue2.task_done()
+            if metrics is not None:  # time the writer sat idle waiting on the scrapers
+                metrics.observe(
+                    "queue_get_wait_seconds",
+                    time.perf_counter() - wait_start,
+                    queue="write",
+                )
+            if item is None:
+                num_sentinels += 1
+                continue
+            if not batch:
+                deadline = loop.time() + max_age
+            batch.append(item)
+            num_bytes += item.nbytes()
+            if len(batch) >= sizer.size:
+                await hand_off("size")
+            elif num_bytes >= MAX_BATCH_BYTES:
+                await hand_off("bytes")
+
+        if batch:
+            await hand_off("end")
+        for _ in range(num_writers):
+            await batches.put(None)
 
-    async for chart in async_stream():
-        batch.append(chart)
-        if len(batch) >= 100:
-            # if 100 charts in buffer write them to database
-            await async_add_batch(batch)
+    async def flush(batch: list[ChartRecord]):
+        nonlocal num_rows, num_unchanged, num_retries, write_time
+        records: list[ChartRecord] = list(batch)  # write_batch clears the buffer
+        statement: Optional[Executable] = (
+            None if in_transaction is None else in_transaction(records)
+        )
+        start_time: float = time.perf_counter()
+        for attempt in range(WRITE_ATTEMPTS):
+            try:
+                written: list[ChartRecord] = await write_batch(batch, statement)
+                break
+            except DBAPIError as e:
+                # a transaction postgres aborted for a concurrent one left nothing behind,
+                # the batch is still whole and is written again
+                if not is_retryable(e) or attempt == WRITE_ATTEMPTS - 1:
+                    raise
+                num_retries += 1
+                if metrics is not None:
+                    metrics.inc("write_retries_total")
+                await asyncio.sleep(random.uniform(0.05, 0.2) * 2**attempt)
+        if written:
+            query_cache.invalidate()  # cached pages may miss the new weeks
+        batch_time: float = time.perf_counter() - start_time
+        sizer.observe(len(records), batch_time)
+        rows: int = sum(len(record) for record in written)
+        write_time += batch_time
+        num_rows += rows
+        # stored weeks the upsert loader found unchanged are done without being rewritten
+        num_unchanged += len(records) - len(written)
+        if metrics is not None:
+            metrics.observe("write_batch_seconds", batch_time)
+            metrics.inc("charts_written_total", len(written))
+            metrics.inc("charts_unchanged_total", len(records) - len(written))
+            metrics.inc("rows_written_total", rows)
+            metrics.set("write_batch_size", sizer.size)
+        if on_commit is not None:
+            on_commit(records)
+
+    async def write_worker():
+        while (batch := await batches.get()) is not None:
+            if not serialize:
+                await flush(batch)
+                continue
+            spans: Spans = batch_spans(batch)
+            async with turn:
+                # batches taken earlier go first, so a chart's weeks still commit in order
+                await turn.wait_for(
+                    lambda: not any(share_keyframes(spans, s) for s in in_flight)
+                )
+                in_flight.append(spans)
+            try:
+                await flush(batch)
+            finally:
+                async with turn:
+                    in_flight.remove(spans)
+                    turn.notify_all()
 
-    if batch:
-        await async_add_batch(batch)
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(collect())
+        for _ in range(num_writers):
+            tg.create_task(write_worker())
 
-    await engine.dispose()  # dispose db connection
+    if write_time:
+        # write_time adds up every writer, the rate is per writer
+        print(
+            f"{num_rows} rows written in {round(write_time, 3)} seconds "
+            f"({round(num_rows / write_time)} rows/sec, {target}, "
+            f"{num_writers} writers, final batch size {sizer.size})"
+        )
+    if num_retries:
+        print(f"{num_retries} batches written again after a deadlock")
+    if num_unchanged:
+        print(f"{num_unchanged} stored charts unchanged and skipped")
+    if song_cache.hits or song_cache.misses:
+        print(
+            f"song cache: {song_cache.hits} hits, {song_cache.misses} misses, "
+            f"artist cache: {artist_cache.hits} hits, {artist_cache.misses} misses"
+        )
+    if metrics is not None:
+        metrics.set("song_cache_hits", song_cache.hits)
+        metrics.set("song_cache_misses", song_cache.misses)
@@ -1 +1,32 @@
-from .extract import extract
+from importlib import import_module
+from typing import TYPE_CHECKING
+
+# submodule of every name exported here, imported on first use so the process pool's
+# workers only load the parser and not the http client or the database layer
+_EXPORTS: dict[str, str] = {
+    "extract": "extract",
+    "ResponseArchive": "archive",
+    "ShellPageError": "html_parser",
+    "RunJournal": "journal",
+    "run_transform": "transform",
+    "ParquetSink": "parquet",
+    "export_parquet": "parquet",
+    "import_parquet": "parquet",
+}
+
+
+def __getattr__(name: str):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(f".{_EXPORTS[name]}", __name__), name)
+    globals()[name] = value  # later lookups skip __getattr__
+    return value
+
+
+if TYPE_CHECKING:
+    from .extract import extract
+    from .archive import ResponseArchive
+    from .html_parser import ShellPageError
+    from .journal import RunJournal
+    from .transform import run_transform
+    from .parquet import ParquetSink, export_parquet, import_parquet
@@ -0,0 +1,131 @@
+from datetime import date, datetime
+from pathlib import Path
+from typing import Iterator, Mapping, Optional
+import gzip
+import hashlib
+import json
+import os
+from .html_parser import ChartRows, parse_html
+
+
+class ResponseArchive:
+    # content-addressed store of raw chart html
+    #   objects/<ab>/<sha256>.gz holds each distinct gzip compressed body once
+    #   refs/<chart_name>/<YYYY-MM-DD> holds the sha256 of the body fetched for that chart week
+    #   validators/<chart_name>/<YYYY-MM-DD> holds the conditional request headers for that week
+    #   hashes/<chart_name>/<YYYY-MM-DD> holds the content hash of the rows that body parsed into
+    def __init__(self, root: str | Path, compress_level: int = 6):
+        self.root: Path = Path(root)
+        self.compress_level: int = compress_level
+
+    def ref_path(self, chart_name: str, date_: date) -> Path:
+        return self.root / "refs" / chart_name / date_.strftime("%Y-%m-%d")
+
+    def object_path(self, digest: str) -> Path:
+        return self.root / "objects" / digest[:2] / f"{digest}.gz"
+
+    def validators_path(self, chart_name: str, date_: date) -> Path:
+        return self.root / "validators" / chart_name / date_.strftime("%Y-%m-%d")
+
+    def hash_path(self, chart_name: str, date_: date) -> Path:
+        return self.root / "hashes" / chart_name / date_.strftime("%Y-%m-%d")
+
+    def get_digest(self, chart_name: str, date_: date) -> Optional[str]:
+        try:
+            return self.ref_path(chart_name, date_).read_text().strip()
+        except FileNotFoundError:
+            return None
+
+    def get_path(self, chart_name: str, date_: date) -> Optional[Path]:
+        # returns the path of the archived body for a chart week or None if it was never archived
+        digest: Optional[str] = self.get_digest(chart_name, date_)
+        if digest is None:
+            return None
+        path: Path = self.object_path(digest)
+        return path if path.exists() else None
+
+    def get_validators(self, chart_name: str, date_: date) -> dict[str, str]:
+        # If-None-Match / If-Modified-Since headers revalidating the archived body, empty if unknown
+        try:
+            return json.loads(self.validators_path(chart_name, date_).read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def put_validators(
+        self, chart_name: str, date_: date, response_headers: Mapping[str, str]
+    ):
+        # keeps the ETag and Last-Modified of the response the archived body came from
+        validators: dict[str, str] = {}
+        if "ETag" in response_headers:
+            validators["If-None-Match"] = response_headers["ETag"]
+        if "Last-Modified" in response_headers:
+            validators["If-Modified-Since"] = response_headers["Last-Modified"]
+        path: Path = self.validators_path(chart_name, date_)
+        if validators:
+            _atomic_write(path, json.dumps(validators).encode())
+        else:  # validators of an older body must not revalidate the new one
+            path.unlink(missing_ok=True)
+
+    def get_content_hash(self, chart_name: str, date_: date) -> Optional[str]:
+        # content hash of the archived body's rows, None if it was archived before it was kept
+        try:
+            return self.hash_path(chart_name, date_).read_text().strip()
+        except FileNotFoundError:
+            return None
+
+    def put_content_hash(self, chart_name: str, date_: date, content_hash: str):
+        _atomic_write(self.hash_path(chart_name, date_), content_hash.encode())
+
+    def get(self, chart_name: str, date_: date) -> Optional[bytes]:
+        path: Optional[Path] = self.get_path(chart_name, date_)
+        return None if path is None else gzip.decompress(path.read_bytes())
+
+    def put(self, chart_name: str, date_: date, body: bytes) -> str:
+        digest: str = body_digest(body)
+        path: Path = self.object_path(digest)
+        if not path.exists():  # identical bodies are only stored once
+            _atomic_write(path, gzip.compress(body, self.compress_level))
+        if digest != self.get_digest(chart_name, date_):
+            # the rows of the replaced body no longer describe the week
+            self.hash_path(chart_name, date_).unlink(missing_ok=True)
+        _atomic_write(self.ref_path(chart_name, date_), digest.encode())
+        return digest
+
+    def dates(
+        self,
+        chart_name: str,
+        start_date: Optional[date] = None,
+        end_date: Optional[date] = None,
+    ) -> Iterator[date]:
+        # yields every archived date of a chart in ascending order within the optional range
+        ref_dir: Path = self.root / "refs" / chart_name
+        if not ref_dir.is_dir():
+            return
+        for name in sorted(os.listdir(ref_dir)):
+            try:
+                date_: date = datetime.strptime(name, "%Y-%m-%d").date()
+            except ValueError:  # skip partially written temp files
+                continue
+            if start_date is not None and date_ < start_date:
+                continue
+            if end_date is not None and date_ > end_date:
+                break
+            yield date_
+
+
+def body_digest(body: bytes) -> str:
+    # name of a body in the archive, equal digests mean byte for byte equal bodies
+    return hashlib.sha256(body).hexdigest()
+
+
+def _atomic_write(path: Path, data: bytes):
+    # write to a temp file then rename so readers never see a partial file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path: Path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+
+def parse_archived(path: Path, chart_len: int = 100) -> ChartRows:
+    # reads, decompresses and parses an archived body entirely inside the worker process
+    return parse_html(gzip.decompress(path.read_bytes()), chart_len)
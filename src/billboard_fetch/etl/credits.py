@@ -0,0 +1,84 @@
+import re
+import unicodedata
+
+# "a duet with" is billed like "&"
+DUET_PATTERN: re.Pattern = re.compile(r"(?i)\b(a\s)?duet\swith")
+# a parenthesised featuring, with or & credit, only the parentheses are dropped
+PAREN_PATTERN: re.Pattern = re.compile(r"(?i)\((feat\.*[a-z]*|&|with)(.*?)\)(.*$)")
+# any other parenthesised note, e.g. a group's members, is not an artist of its own
+NOTE_PATTERN: re.Pattern = re.compile(r"\s*\([^)]*\)")
+# first class separators, everything after the first one is a featured artist
+#   the parser joins an artist link to the text around it, so "BrownsFeaturingJim" and
+#   "PresleyWith The" are matched case sensitively without the surrounding spaces too
+FEATURE_PATTERN: re.Pattern = re.compile(
+    r"(?i:\sfeat\.*[a-z]*\s|\swith\s)|(?<=[a-z.)])(?:Featuring|Feat\.|With)(?=[A-Z\s])"
+)
+# second class separators between artists billed on the same side
+#   a bare comma is part of too many names, "Earth, Wind & Fire" or "Tyler, The Creator",
+#   only lists of featured artists are split on it
+ARTIST_SEPARATOR: re.Pattern = re.compile(r"\s*[&/+]\s*|\s[xX]\s")
+FEATURED_SEPARATOR: re.Pattern = re.compile(r"\s*[&/+,]\s*|\s[xX]\s")
+# acts whose name holds a separator, never split wherever they are billed
+KNOWN_NAMES: tuple[str, ...] = (
+    "Blood, Sweat & Tears",
+    "Crosby, Stills & Nash",
+    "Crosby, Stills, Nash & Young",
+    "Earth, Wind & Fire",
+    "Emerson, Lake & Palmer",
+    "Tyler, The Creator",
+)
+KNOWN_NAME_PATTERN: re.Pattern = re.compile(
+    "|".join(map(re.escape, sorted(KNOWN_NAMES, key=len, reverse=True))), re.I
+)
+
+
+def split_names(part: str, separator: re.Pattern) -> list[str]:
+    # splits one side of a credit on separator, keeping known names whole
+    names: list[str] = []
+    last: int = 0
+    for match in KNOWN_NAME_PATTERN.finditer(part):
+        names += separator.split(part[last : match.start()])
+        names.append(match.group())
+        last = match.end()
+    return names + separator.split(part[last:])
+
+
+def split_credit(credit: str) -> list[tuple[str, str]]:
+    # splits a billed artist credit into (artist, role) pairs in billing order
+    #   "Drake Featuring Future & Young Thug"
+    #   -> [("Drake", "main"), ("Future", "featured"), ("Young Thug", "featured")]
+    #   "Earth, Wind & Fire" -> [("Earth, Wind & Fire", "main")]
+    # "and" is never split on, too many band names contain it
+    credit = PAREN_PATTERN.sub(r"\1\2\3", DUET_PATTERN.sub("&", credit))
+    credit = NOTE_PATTERN.sub("", credit)
+    artists: list[tuple[str, str]] = []
+    seen: set[str] = set()
+    for i, part in enumerate(FEATURE_PATTERN.split(credit)):
+        for name in split_names(part, FEATURED_SEPARATOR if i else ARTIST_SEPARATOR):
+            name = name.strip()
+            if name and name not in seen:
+                seen.add(name)
+                artists.append((name, "featured" if i else "main"))
+    return artists
+
+
+# separators a credit may be billed with in any of its spellings, "X And Y", "X & Y" and
+# "X Featuring Y" all leave the same search term
+#   "x" only between two names, "Lil Nas X" ends in a name, not a collaboration
+TERM_SEPARATOR: re.Pattern = re.compile(
+    r"\b(?:a\s+)?duet\s+with\b|\bfeat(?:uring|\.)?|\bft\.|\bwith\b|\band\b|[&/+,]"
+    r"|(?<=\w)\s+x\s+(?=\w)(?!(?:feat|ft\.|with\b|and\b|(?:a\s+)?duet\b))"
+)
+# everything but letters and digits, spaces included, so "Br Andy", the parser's spelling of
+# "Brandy", reads the same as the name it was cut from
+TERM_NOISE: re.Pattern = re.compile(r"[\W_]+")
+
+
+def search_term(text: str, credit: bool = False) -> str:
+    # the normalized text fuzzy search matches titles, credits and artist names by
+    #   "Simon & Garfunkel" -> "simongarfunkel", "Beyoncé Featuring JAY Z" -> "beyoncejayz"
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    if credit:
+        text = TERM_SEPARATOR.sub(" ", text)
+    return TERM_NOISE.sub("", text)
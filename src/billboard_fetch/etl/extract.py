@@ -1,95 +1,529 @@
 import asyncio
 from concurrent.futures import ProcessPoolExecutor
 from datetime import date
+from pathlib import Path
 from typing import Iterator, Optional
-import time
+import os
 import random
-from aiohttp import ClientSession, TCPConnector
-from billboard_fetch.database import Chart, Entry, async_writer
+import time
+from aiohttp import (
+    ClientConnectionError,
+    ClientPayloadError,
+    ClientResponse,
+    ClientSession,
+    TCPConnector,
+)
+from billboard_fetch.configs import (
+    ARCHIVE_DIR,
+    BILLBOARD_URL,
+    CHART_INFO,
+    CHARTS,
+    PARQUET_DIR,
+)
+from billboard_fetch.database import ChartRecord, JobQueue, async_writer
+from billboard_fetch.database.gaps import record_gap
+from billboard_fetch.database.plan import stored_hash
 from billboard_fetch.utils import (
+    AdaptiveLimiter,
     AsyncCounter,
+    Metrics,
+    monitor_queues,
     retry_middleware,
+    timed_call,
 )
-from .html_parser import parse_html
+from .archive import ResponseArchive, body_digest, parse_archived
+from .journal import RunJournal
+from .html_parser import (
+    LIST_END_MARKER,
+    LIST_START_LIMIT,
+    LIST_START_MARKER,
+    ROW_MARKER,
+    ChartRows,
+    ShellPageError,
+    parse_html,
+)
+
+# attempts made at a chart week that keeps coming back as a shell page
+SHELL_ATTEMPTS: int = 4
+
+# bytes read from the response stream at a time
+CHUNK_SIZE: int = 64 * 1024
+
+
+async def read_chart_body(r: ClientResponse, chart_len: int) -> bytes:
+    # reads the body incrementally, giving up as soon as the chart list ends early
+    body: bytearray = bytearray()
+    list_start: int = -1  # offset of the chart list, -1 until it opened
+    num_rows: int = 0
+    async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+        # rescan the tail of the previous chunk in case a marker was split across chunks
+        scan_from: int = max(
+            0, len(body) - max(len(ROW_MARKER), len(LIST_START_MARKER)) + 1
+        )
+        body += chunk
+        if num_rows >= chart_len:
+            continue  # rows are confirmed, just finish reading the body
+        if list_start == -1:
+            list_start = body.find(LIST_START_MARKER, scan_from)
+            if list_start == -1:
+                if len(body) >= LIST_START_LIMIT:
+                    raise ShellPageError(
+                        f"no chart list in the first {len(body)} bytes"
+                    )
+                continue
+            scan_from = list_start
+        num_rows += body.count(ROW_MARKER, scan_from)
+        if num_rows < chart_len and body.find(LIST_END_MARKER, scan_from) != -1:
+            raise ShellPageError(f"chart list ended after {num_rows} rows")
+    if list_start == -1:
+        raise ShellPageError("body has no chart list")
+    if num_rows < chart_len:
+        # shell pages stop inside the list, the way logs/paywall_html.html does
+        raise ShellPageError(f"chart list cut off after {num_rows} rows")
+    return bytes(body)
 
 
 async def url_producer(
-    dates: Iterator[date], queue1: asyncio.Queue, chart_name: str, num_workers: int
+    plans: list[tuple[CHART_INFO, Iterator[date]]],
+    queue1: asyncio.Queue,
+    num_workers: int,
 ):
-    # produces chart urls for each date in dates iterator and puts them into queue1
-    for i, _date in enumerate(dates, start=1):
-        tail_url: str = f"{chart_name}/{_date.strftime('%Y-%m-%d')}/"
-        await queue1.put((i, _date, tail_url))
+    # produces chart urls for each chart's dates iterator and puts them into queue1
+    # charts take turns one week at a time so they all progress at the same pace
+    active: list[tuple[CHART_INFO, Iterator[date]]] = [
+        (chart, iter(dates)) for chart, dates in plans
+    ]
+    i: int = 0
+    while active:
+        for plan in list(active):
+            chart, dates = plan
+            _date: Optional[date] = next(dates, None)
+            if _date is None:  # this chart's plan is exhausted
+                active.remove(plan)
+                continue
+            i += 1
+            tail_url: str = f"{chart.name}/{_date.strftime('%Y-%m-%d')}/"
+            await queue1.put((i, chart, _date, tail_url))
     for _ in range(num_workers):
         # put a sentinel value into queue1 for each scrape worker to signal that the url producer has finished
         await queue1.put(None)
 
 
+async def job_producer(
+    jobs: JobQueue,
+    queue1: asyncio.Queue,
+    num_workers: int,
+    poll_every: float = 1.0,
+):
+    # claims chart weeks from the shared jobs table and puts their urls into queue1
+    charts: dict[str, CHART_INFO] = {chart.name: chart for chart in CHARTS}
+    i: int = 0
+    while True:
+        # claim only what fits the fetch queue so claimed weeks do not sit idle on this node
+        claimed: list[tuple[str, date]] = await jobs.claim(
+            max(1, queue1.maxsize - queue1.qsize())
+        )
+        if not claimed:
+            # weeks leased by dead nodes are claimed above once their lease runs out,
+            # weeks held by live nodes are left to them
+            if not await jobs.pending():
+                break
+            # pending weeks were locked by nodes claiming at the same moment, try again
+            await asyncio.sleep(poll_every)
+            continue
+        for chart_name, _date in claimed:
+            i += 1
+            chart: CHART_INFO = charts[chart_name]
+            tail_url: str = f"{chart.name}/{_date.strftime('%Y-%m-%d')}/"
+            await queue1.put((i, chart, _date, tail_url))
+    for _ in range(num_workers):
+        await queue1.put(None)
+
+
 async def scrape_worker(
     num: int,
-    chart_name: str,
     counter: Optional[AsyncCounter],
     queue1: asyncio.Queue,
     queue2: asyncio.Queue,
     client: ClientSession,
+    limiter: AdaptiveLimiter,
     pool: ProcessPoolExecutor,
+    archive: ResponseArchive,
+    metrics: Metrics,
+    journal: Optional[RunJournal],
+    reparse: bool = False,
+    refresh: bool = False,
+    jobs: Optional[JobQueue] = None,
 ):
-    # parse the html response body for each url into a Chart object and put into queue2
+    # parse the html response body for each url into a ChartRecord and put into queue2
     while True:
-        item: tuple[int, date, str] | None = await queue1.get()
+        wait_start: float = time.perf_counter()
+        item: tuple[int, CHART_INFO, date, str] | None = await queue1.get()
+        # a worker that waits long here is starved by the producer or the limiter
+        metrics.observe(
+            "queue_get_wait_seconds", time.perf_counter() - wait_start, queue="fetch"
+        )
         if item is None:
             # if sentinel value is received, pass through to queue2 and end worker
             await queue2.put(None)
             queue1.task_done()
             break
-        # unstructure tuple into date and url
-        chart_num, date_, tail_url = item
-        # get html response body from url
-        async with client.get(tail_url) as r:
-            r.raise_for_status()
-            r_body: str = await r.text(encoding="utf-8")
+        # unstructure tuple into chart, date and url
+        chart_num, chart, date_, tail_url = item
         loop = asyncio.get_running_loop()
-        # offloads the parsing of html into a list of entries objects into a process pool since parsing is cpu-bounded
-        entries: list[Entry] = await loop.run_in_executor(pool, parse_html, r_body)
-        # create a charts object from the chart date and entries list
-        chart: Chart = Chart(date=date_, chart_name=chart_name, entries=entries)
+        rows: ChartRows
+        parse_time: float  # seconds spent parsing inside the pool process
+        # check the local archive before going to the network
+        archived: Optional[Path] = await asyncio.to_thread(
+            archive.get_path, chart.name, date_
+        )
+        if archived is not None and not refresh:
+            if journal is not None:
+                journal.mark("fetched", chart.name, [date_])
+            metrics.inc("archive_hits_total")
+            # the worker process reads and decompresses the archived body itself
+            parse_start: float = time.perf_counter()
+            rows, parse_time = await loop.run_in_executor(
+                pool, timed_call, parse_archived, archived, chart.length
+            )
+            metrics.observe("parse_seconds", parse_time, source="archive")
+        elif reparse:
+            # reparse runs never touch the network, skip weeks missing from the archive
+            print(f"{chart.name} {date_} is not archived, skipping")
+            if jobs is not None:
+                await jobs.settle(chart.name, date_)
+            queue1.task_done()
+            continue
+        else:
+            # refresh runs revalidate archived weeks instead of reading them
+            validators: dict[str, str] = {}
+            archived_digest: Optional[str] = None
+            if archived is not None:
+                validators = await asyncio.to_thread(
+                    archive.get_validators, chart.name, date_
+                )
+                archived_digest = await asyncio.to_thread(
+                    archive.get_digest, chart.name, date_
+                )
+            unchanged: bool = False
+            missing: bool = False
+            for attempt in range(SHELL_ATTEMPTS):
+                try:
+                    # get html response body from url, stopping early on shell pages
+                    fetch_start: float = time.perf_counter()
+                    async with client.get(tail_url, headers=validators) as r:
+                        congested: bool = False
+                        try:
+                            # retry_middleware passes a 304 straight through, it has no body
+                            unchanged = r.status == 304
+                            # billboard has no chart for the week, nothing to retry
+                            missing = r.status == 404
+                            if missing:
+                                break
+                            if not unchanged:
+                                r.raise_for_status()
+                                r_body: bytes = await read_chart_body(r, chart.length)
+                        except (
+                            ClientPayloadError,
+                            ClientConnectionError,
+                            TimeoutError,
+                        ):
+                            congested = True
+                            raise
+                        finally:
+                            # the request holds its limiter slot until the body was read
+                            await limiter.done(r, congested)
+                    # limiter waits and retries included, response_seconds has the bare latency
+                    metrics.observe("fetch_seconds", time.perf_counter() - fetch_start)
+                    if journal is not None:
+                        journal.mark("fetched", chart.name, [date_])
+                    if unchanged:
+                        metrics.inc("not_modified_total")
+                        break
+                    metrics.inc("fetched_bytes_total", len(r_body))
+                    if archived_digest is not None:
+                        # servers without validators still get caught by the body hash
+                        digest: str = await asyncio.to_thread(body_digest, r_body)
+                        if digest == archived_digest:
+                            unchanged = True
+                            metrics.inc("unchanged_bodies_total")
+                            await asyncio.to_thread(
+                                archive.put_validators, chart.name, date_, r.headers
+                            )
+                            break
+                    # offloads the decoding and parsing of the raw body into a process pool since parsing is cpu-bounded
+                    parse_start = time.perf_counter()
+                    rows, parse_time = await loop.run_in_executor(
+                        pool, timed_call, parse_html, r_body, chart.length
+                    )
+                    metrics.observe("parse_seconds", parse_time, source="network")
+                    break
+                except ShellPageError:
+                    metrics.inc("shell_pages_total")
+                    # shell pages get their own backoff, separate from the limiter's,
+                    # the last attempt skips the week right away
+                    if attempt < SHELL_ATTEMPTS - 1:
+                        await asyncio.sleep(2**attempt + random.expovariate(1.0 / 0.3))
+            else:
+                metrics.inc("shell_skipped_total")
+                print(
+                    f"{chart.name} {date_} served a shell page {SHELL_ATTEMPTS} times, skipping"
+                )
+                # left to later runs, until enough of them gave up on it too
+                await record_gap(chart.name, date_, "shell")
+                if jobs is not None:
+                    await jobs.settle(chart.name, date_, "failed")
+                queue1.task_done()
+                continue
+            if missing:
+                metrics.inc("missing_weeks_total")
+                print(f"{chart.name} {date_} has no chart, skipping")
+                # learned by the calendar so no later plan includes the week
+                await record_gap(chart.name, date_, "missing")
+                if journal is not None:
+                    journal.mark("written", chart.name, [date_], sync=True)
+                if jobs is not None:
+                    await jobs.settle(chart.name, date_)
+                queue1.task_done()
+                continue
+            if unchanged:
+                # the archived body is still current, the week is only skipped once the
+                # database holds the rows that body parsed into
+                stored: Optional[str] = await stored_hash(chart.name, date_)
+                if stored is not None and stored == await asyncio.to_thread(
+                    archive.get_content_hash, chart.name, date_
+                ):
+                    if journal is not None:
+                        journal.mark("written", chart.name, [date_], sync=True)
+                    if jobs is not None:
+                        await jobs.settle(chart.name, date_)
+                    queue1.task_done()
+                    continue
+                # stored differently or not at all, the archived body is written instead
+                metrics.inc("unchanged_unstored_total")
+                parse_start = time.perf_counter()
+                rows, parse_time = await loop.run_in_executor(
+                    pool, timed_call, parse_archived, archived, chart.length
+                )
+                metrics.observe("parse_seconds", parse_time, source="archive")
+            else:
+                # only archive bodies that parsed into a full chart, with the validators they came with
+                await asyncio.to_thread(archive.put, chart.name, date_, r_body)
+                await asyncio.to_thread(
+                    archive.put_validators, chart.name, date_, r.headers
+                )
+            await asyncio.to_thread(
+                archive.put_content_hash,
+                chart.name,
+                date_,
+                ChartRecord(chart.name, date_, *rows).content_hash(),
+            )
+        # pickling the body and rows plus waiting for a free pool process
+        metrics.observe("ipc_seconds", time.perf_counter() - parse_start - parse_time)
+        metrics.inc("charts_parsed_total")
+        if journal is not None:
+            journal.mark("parsed", chart.name, [date_])
         # mark the current url response as parsed/done
         queue1.task_done()
         # increment the parsed charts counter
         # await counter.add()
-        await queue2.put(chart)
-        # sleep to avoid flooding the billboard site
-        await asyncio.sleep(random.expovariate(1.0))
+        # create a chart record from the chart date and parsed rows
+        put_start: float = time.perf_counter()
+        await queue2.put(ChartRecord(chart.name, date_, *rows))
+        # a worker that waits long here is held back by the writer
+        metrics.observe(
+            "queue_put_wait_seconds", time.perf_counter() - put_start, queue="write"
+        )
+
 
+def mark_written(journal: RunJournal, records: list[ChartRecord]):
+    # written weeks are synced to disk so a resume never redoes them
+    dates: dict[str, list[date]] = {}
+    for record in records:
+        dates.setdefault(record.chart_name, []).append(record.date)
+    for chart_name, chart_dates in dates.items():
+        journal.mark("written", chart_name, chart_dates, sync=True)
 
-async def extract(chart_name: str, dates: Iterator[date]):
+
+def report_stages(metrics: Metrics, elapsed: float):
+    # one line per stage, the stage with the highest time per chart is the bottleneck
+    fetch = metrics.histogram("fetch_seconds")
+    response = metrics.histogram("response_seconds")
+    ipc = metrics.histogram("ipc_seconds")
+    write = metrics.histogram("write_batch_seconds")
+    rows: float = metrics.counter("rows_written_total")
+    metrics.set("rows_per_second", rows / elapsed if elapsed else 0.0)
+    if fetch.count:
+        print(
+            f"fetch: {fetch.count} charts, p50 {fetch.quantile(0.5):.3f}s, p95 {fetch.quantile(0.95):.3f}s "
+            f"(server p50 {response.quantile(0.5):.3f}s), {int(metrics.counter('retries_total'))} retries, "
+            f"{metrics.counter('fetched_bytes_total') / 2**20:.1f} MiB"
+        )
+    for source in ("network", "archive"):
+        parse = metrics.histogram("parse_seconds", source=source)
+        if parse.count:
+            print(
+                f"parse ({source}): p50 {parse.quantile(0.5) * 1000:.1f}ms in the pool, "
+                f"ipc p50 {ipc.quantile(0.5) * 1000:.1f}ms"
+            )
+    if write.count:
+        print(
+            f"write: {write.count} batches, p50 {write.quantile(0.5):.3f}s, "
+            f"{round(rows / write.sum) if write.sum else 0} rows/sec while writing, "
+            f"{round(rows / elapsed) if elapsed else 0} rows/sec overall"
+        )
+
+
+async def extract(
+    plans: list[tuple[CHART_INFO, Iterator[date]]],
+    journal: Optional[RunJournal],
+    loader: str = "orm",
+    reparse: bool = False,
+    refresh: bool = False,
+    max_concurrency: int = 16,
+    max_rate: float = 10.0,
+    fetch_queue_size: int = 0,
+    write_queue_size: int = 200,
+    jobs: Optional[JobQueue] = None,
+    metrics_path: Optional[str] = None,
+    sink: str = "postgres",
+    parquet_dir: Optional[str] = None,
+    writers: int = 4,
+    flush_age: float = 2.0,
+    storage: str = "full",
+) -> Metrics:
+    # runs either the given per-chart plans, tracked by a local journal,
+    # or chart weeks claimed from the shared jobs table when jobs is passed
+    # returns the run's metrics
     start_time: float = time.time()
+    archive: ResponseArchive = ResponseArchive(ARCHIVE_DIR)
+    metrics: Metrics = Metrics()
+    # paces every request of the run, the site decides how many are actually in flight
+    limiter: AdaptiveLimiter = AdaptiveLimiter(
+        max_limit=max_concurrency,
+        max_rate=max_rate,
+        start_limit=min(4, max_concurrency),
+        start_rate=min(2.0, max_rate),
+    )
+    # enough workers to fill the limiter's largest window, or every pool process when reparsing
+    num_workers: int = max(max_concurrency, 2 * (os.cpu_count() or 1) if reparse else 0)
     # total_charts: int = calc_num_charts(start_date, end_date)
-    queue1: asyncio.Queue = asyncio.Queue()
-    queue2: asyncio.Queue = asyncio.Queue()
+    # bounded queues make every stage wait on the slowest one instead of buffering without limit
+    #   queue1 defaults to two urls per worker, queue2 to two writer batches
+    queue1: asyncio.Queue = asyncio.Queue(maxsize=fetch_queue_size or 2 * num_workers)
+    queue2: asyncio.Queue = asyncio.Queue(maxsize=write_queue_size)
+    gauges: dict[str, list[int]] = {}
     # counter: AsyncCounter = AsyncCounter(stop_at=total_charts)
     client: ClientSession = ClientSession(
-        base_url="https://www.billboard.com/charts/",
-        middlewares=[retry_middleware],
-        connector=TCPConnector(limit=30),
+        base_url=BILLBOARD_URL,
+        middlewares=[retry_middleware(limiter, metrics=metrics)],
+        connector=TCPConnector(limit=max_concurrency),
     )
     pool: ProcessPoolExecutor = ProcessPoolExecutor()
+    parquet_sink = None
+    if sink == "parquet":
+        from .parquet import ParquetSink  # polars is only loaded for the parquet sink
+
+        parquet_sink = ParquetSink(Path(parquet_dir or PARQUET_DIR))
 
     try:
         async with asyncio.TaskGroup() as tg:
             # tg.create_task(progress_report(total_charts, counter))
-            tg.create_task(url_producer(dates, queue1, chart_name, 5))
-            tg.create_task(async_writer(queue2, 5))
-            for i in range(5):
+            monitor = tg.create_task(
+                monitor_queues({"fetch": queue1, "write": queue2}, gauges)
+            )
+            if jobs is None:
+                tg.create_task(url_producer(plans, queue1, num_workers))
+            else:
+                tg.create_task(job_producer(jobs, queue1, num_workers))
+                lease_keeper = tg.create_task(jobs.keep_leases())
+            writer = tg.create_task(
+                async_writer(
+                    queue2,
+                    num_workers,
+                    loader,
+                    (
+                        None
+                        if journal is None
+                        else lambda records: mark_written(journal, records)
+                    ),
+                    None if jobs is None else jobs.complete,
+                    metrics,
+                    parquet_sink,
+                    writers,
+                    flush_age,
+                    storage,
+                )
+            )
+            for i in range(num_workers):
                 tg.create_task(
-                    scrape_worker(i + 1, chart_name, None, queue1, queue2, client, pool)
+                    scrape_worker(
+                        i + 1,
+                        None,
+                        queue1,
+                        queue2,
+                        client,
+                        limiter,
+                        pool,
+                        archive,
+                        metrics,
+                        journal,
+                        reparse,
+                        refresh,
+                        jobs,
+                    )
                 )
             await queue1.join()  # ensure all producer inputs were processed
             await queue2.join()  # ensure all worker outputs were processed
+            await writer  # the writer exits last, once every worker has sent its sentinel
+            monitor.cancel()
+            if jobs is not None:
+                lease_keeper.cancel()
     finally:
         pool.terminate_workers()
         await client.close()
+        if jobs is not None:
+            job_counts: dict[str, int] = await jobs.close()
+    if journal is not None:
+        journal.finish()
 
     # num_charts: int = await counter.get()
-    print(f"fetching completed in {time.time() - start_time} seconds")
+    elapsed: float = time.time() - start_time
+    print(f"fetching completed in {elapsed} seconds")
+    print(
+        f"final request window {round(limiter.limit, 2)}, final rate {round(limiter.rate, 2)} requests/sec"
+    )
+    metrics.set("elapsed_seconds", elapsed)
+    metrics.set("request_window", limiter.limit)
+    metrics.set("request_rate", limiter.rate)
+    for name, (samples, total, peak) in gauges.items():
+        if samples:
+            print(f"{name} queue depth: mean {round(total / samples, 1)}, max {peak}")
+            metrics.set("queue_depth_mean", total / samples, queue=name)
+            metrics.set("queue_depth_max", peak, queue=name)
+    if metrics.counter("shell_pages_total"):
+        print(
+            f"{int(metrics.counter('shell_pages_total'))} shell pages served, "
+            f"{int(metrics.counter('shell_skipped_total'))} chart weeks skipped"
+        )
+    if metrics.counter("missing_weeks_total"):
+        print(
+            f"{int(metrics.counter('missing_weeks_total'))} chart weeks not found, "
+            "left out of later plans"
+        )
+    if refresh:
+        print(
+            f"{int(metrics.counter('not_modified_total'))} chart weeks not modified, "
+            f"{int(metrics.counter('unchanged_bodies_total'))} refetched unchanged"
+        )
+    report_stages(metrics, elapsed)
+    if metrics_path is not None:
+        metrics.write(metrics_path)
+        print(f"metrics written to {metrics_path}")
+    if jobs is not None:
+        print(
+            "jobs table: "
+            + ", ".join(f"{n} {state}" for state, n in sorted(job_counts.items()))
+        )
     # print(f"{num_charts} extracted in {time.time() - start_time} seconds")
+    return metrics
@@ -1,54 +1,68 @@
 from selectolax.parser import HTMLParser
-from billboard_fetch.database import Entry
 import re
 
+# css selector for the container of a single chart row
+ROW_SELECTOR: str = "div.o-chart-results-list-row-container"
 
-def get_selectors(num: int) -> tuple[str, str, str]:
-    # returns css selectors for:
-    #   chart position, title, artist
-    return (
-        f"""
-        div.o-chart-results-list-row-container:nth-child({num}) > 
-        ul:nth-child(1) > li:nth-child(1) > span:nth-child(1)
-        """,
-        f"""
-    div.o-chart-results-list-row-container:nth-child({num}) > 
-    ul:nth-child(1) > li:nth-child(4) > ul:nth-child(1) > 
-    li:nth-child(1) > h3:nth-child(1)
-    """,
-        f"""
-    div.o-chart-results-list-row-container:nth-child({num}) > 
-    ul:nth-child(1) > li:nth-child(4) > ul:nth-child(1) > 
-    li:nth-child(1) > span:nth-child(2)
-    """,
-    )
-
-
-def parse_html(html_body: str) -> list[Entry]:
-    tree: HTMLParser = HTMLParser(html_body)
-    entries: list[Entry] = []
-    chart_num: int = 1
-    while True:
-        position_tag, title_tag, artist_tag = [
-            tree.css_first(s) for s in get_selectors(chart_num)
-        ]
-        if position_tag and title_tag and artist_tag:
-            attrs = {
-                "position": int(position_tag.text(strip=True)),
-                "artist": re.sub(r"(?<! )[aA]nd", " And", artist_tag.text(strip=True)),
-                "song_title": title_tag.text(strip=True)
-                .replace("RE-\nENTRY", "")
-                .replace("NEW", ""),
-            }
-
-            entries.append(Entry(**attrs))
-
-            if attrs["position"] == 100 or len(entries) == 100:
-                break
-
-        if chart_num >= 150:
-            raise Exception("shell html served")
-
-        chart_num += 1
-
-    return entries
+# css selectors for chart position, title, artist relative to a row container
+POSITION_SELECTOR: str = "ul:nth-child(1) > li:nth-child(1) > span:nth-child(1)"
+TITLE_SELECTOR: str = (
+    "ul:nth-child(1) > li:nth-child(4) > ul:nth-child(1) > "
+    "li:nth-child(1) > h3:nth-child(1)"
+)
+ARTIST_SELECTOR: str = (
+    "ul:nth-child(1) > li:nth-child(4) > ul:nth-child(1) > "
+    "li:nth-child(1) > span:nth-child(2)"
+)
+
+# inserts the space lost when an artist link is joined to the text following it
+ARTIST_PATTERN: re.Pattern = re.compile(r"(?<! )[aA]nd")
+
+# raw markers used to classify a body while it is still streaming in
+#   a shell page opens the chart list like a full one, then stops after its first rows,
+#   logs/paywall_html.html ends inside the list after 14 rows and never reaches its end
+ROW_MARKER: bytes = b"o-chart-results-list-row-container"
+# the chart list, rows are only counted once it opened
+LIST_START_MARKER: bytes = b'<div class="chart-results-list'
+# bytes read before the chart list must have opened, full pages open it about 0.7 MiB in
+LIST_START_LIMIT: int = 2 * 2**20
+# the element rendered right after the last chart row of a full page
+LIST_END_MARKER: bytes = b'charts-paywall-fade">'
+
+# parallel arrays of positions, song titles, artists
+ChartRows = tuple[list[int], list[str], list[str]]
+
+
+class ShellPageError(Exception):
+    # raised when billboard serves a shell/paywall page instead of the full chart
+    pass
+
+
+def parse_html(html_body: bytes, chart_len: int = 100) -> ChartRows:
+    # raw response bytes are decoded by the parser itself, inside the worker process
+    tree: HTMLParser = HTMLParser(html_body, detect_encoding=False)
+    positions: list[int] = []
+    titles: list[str] = []
+    artists: list[str] = []
+    # select every row once and query each row's subtree instead of the whole document
+    for row in tree.css(ROW_SELECTOR):
+        position_tag = row.css_first(POSITION_SELECTOR)
+        title_tag = row.css_first(TITLE_SELECTOR)
+        artist_tag = row.css_first(ARTIST_SELECTOR)
+        if not (position_tag and title_tag and artist_tag):
+            continue
+
+        position: int = int(position_tag.text(strip=True))
+        positions.append(position)
+        artists.append(ARTIST_PATTERN.sub(" And", artist_tag.text(strip=True)))
+        titles.append(
+            title_tag.text(strip=True).replace("RE-\nENTRY", "").replace("NEW", "")
+        )
+
+        if position == chart_len or len(positions) == chart_len:
+            break
+    else:
+        # shell pages only render the first few rows of the chart
+        raise ShellPageError("shell html served")
+
+    return positions, titles, artists
@@ -0,0 +1,125 @@
+from datetime import date, datetime
+from pathlib import Path
+from typing import IO, AsyncIterable, Iterable, Iterator, Optional
+import json
+import os
+
+
+class RunJournal:
+    # append-only json lines log of one fetch run
+    #   first line: {"event": "run", "run_id": ..., "charts": [...], "argv": [...]}
+    #   then one {"event": <state>, "chart": ..., "date": "YYYY-MM-DD"} line per state change
+    #   {"event": "planned_all"} once the whole plan is on disk, {"event": "finished"} at the end
+    def __init__(
+        self, path: Path, run_id: str, chart_names: list[str], argv: list[str]
+    ):
+        self.path: Path = path
+        self.run_id: str = run_id
+        self.chart_names: list[str] = chart_names
+        self.argv: list[str] = argv
+        self.file: Optional[IO[str]] = None
+
+    @classmethod
+    def create(
+        cls, root: str | Path, chart_names: list[str], argv: list[str]
+    ) -> "RunJournal":
+        # the random suffix keeps runs started in the same second, on any host sharing the
+        # journal directory, from claiming the same file
+        run_id: str = (
+            f"run-{datetime.now().strftime('%Y%m%dT%H%M%S')}-{os.urandom(3).hex()}"
+        )
+        path: Path = Path(root) / f"{run_id}.jsonl"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        journal: RunJournal = cls(path, run_id, chart_names, argv)
+        journal.file = open(path, "x", encoding="utf-8")
+        journal.write(
+            {"event": "run", "run_id": run_id, "charts": chart_names, "argv": argv}
+        )
+        return journal
+
+    @classmethod
+    def load(cls, root: str | Path, run_id: str) -> "RunJournal":
+        path: Path = Path(root) / f"{run_id}.jsonl"
+        with open(path, encoding="utf-8") as f:
+            header: dict = json.loads(f.readline())
+        journal: RunJournal = cls(path, run_id, header["charts"], header["argv"])
+        journal.file = open(path, "a", encoding="utf-8")
+        # terminate a line torn by a crash before appending
+        if path.read_bytes()[-1:] != b"\n":
+            journal.file.write("\n")
+        return journal
+
+    def write(self, record: dict, sync: bool = False):
+        self.file.write(json.dumps(record) + "\n")
+        # flushed lines survive the process dying, fsync also survives the machine dying
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+
+    def mark(
+        self, state: str, chart_name: str, dates: Iterable[date], sync: bool = False
+    ):
+        for date_ in dates:
+            self.file.write(
+                json.dumps(
+                    {
+                        "event": state,
+                        "chart": chart_name,
+                        "date": date_.strftime("%Y-%m-%d"),
+                    }
+                )
+                + "\n"
+            )
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+
+    async def plan(self, plans: dict[str, AsyncIterable[date]]):
+        # the full plan is persisted before any work starts so a resume never re-plans
+        for chart_name, dates in plans.items():
+            self.mark("planned", chart_name, [date_ async for date_ in dates])
+        self.write({"event": "planned_all"}, sync=True)
+
+    def finish(self):
+        self.write({"event": "finished"}, sync=True)
+        self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def events(self) -> Iterator[dict]:
+        with open(self.path, encoding="utf-8") as f:
+            next(f)  # skip header
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:  # line torn by a crash
+                    continue
+
+    def unfinished(self) -> dict[str, Iterator[date]]:
+        # returns every planned date that was never written per chart, streaming the plan from disk
+        written: set[tuple[str, str]] = set()
+        planned_all: bool = False
+        for event in self.events():
+            if event["event"] == "written":
+                written.add((event["chart"], event["date"]))
+            elif event["event"] == "planned_all":
+                planned_all = True
+        if not planned_all:
+            raise Exception(
+                f"run {self.run_id} was interrupted while planning, start a new run instead"
+            )
+        return {name: self._remaining(name, written) for name in self.chart_names}
+
+    def _remaining(
+        self, chart_name: str, written: set[tuple[str, str]]
+    ) -> Iterator[date]:
+        for event in self.events():
+            if (
+                event["event"] == "planned"
+                and event["chart"] == chart_name
+                and (chart_name, event["date"]) not in written
+            ):
+                yield datetime.strptime(event["date"], "%Y-%m-%d").date()
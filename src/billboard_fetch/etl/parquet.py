@@ -0,0 +1,216 @@
+from billboard_fetch.database import (
+    Chart,
+    ChartRecord,
+    DeltaEncoder,
+    Song,
+    chart_entries,
+    get_engine,
+    query_cache,
+)
+from billboard_fetch.database.write import async_upsert_batch
+from pathlib import Path
+from sqlalchemy import Executable, select
+from typing import Optional
+from uuid import uuid4
+import asyncio
+import os
+import polars as pl
+import time
+
+# chart rows as columnar files, partitioned hive style into one directory per chart and year
+#   <dir>/chart_name=hot-100/year=1999/*.parquet
+# so any parquet reader gets the chart name and year back as columns and can skip the
+# directories a query does not touch
+
+# one row per chart entry, the layout of an export once its partitions are read back
+EXPORT_SCHEMA: dict[str, pl.DataType] = {
+    "chart_name": pl.String(),
+    "date": pl.Date(),
+    "position": pl.Int16(),
+    "title": pl.String(),
+    "artist_credit": pl.String(),
+}
+PARTITION_COLUMNS: list[str] = ["chart_name", "year"]
+
+# rows fetched per round trip while exporting, charts written per batch while importing
+EXPORT_CHUNK: int = 50_000
+IMPORT_BATCH: int = 100
+
+
+def scan_export(path: Path) -> pl.LazyFrame:
+    # reads the root of an export, or a single file holding a chart_name column
+    #   weeks written more than once over, e.g. by the sink and a rerun, keep one row per position
+    if not (path.is_file() or any(path.rglob("*.parquet"))):
+        raise Exception(f"no parquet files found under {path}")
+    return (
+        pl.scan_parquet(path)
+        .select(list(EXPORT_SCHEMA))
+        .cast(EXPORT_SCHEMA)
+        .unique(subset=["chart_name", "date", "position"], keep="any")
+    )
+
+
+def records_frame(records: list[ChartRecord]) -> pl.DataFrame:
+    return pl.DataFrame(
+        {
+            "chart_name": [r.chart_name for r in records for _ in r.positions],
+            "date": [r.date for r in records for _ in r.positions],
+            "position": [p for r in records for p in r.positions],
+            "title": [t for r in records for t in r.titles],
+            "artist_credit": [a for r in records for a in r.artists],
+        },
+        schema=EXPORT_SCHEMA,
+    )
+
+
+def write_partition(
+    directory: Path, chart_name: str, year: int, frame: pl.DataFrame, replace: bool
+):
+    # writes one file into the partition, renamed into place so readers never see half a file
+    #   replace removes the files already there, appending leaves them
+    partition: Path = directory / f"chart_name={chart_name}" / f"year={year}"
+    partition.mkdir(parents=True, exist_ok=True)
+    stale: list[Path] = list(partition.glob("*.parquet")) if replace else []
+    name: str = f"part-{uuid4().hex}.parquet"
+    frame.drop(PARTITION_COLUMNS, strict=False).write_parquet(
+        partition / f".{name}", compression="zstd"
+    )
+    os.replace(partition / f".{name}", partition / name)
+    for path in stale:
+        path.unlink()
+
+
+def append_partitions(directory: Path, frame: pl.DataFrame):
+    for (chart_name, year), part in (
+        frame.with_columns(year=pl.col("date").dt.year())
+        .partition_by(PARTITION_COLUMNS, as_dict=True, maintain_order=True)
+        .items()
+    ):
+        write_partition(directory, chart_name, year, part, replace=False)
+
+
+class ParquetSink:
+    # writes the pipeline's charts to parquet files under directory instead of the database,
+    # every batch appends a file to each chart and year it holds
+    name: str = "parquet"
+
+    def __init__(self, directory: Path):
+        self.directory: Path = directory
+
+    async def __call__(
+        self, batch: list[ChartRecord], in_transaction: Optional[Executable] = None
+    ) -> list[ChartRecord]:
+        written: list[ChartRecord] = list(batch)
+        # compressed and written off the event loop, the scrapers keep going meanwhile
+        await asyncio.to_thread(append_partitions, self.directory, records_frame(batch))
+        if in_transaction is not None:
+            # e.g. completing --work jobs, only once the files exist
+            async with get_engine().begin() as conn:
+                await conn.execute(in_transaction)
+        batch.clear()  # clear buffer
+        return written
+
+
+async def export_parquet(directory: Path, chart_names: Optional[list[str]] = None):
+    # writes every stored chart, or only those of chart_names, as one file per chart and year,
+    # replacing what the partitions held before
+    start_time: float = time.perf_counter()
+    stmt = (
+        select(
+            Chart.chart_name,
+            Chart.date,
+            chart_entries.c.position,
+            Song.title,
+            Song.artist_credit,
+        )
+        .join(chart_entries, chart_entries.c.chart_id == Chart.id)
+        .join(Song, Song.id == chart_entries.c.song_id)
+        .order_by(Chart.chart_name, Chart.date, chart_entries.c.position)
+    )
+    if chart_names:
+        stmt = stmt.where(Chart.chart_name.in_(chart_names))
+    # rows arrive ordered by chart and date so a partition is complete once the next begins,
+    # only the rows of one partition are held at a time
+    key: Optional[tuple[str, int]] = None
+    pending: list[pl.DataFrame] = []
+    num_rows: int = 0
+    num_partitions: int = 0
+
+    def flush():
+        nonlocal num_partitions
+        if pending:
+            write_partition(directory, *key, pl.concat(pending), replace=True)
+            pending.clear()
+            num_partitions += 1
+
+    async with get_engine().connect() as conn:
+        result = await conn.stream(stmt.execution_options(yield_per=EXPORT_CHUNK))
+        async for rows in result.partitions():
+            chunk: pl.DataFrame = pl.DataFrame(
+                rows, schema=EXPORT_SCHEMA, orient="row"
+            ).with_columns(year=pl.col("date").dt.year())
+            num_rows += len(chunk)
+            for part_key, part in chunk.partition_by(
+                PARTITION_COLUMNS, as_dict=True, maintain_order=True
+            ).items():
+                if part_key != key:
+                    flush()
+                    key = part_key
+                pending.append(part)
+    flush()
+    print(
+        f"{num_rows} rows exported to {num_partitions} partitions under {directory} "
+        f"in {round(time.perf_counter() - start_time, 3)} seconds"
+    )
+
+
+async def import_parquet(directory: Path, storage: str = "full"):
+    # loads an export into the database with the upsert loader, weeks already stored with
+    # the same content are skipped so an import can be rerun or resumed
+    start_time: float = time.perf_counter()
+    deltas: Optional[DeltaEncoder] = DeltaEncoder() if storage == "delta" else None
+    export: pl.LazyFrame = scan_export(directory)
+    partitions: pl.DataFrame = (
+        export.select("chart_name", year=pl.col("date").dt.year())
+        .unique()
+        .sort(PARTITION_COLUMNS)
+        .collect(engine="streaming")
+    )
+    num_charts: int = 0
+    num_written: int = 0
+    num_rows: int = 0
+    # one chart and year in memory at a time, the filter skips the other partitions' files
+    for chart_name, year in partitions.iter_rows():
+        frame: pl.DataFrame = (
+            export.filter(
+                pl.col("chart_name") == chart_name, pl.col("date").dt.year() == year
+            )
+            .sort("date", "position")
+            .collect(engine="streaming")
+        )
+        records: list[ChartRecord] = [
+            ChartRecord(
+                chart_name,
+                date_,
+                week["position"].to_list(),
+                week["title"].to_list(),
+                week["artist_credit"].to_list(),
+            )
+            for (date_,), week in frame.partition_by(
+                "date", as_dict=True, maintain_order=True
+            ).items()
+        ]
+        num_charts += len(records)
+        for i in range(0, len(records), IMPORT_BATCH):
+            written: list[ChartRecord] = await async_upsert_batch(
+                records[i : i + IMPORT_BATCH], deltas=deltas
+            )
+            num_written += len(written)
+            if written:
+                query_cache.invalidate()
+            num_rows += sum(len(record) for record in written)
+    print(
+        f"{num_charts} charts imported from {directory} in "
+        f"{round(time.perf_counter() - start_time, 3)} seconds, {num_written} written "
+        f"({num_rows} rows), {num_charts - num_written} already stored unchanged"
+    )
@@ -1,152 +1,340 @@
-# from pathlib import Path
-
-# pl.Config.set_tbl_cols(200)
-# pl.Config.set_tbl_rows(100)
-# pl.Config.set_tbl_width_chars(-1)
-# pl.Config.set_tbl_formatting(format="UTF8_FULL")
-# # if i mistakenly seperate a band name, they should have the exact same artist score and amount of chart entries
-# # total points for a song should be distributed evenly among all artists on a track
-
-
-# def load_data(load_path):
-#     return (
-#         pl.scan_parquet(
-#             source=load_path,
-#             schema={
-#                 "position": pl.UInt8,
-#                 "date": pl.Date,
-#                 "song": pl.String,
-#                 "artist": pl.String,
-#             },
-#         )
-#         .sort(by="date")
-#         .with_row_index("id")
-#         .select(["id", "date", "position", "song", "artist"])
-#     )
-
-
-# def create_table_song(lf) -> pl.LazyFrame:
-#     # score_calcs: dict =  {
-#     #     "pos_weighted": (1 / pl.col("position")).sum,
-#     #     "longevity_weighted": (101 - pl.col("position")).truediv(100).sum,
-#     #     "unweighted": (pl.lit(100).log1p() - pl.col("position").log1p()).sum,
-#     # }
-#     decade_cuts: range = range(1970, 2030, 10)
-#     decade_labels = [f"{decade}s" for decade in range(1960, 2030, 10)]
-#     return (
-#         lf.group_by(["song", "artist"])
-#         .agg(
-#             # position_score=score_calcs["pos_weighted"](),
-#             # longevity_score=score_calcs["longevity_weighted"](),
-#             # overall_score=score_calcs["unweighted"](),
-#             debut=pl.min("date"),
-#         )
-#         .sort(by="debut")
-#         .with_row_index("id")
-#         .with_columns(
-#             decade=(
-#                 pl.col("debut")
-#                 .dt.year()
-#                 .cut(breaks=decade_cuts, labels=decade_labels, left_closed=True)
-#             )
-#         )
-#         .reverse()
-#         .select(["id", "song", "artist", "debut", "decade", "hash_id"])
-#     )
-
-
-# def handle_edge_cases(col: pl.Expr) -> pl.Expr:
-#     edge_pat_1 = r"(?i)(\sa\s)?(duet\swith)"
-#     # matches any occurance of "duet with" (case insensitive)
-#     edge_pat_2 = r"(?i)\((feat\.*[a-z]*|&|with)(.*?)\)(.*$)"
-#     # matches any occurance of an opening parenthese immediately followed by a first class seperator (DEFINE CONST) or "&"
-#     # edge_pat_3: str = r"(?i)&\s(the|his|her|original|co\.)(.*$)"
-#     # matches any occurance of "& " followed by the, his, her, or original; captures the previous word and the rest of the string
-#     return (
-#         col.str.replace(edge_pat_1, "&").str.replace(edge_pat_2, r"$1$2$3")
-#         # .str.replace(edge_pat_3, r"and $1$2")
-#     )
-
-
-# def simple_str_clean(col: pl.Expr) -> pl.Expr:
-#     sep_pattern: str = r"(?i)\sfeat\.*[a-z]*\s|\swith\s|\s*[&/+,]\s*|\sx\s|\sand\s"
-
-#     return col.str.replace_all(sep_pattern, "--").str.split("--")
-
-
-# def first_and_second_class_insert(artist_col: pl.Expr) -> pl.Expr:
-#     split_pattern: str = r"(?i)\sfeat\.*[a-z]*\s|\swith\s"
-#     sep_pattern: str = r"\s*[&/+,]\s*|\s[xX]\s"
-
-#     return (
-#         artist_col.str.replace_all(split_pattern, "!-!")
-#         .str.split("!-!")
-#         .list.eval(
-#             pl.element()
-#             .str.strip_chars()
-#             .str.replace_all(sep_pattern, "!-!")
-#             .str.split("!-!")
-#             .list.sort()
-#             .list.join("!-!")
-#         )
-#         .list.sort()
-#         .list.join("!~!")
-#     )
-
-
-# def first_class_split(col: pl.Expr) -> pl.Expr:
-#     return (
-#         col.str.split_exact("!~!", n=1)
-#         .struct.rename_fields(["main", "featuring"])
-#         .struct.unnest()
-#     )
-
-
-# def second_class_split(col: pl.Expr) -> pl.Expr:
-#     return col.str.split("!-!").list.eval(pl.element().str.strip_chars())
-
-
-# def clean_base_table(lf) -> pl.LazyFrame:
-#     return (
-#         lf.with_columns(
-#             artists=pl.col("artist").pipe(handle_edge_cases).pipe(simple_str_clean),
-#         )
-#         .unique(subset=["date", "position"])
-#         .select(["date", "position", "song", "artists"])
-#         .sort(by="date", descending=True)
-#     )
-
-
-# def derive_song_base(lf) -> pl.LazyFrame:
-#     return (
-#         lf.group_by(["song", "artists"])
-#         .agg(debut=pl.min("date"))
-#         .sort(by="debut")
-#         .with_row_index(name="id")
-#         .select(id="id", title="song", artists="artists")
-#     )
-
-
-# def derive_artist_base(lf) -> pl.LazyFrame:
-#     unnested = lf.explode("artists")
-#     return (
-#         unnested.group_by("artists", maintain_order=True)
-#         .agg(id_songs=pl.col("id"), art_debut=pl.min("debut"))
-#         .group_by("id_songs")
-#         .agg(
-#             name_parts=pl.col("artists"),
-#             name_str=pl.col("artists").str.concat(" and "),
-#             art_debut=pl.col("art_debut").any_value(),
-#         )
-#     )
-
-
-# def transform(load_path) -> pl.DataFrame:
-#     base_table: pl.LazyFrame = load_data(load_path)
-#     return base_table.pipe(clean_base_table).collect()
-
-
-# # if __name__ == "__main__":
-# #     _DIR: Path = Path(__file__).parent.parent
-# #     path = ROOT_DIR / "data" / "raw_data" / "raw-data_06-22.parquet"
-# #     tbls_dict = transform(load_path=path)
+from billboard_fetch.configs import CHARTS
+from billboard_fetch.database import (
+    ArtistScore,
+    Chart,
+    SongArtist,
+    SongScore,
+    TransformedChart,
+    chart_entries,
+    get_engine,
+)
+from billboard_fetch.database.dimensions import resolve_songs
+from .parquet import scan_export
+from pathlib import Path
+from sqlalchemy import (
+    Column,
+    Integer,
+    MetaData,
+    Select,
+    String,
+    Table,
+    delete,
+    exists,
+    insert,
+    or_,
+    select,
+    tuple_,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncConnection
+from tempfile import TemporaryDirectory
+from typing import Optional
+import polars as pl
+import time
+
+# derives the song_scores and artist_scores tables from the stored charts
+#   rows leave the database in chunks that are spilled to parquet files, every step after
+#   that is a lazy polars plan run by the streaming engine, so the raw rows are never held
+#   in memory all at once
+
+# rows fetched per round trip while streaming out of the database, one parquet file each
+STREAM_CHUNK: int = 50_000
+
+# score columns shared by both derived tables
+SCORE_COLUMNS: list[str] = ["position_score", "longevity_score", "overall_score"]
+
+ENTRY_SCHEMA: dict[str, pl.DataType] = {
+    "song_id": pl.Int64(),
+    "chart_name": pl.String(),
+    "date": pl.Date(),
+    "position": pl.Int16(),
+}
+CREDIT_SCHEMA: dict[str, pl.DataType] = {"song_id": pl.Int64(), "artist_id": pl.Int64()}
+SONG_SCORE_SCHEMA: dict[str, pl.DataType] = {
+    "song_id": pl.Int64(),
+    "chart_name": pl.String(),
+    "debut": pl.Date(),
+    "weeks": pl.Int64(),
+    **{column: pl.Float64() for column in SCORE_COLUMNS},
+}
+
+CHART_LENGTHS: dict[str, int] = {chart.name: chart.length for chart in CHARTS}
+
+# (song id, chart name) of the scores an incremental or parquet transform replaces,
+# gone when it commits
+scope_table: Table = Table(
+    "transform_scope",
+    MetaData(),
+    Column("song_id", Integer, primary_key=True),
+    Column("chart_name", String, primary_key=True),
+    prefixes=["TEMPORARY"],
+    postgresql_on_commit="DROP",
+)
+
+
+def score_songs(entries: pl.LazyFrame) -> pl.LazyFrame:
+    # scores every song on every chart it entered, charts missing from CHARTS are as long
+    # as the lowest position seen on them
+    length: pl.Expr = (
+        pl.col("chart_name")
+        .replace_strict(CHART_LENGTHS, default=None, return_dtype=pl.Float64)
+        .fill_null(pl.col("position").max().over("chart_name").cast(pl.Float64))
+    )
+    position: pl.Expr = pl.col("position").cast(pl.Float64)
+    return (
+        entries.with_columns(length=length)
+        .group_by("song_id", "chart_name")
+        .agg(
+            debut=pl.min("date"),
+            weeks=pl.len().cast(pl.Int64),
+            position_score=(1 / position).sum(),
+            longevity_score=(
+                (pl.col("length") + 1 - position) / pl.col("length")
+            ).sum(),
+            overall_score=(pl.col("length").log1p() - position.log1p()).sum(),
+        )
+        .select(list(SONG_SCORE_SCHEMA))
+    )
+
+
+def score_artists(songs: pl.LazyFrame, credits: pl.LazyFrame) -> pl.LazyFrame:
+    # the scores of a song are split evenly among every artist of its credit, so a band
+    # name split by mistake still leaves each half the same scores and weeks
+    shares: pl.LazyFrame = credits.with_columns(
+        share=1 / pl.col("artist_id").count().over("song_id")
+    )
+    return (
+        songs.join(shares, on="song_id")
+        .group_by("artist_id", "chart_name")
+        .agg(
+            debut=pl.min("debut"),
+            songs=pl.len().cast(pl.Int64),
+            weeks=pl.sum("weeks"),
+            **{c: (pl.col(c) * pl.col("share")).sum() for c in SCORE_COLUMNS},
+        )
+    )
+
+
+async def spill(
+    conn: AsyncConnection,
+    stmt: Select,
+    schema: dict[str, pl.DataType],
+    directory: Path,
+    name: str,
+) -> pl.LazyFrame:
+    # streams the rows of stmt chunk by chunk into parquet files and scans them back lazily
+    num_files: int = 0
+    result = await conn.stream(stmt.execution_options(yield_per=STREAM_CHUNK))
+    async for rows in result.partitions():
+        pl.DataFrame(rows, schema=schema, orient="row").write_parquet(
+            directory / f"{name}-{num_files}.parquet"
+        )
+        num_files += 1
+    if not num_files:  # a scan needs at least one file
+        pl.DataFrame(schema=schema).write_parquet(directory / f"{name}-0.parquet")
+    return pl.scan_parquet(directory / f"{name}-*.parquet")
+
+
+async def copy_frame(conn: AsyncConnection, table: Table, frame: pl.DataFrame):
+    # bulk loads the frame through COPY on the connection's transaction
+    raw_conn = await conn.get_raw_connection()
+    columns: str = ", ".join(frame.columns)
+    async with raw_conn.driver_connection.cursor() as cur:
+        async with cur.copy(
+            f"COPY {table.name} ({columns}) FROM STDIN (FORMAT csv)"
+        ) as copy:
+            for chunk in frame.iter_slices(STREAM_CHUNK):
+                await copy.write(chunk.write_csv(include_header=False))
+
+
+async def resolve_export(export: pl.LazyFrame) -> pl.DataFrame:
+    # the song id of every (title, credit) in the export, songs new to the database are created
+    keys: pl.DataFrame = (
+        export.select("title", "artist_credit").unique().collect(engine="streaming")
+    )
+    # committed on its own before the scores, like the writer's interning
+    async with get_engine().begin() as conn:
+        ids, _ = await resolve_songs(conn, sorted(keys.iter_rows()))
+    return pl.DataFrame(
+        [(title, credit, id_) for (title, credit), id_ in ids.items()],
+        schema={"title": pl.String, "artist_credit": pl.String, "song_id": pl.Int64},
+        orient="row",
+    )
+
+
+def replaced_charts() -> Select:
+    # charts transformed before that were deleted since or rewritten with different content
+    return (
+        select(TransformedChart.chart_id)
+        .outerjoin(Chart, Chart.id == TransformedChart.chart_id)
+        .where(
+            or_(
+                Chart.id.is_(None),
+                Chart.content_hash.is_distinct_from(TransformedChart.content_hash),
+            )
+        )
+    )
+
+
+async def derive_scores(
+    conn: AsyncConnection,
+    directory: Path,
+    full: bool,
+    export: Optional[pl.LazyFrame],
+    export_ids: Optional[pl.DataFrame],
+) -> Optional[tuple[int, int]]:
+    # returns the number of song and artist scores written, None when nothing changed
+    scope = None  # every song on every chart unless the transform is scoped
+    if not full:
+        await conn.run_sync(scope_table.create)
+        scope = select(scope_table.c.song_id, scope_table.c.chart_name)
+        if export is None:
+            # songs of charts added since the last run, runs after charts were replaced are full
+            changed = (
+                select(Chart.id)
+                .outerjoin(TransformedChart, TransformedChart.chart_id == Chart.id)
+                .where(TransformedChart.chart_id.is_(None))
+            )
+            await conn.execute(
+                insert(scope_table).from_select(
+                    ["song_id", "chart_name"],
+                    select(chart_entries.c.song_id, Chart.chart_name)
+                    .distinct()
+                    .join(Chart, Chart.id == chart_entries.c.chart_id)
+                    .where(Chart.id.in_(changed)),
+                )
+            )
+        else:
+            # the songs' scores on charts missing from the export are left as they are
+            export = export.join(export_ids.lazy(), on=["title", "artist_credit"])
+            await copy_frame(
+                conn,
+                scope_table,
+                export.select("song_id", "chart_name")
+                .unique()
+                .collect(engine="streaming"),
+            )
+        if not await conn.scalar(select(exists().select_from(scope_table))):
+            return None
+
+    # song scores, every week of every song in scope is scored again
+    if export is None:
+        stmt = select(
+            chart_entries.c.song_id,
+            Chart.chart_name,
+            Chart.date,
+            chart_entries.c.position,
+        ).join(Chart, Chart.id == chart_entries.c.chart_id)
+        if scope is not None:
+            stmt = stmt.where(
+                tuple_(chart_entries.c.song_id, Chart.chart_name).in_(scope)
+            )
+        entries: pl.LazyFrame = await spill(
+            conn, stmt, ENTRY_SCHEMA, directory, "entries"
+        )
+    else:
+        entries = export.select(list(ENTRY_SCHEMA))
+    songs: pl.DataFrame = score_songs(entries).collect(engine="streaming")
+    stmt = delete(SongScore)
+    if scope is not None:
+        stmt = stmt.where(tuple_(SongScore.song_id, SongScore.chart_name).in_(scope))
+    await conn.execute(stmt)
+    await copy_frame(conn, SongScore.__table__, songs)
+
+    # artist scores, every artist of a song in scope is scored again from all of its songs
+    artist_ids = select(SongArtist.artist_id)
+    credit_stmt = select(SongArtist.song_id, SongArtist.artist_id)
+    score_stmt = select(*(SongScore.__table__.c[c] for c in SONG_SCORE_SCHEMA))
+    if scope is not None:
+        artist_ids = artist_ids.where(
+            SongArtist.song_id.in_(select(scope_table.c.song_id))
+        )
+        their_songs = select(SongArtist.song_id).where(
+            SongArtist.artist_id.in_(artist_ids)
+        )
+        # every credit of their songs is needed to split the songs' scores
+        credit_stmt = credit_stmt.where(SongArtist.song_id.in_(their_songs))
+        score_stmt = score_stmt.where(SongScore.song_id.in_(their_songs))
+    credits: pl.LazyFrame = await spill(
+        conn, credit_stmt, CREDIT_SCHEMA, directory, "credits"
+    )
+    artist_scores: pl.LazyFrame = score_artists(
+        await spill(conn, score_stmt, SONG_SCORE_SCHEMA, directory, "songs"), credits
+    )
+    stmt = delete(ArtistScore)
+    if scope is not None:
+        # co-artists outside the scope only appear in credits to count the shares
+        scoped: pl.LazyFrame = await spill(
+            conn,
+            artist_ids.distinct(),
+            {"artist_id": pl.Int64()},
+            directory,
+            "artists",
+        )
+        artist_scores = artist_scores.join(scoped, on="artist_id", how="semi")
+        stmt = stmt.where(ArtistScore.artist_id.in_(artist_ids))
+    artists: pl.DataFrame = artist_scores.collect(engine="streaming")
+    await conn.execute(stmt)
+    await copy_frame(conn, ArtistScore.__table__, artists)
+    return len(songs), len(artists)
+
+
+async def mark_transformed(conn: AsyncConnection):
+    # records the content of every chart the scores now reflect
+    await conn.execute(
+        delete(TransformedChart).where(
+            ~exists().where(Chart.id == TransformedChart.chart_id)
+        )
+    )
+    stmt = pg_insert(TransformedChart).from_select(
+        ["chart_id", "content_hash"], select(Chart.id, Chart.content_hash)
+    )
+    await conn.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[TransformedChart.chart_id],
+            set_={"content_hash": stmt.excluded.content_hash},
+            where=TransformedChart.content_hash.is_distinct_from(
+                stmt.excluded.content_hash
+            ),
+        )
+    )
+
+
+async def run_transform(full: bool = False, parquet: Optional[Path] = None):
+    # incremental unless full, only songs of charts added since the last run are scored
+    # again, a parquet export replaces the scores of the songs it holds
+    start_time: float = time.perf_counter()
+    export: Optional[pl.LazyFrame] = None
+    export_ids: Optional[pl.DataFrame] = None
+    if parquet is not None:
+        export = scan_export(parquet)
+        # resolved before the snapshot below is taken so the new songs are visible in it
+        export_ids = await resolve_export(export)
+        full = False
+    async with get_engine().connect() as conn:
+        # one snapshot for the whole run, the artist scores are split from exactly the song
+        # scores it wrote and the charts it marks are the charts it read
+        await conn.execution_options(isolation_level="REPEATABLE READ")
+        async with conn.begin():
+            if export is None and not full:
+                # the first run has nothing to be incremental to, and the songs that left a
+                # rewritten or deleted chart are no longer in its entries to be scoped, so
+                # either one scores every song again
+                full = not await conn.scalar(
+                    select(exists().select_from(TransformedChart))
+                ) or await conn.scalar(select(exists(replaced_charts())))
+            with TemporaryDirectory(prefix="billboard-transform-") as directory:
+                written: Optional[tuple[int, int]] = await derive_scores(
+                    conn, Path(directory), full, export, export_ids
+                )
+            if export is None:
+                await mark_transformed(conn)
+    if written is None:
+        print("no charts added or changed since the last transform")
+        return
+    mode: str = "full" if full else "incremental" if export is None else str(parquet)
+    num_songs, num_artists = written
+    print(
+        f"{num_songs} song scores and {num_artists} artist scores written in "
+        f"{round(time.perf_counter() - start_time, 3)} seconds ({mode})"
+    )
@@ -1,11 +1,125 @@
-import asyncio
-from billboard_fetch.utils import create_parser, handle_args
-from billboard_fetch.etl import extract
+import sys
+from argparse import ArgumentParser, Namespace
+from pathlib import Path
+from billboard_fetch.configs import JOURNAL_DIR
+from billboard_fetch.utils import create_parser, parse_flags
+
+
+def fetch_options(args: Namespace) -> dict:
+    # pipeline tuning shared by planned runs and --work nodes
+    return dict(
+        loader=args.loader,
+        reparse=args.reparse,
+        refresh=args.refresh,
+        max_concurrency=args.max_concurrency,
+        max_rate=args.max_rate,
+        fetch_queue_size=args.fetch_queue_size,
+        write_queue_size=args.write_queue_size,
+        metrics_path=args.metrics,
+        sink=args.sink,
+        parquet_dir=args.parquet_dir,
+        writers=args.writers,
+        flush_age=args.flush_age,
+        storage=args.storage,
+    )
+
+
+async def run_command(parser: ArgumentParser, args: Namespace):
+    # the database, http and parsing stack is only imported once the arguments are valid
+    from billboard_fetch.database import (
+        JobQueue,
+        dispose_engine,
+        init_schema,
+        size_pool,
+    )
+    from billboard_fetch.etl import RunJournal, extract
+    from billboard_fetch.utils import plan_chart
+
+    try:
+        # the journal's argv has no --resume, remember it before args is replaced
+        resumed: bool = args.resume is not None
+        if resumed:
+            # the original run's arguments and remaining plan come from its journal
+            journal = RunJournal.load(JOURNAL_DIR, args.resume)
+            args = parse_flags(parser, journal.argv)
+        size_pool(args.writers)
+        await init_schema()
+        if args.transform:
+            # polars is only loaded by the transform
+            from billboard_fetch.etl import run_transform
+
+            await run_transform(full=args.full, parquet=args.from_parquet)
+            return
+        if args.export:
+            from billboard_fetch.etl import export_parquet
+
+            await export_parquet(
+                Path(args.parquet_dir), [chart.name for chart in args.chart or []]
+            )
+            return
+        if args.import_:
+            from billboard_fetch.etl import import_parquet
+
+            await import_parquet(Path(args.parquet_dir), args.storage)
+            return
+        if args.query:
+            from billboard_fetch.database.query import run_query
+
+            await run_query(
+                args.query,
+                [chart.name for chart in args.chart or []],
+                args.week,
+                args.start,
+                args.end,
+                args.artist,
+                args.song,
+                args.limit,
+                args.after,
+            )
+            return
+        if args.search:
+            from billboard_fetch.database.search import run_search
+
+            await run_search(
+                args.search,
+                args.song if args.search == "song" else args.artist,
+                args.limit,
+            )
+            return
+        if args.work:
+            # the plan lives in the shared jobs table, this node only claims and fetches from it
+            await extract([], None, jobs=JobQueue(args.lease), **fetch_options(args))
+            return
+        if not resumed:
+            # every chart gets its own date plan
+            plans = {
+                chart.name: await plan_chart(parser, args, chart)
+                for chart in args.chart
+            }
+            if args.enqueue:
+                num_jobs: int = await JobQueue(args.lease).enqueue(plans)
+                print(f"{num_jobs} chart weeks queued, fetch them with --work")
+                return
+            journal = RunJournal.create(
+                JOURNAL_DIR, [chart.name for chart in args.chart], sys.argv[1:]
+            )
+            await journal.plan(plans)
+        print(f"run {journal.run_id}, resume with --resume {journal.run_id}")
+        unfinished = journal.unfinished()
+        charts = {chart.name: chart for chart in args.chart}
+
+        await extract(
+            [(charts[name], unfinished[name]) for name in journal.chart_names],
+            journal,
+            **fetch_options(args),
+        )
+    finally:
+        await dispose_engine()  # close the shared connection pool
 
 
 def run():
     parser = create_parser()
-    args = parser.parse_args()
-    charts_to_fetch = handle_args(args)
+    args = parse_flags(parser)
+    import asyncio  # deferred like the rest of the stack, --help never needs an event loop
 
-    asyncio.run(extract("hot-100", charts_to_fetch))
+    asyncio.run(run_command(parser, args))
@@ -1,10 +1,49 @@
-from .helpers import (
-    calc_num_charts,
-    progress_report,
-    retry_middleware,
-)
-from .counter_class import AsyncCounter
+from importlib import import_module
+from typing import TYPE_CHECKING
 
-from .date_utils import to_saturday, date_generator
+# submodule of every name exported here, a submodule is only imported when one of its names
+# is first used so parsing arguments never loads aiohttp or sqlalchemy
+_EXPORTS: dict[str, str] = {
+    "calc_num_charts": "helpers",
+    "monitor_queues": "helpers",
+    "parse_retry_after": "helpers",
+    "progress_report": "helpers",
+    "retry_middleware": "helpers",
+    "AsyncCounter": "counter_class",
+    "AdaptiveLimiter": "limiter_class",
+    "Metrics": "metrics",
+    "timed_call": "metrics",
+    "to_saturday": "date_utils",
+    "to_weekday": "date_utils",
+    "chart_weeks": "date_utils",
+    "date_generator": "date_utils",
+    "create_parser": "cli_parser",
+    "parse_flags": "cli_parser",
+    "plan_chart": "planner",
+}
 
-from .cli_parser import create_parser, handle_args
+
+def __getattr__(name: str):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(f".{_EXPORTS[name]}", __name__), name)
+    globals()[name] = value  # later lookups skip __getattr__
+    return value
+
+
+if TYPE_CHECKING:
+    from .helpers import (
+        calc_num_charts,
+        monitor_queues,
+        parse_retry_after,
+        progress_report,
+        retry_middleware,
+    )
+    from .counter_class import AsyncCounter
+    from .limiter_class import AdaptiveLimiter
+    from .metrics import Metrics, timed_call
+
+    from .date_utils import to_saturday, to_weekday, date_generator, chart_weeks
+
+    from .cli_parser import create_parser, parse_flags
+    from .planner import plan_chart
@@ -1,18 +1,12 @@
-from billboard_fetch.utils import date_generator
-from billboard_fetch.configs import OLDEST_CHART_DATE, DB_URI, CHARTS, CHART_INFO
-from billboard_fetch.database import Chart, Base
-from sqlalchemy import create_engine, select, func
-from sqlalchemy.orm import sessionmaker
+from billboard_fetch.configs import OLDEST_CHART_DATE, CHARTS, CHART_INFO, PARQUET_DIR
 from datetime import date, datetime
 from argparse import ArgumentParser, ArgumentTypeError, Namespace
-from typing import Iterator, Optional
+from pathlib import Path
+from typing import Optional
+import os
 
-
-engine = create_engine(DB_URI)
-
-Base.metadata.create_all(engine)  # create all tables defined in models.py
-
-Session = sessionmaker(engine)
+# argument parsing only, nothing here touches the database so --help and argument
+# errors return immediately, planning against the database lives in planner.py
 
 
 def parse_name(name_arg: str) -> CHART_INFO:
@@ -74,8 +68,9 @@ def create_parser() -> ArgumentParser:
     parser.add_argument(
         "--chart",
         type=parse_name,
-        required=True,
-        help="Specifies the billboard chart to fetch. Some choices include ('hot-100' 'artist-100', 'streaming-songs'). For all valid options see CHARTS.md",
+        nargs="+",
+        required=False,
+        help="Specifies the billboard charts to fetch, several charts are fetched together in one run. Some choices include ('hot-100' 'artist-100', 'streaming-songs'). For all valid options see CHARTS.md. Required unless --resume or --work is passed",
     )
     parser.add_argument(
         "--start",
@@ -111,7 +106,194 @@ def create_parser() -> ArgumentParser:
     pattern_flag.add_argument(
         "--all",
         action="store_true",
-        help="Fetches all Chart and automatically overwrites and existing database entries",
+        help="Fetches all Chart and automatically overwrites and existing database entries. Uses the upsert loader, stored weeks whose content did not change are skipped",
+    )
+
+    pattern_flag.add_argument(
+        "--reparse",
+        action="store_true",
+        help="Rebuild the database from the local archive of previously fetched charts without going to the network. Stored charts in the optional range that have an archived page are replaced through the upsert loader, unchanged ones are skipped",
+    )
+
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Revalidate already archived weeks with billboard using conditional requests instead of reading them from the archive. Weeks billboard reports as unmodified, or that come back byte for byte the same, are neither parsed nor written. With --new the newest stored week is revalidated too. Uses the upsert loader",
+    )
+
+    parser.add_argument(
+        "--loader",
+        choices=["orm", "copy", "upsert"],
+        default="orm",
+        help="How charts are written to the database: 'orm' adds them through a session, 'copy' assigns chart ids in bulk and streams entries with postgres COPY, 'upsert' overwrites stored weeks whose content changed and skips unchanged ones. --all always uses 'upsert'",
+    )
+
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=16,
+        help="Upper bound on requests in flight; the fetcher adapts below it from response status and latency",
+    )
+
+    parser.add_argument(
+        "--max-rate",
+        type=float,
+        default=10.0,
+        help="Upper bound on requests per second shared by all workers",
+    )
+
+    parser.add_argument(
+        "--fetch-queue-size",
+        type=int,
+        default=0,
+        help="Bound on chart urls waiting to be fetched, defaults to two per worker",
+    )
+
+    parser.add_argument(
+        "--write-queue-size",
+        type=int,
+        default=200,
+        help="Bound on parsed charts waiting to be written, scrapers pause while it is full",
+    )
+
+    parser.add_argument(
+        "--writers",
+        type=int,
+        # the loaders' python work runs on the event loop, writers beyond the cores only interleave
+        default=min(4, os.cpu_count() or 1),
+        help="Number of batches written to the database at once, each through its own connection. The next batch goes to whichever writer is free, defaults to one per core up to 4",
+    )
+
+    parser.add_argument(
+        "--flush-age",
+        type=float,
+        default=2.0,
+        help="Seconds a parsed chart waits for its batch to fill before the batch is written anyway, bounds how long fetched charts take to show up in the database",
+    )
+
+    parser.add_argument(
+        "--metrics",
+        metavar="PATH",
+        help="Write the run's counters and latency histograms to PATH when it ends, as a JSON summary if PATH ends in .json and in the Prometheus text format otherwise",
+    )
+
+    pattern_flag.add_argument(
+        "--resume",
+        metavar="RUN_ID",
+        help="Resume an interrupted run, only the chart weeks it had not written yet are redone. All other arguments are taken from the original run",
+    )
+
+    pattern_flag.add_argument(
+        "--work",
+        action="store_true",
+        help="Claim chart weeks from the shared jobs table until none are left instead of planning a run. Any number of nodes can work the same database at once",
+    )
+
+    parser.add_argument(
+        "--enqueue",
+        action="store_true",
+        help="Write the planned chart weeks into the shared jobs table for --work nodes instead of fetching them. Cannot be combined with --all since the nodes never overwrite stored weeks",
+    )
+
+    parser.add_argument(
+        "--lease",
+        type=float,
+        default=300.0,
+        help="Seconds a --work node holds a claimed chart week without renewing it before other nodes may claim it. Weeks left by a node that died are picked up by nodes still working or by the next --work run",
+    )
+
+    pattern_flag.add_argument(
+        "--transform",
+        action="store_true",
+        help="Derive the song_scores and artist_scores tables from the stored charts instead of fetching. Only songs of charts added or changed since the last transform are scored again unless --full is passed",
+    )
+
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="With --transform, score every stored song again instead of only the songs of charts added or changed since the last transform",
+    )
+
+    parser.add_argument(
+        "--from-parquet",
+        metavar="PATH",
+        type=Path,
+        help="With --transform, score the chart entries of a parquet export instead of the stored charts. The scores of the songs in the export are replaced on the charts in the export and songs new to the database are added",
+    )
+
+    parser.add_argument(
+        "--sink",
+        choices=["postgres", "parquet"],
+        default="postgres",
+        help="Where fetched charts are written: 'postgres' writes them to the database with --loader, 'parquet' appends them to compressed parquet files under --parquet-dir, partitioned by chart and year",
+    )
+
+    parser.add_argument(
+        "--storage",
+        choices=["full", "delta"],
+        default="full",
+        help="How written charts are stored: 'full' writes every entry of every week, 'delta' writes a chart in full every 26 weeks and the weeks between as the songs that moved, entered or left since, several times smaller. Queries, exports and transforms read both the same way. 'delta' writes through the copy loader in place of 'orm'",
+    )
+
+    parser.add_argument(
+        "--parquet-dir",
+        metavar="PATH",
+        default=PARQUET_DIR,
+        help="Directory of the parquet files written by --sink parquet and --export and read by --import, defaults to PARQUET_DIR",
+    )
+
+    pattern_flag.add_argument(
+        "--export",
+        action="store_true",
+        help="Write the stored charts, or only those passed with --chart, to --parquet-dir as one compressed parquet file per chart and year instead of fetching. Exported partitions replace the files they held before",
+    )
+
+    pattern_flag.add_argument(
+        "--import",
+        dest="import_",
+        action="store_true",
+        help="Load the parquet files under --parquet-dir into the database instead of fetching. Uses the upsert loader, stored weeks whose content did not change are skipped",
+    )
+
+    pattern_flag.add_argument(
+        "--query",
+        choices=["chart", "artist", "song", "top", "changes"],
+        help="Read stored charts instead of fetching: 'chart' prints the --chart chart of --week, 'artist' every week --artist charted, 'song' every week of the songs titled --song, 'top' the --chart songs with the most points between --start and --end, 'changes' the songs that entered, moved or left the --chart chart of --week since the week before. Prints one page of rows, repeated queries are answered from a cache",
+    )
+
+    pattern_flag.add_argument(
+        "--search",
+        choices=["song", "artist"],
+        help="Find stored songs by a misspelt or partial --song title, or artists by --artist, instead of fetching. Prints the best matches first, spelling, accents, punctuation and featured billings are ignored",
+    )
+
+    parser.add_argument(
+        "--week",
+        type=parse_date,
+        default="TODAY",
+        help="With --query chart and changes, the chart published on or before this date, defaults to the newest chart",
+    )
+
+    parser.add_argument(
+        "--artist",
+        help="With --query artist, the artist as billboard bills them, e.g. one name of a credit. With --query song, only the song billed with exactly this credit. With --search artist, the name to look for",
+    )
+
+    parser.add_argument(
+        "--song",
+        help="With --query song, the title of the song. With --search song, the title to look for",
+    )
+
+    parser.add_argument(
+        "--limit",
+        type=int,
+        help="With --query, rows per page. Defaults to 200 for chart and changes, 100 for artist and song, and 10 for top. With --search, the number of matches, defaults to 10",
+    )
+
+    parser.add_argument(
+        "--after",
+        metavar="CURSOR",
+        help="With --query, continue after the page that printed this cursor",
     )
 
     pattern_flag.add_argument(
@@ -129,13 +311,90 @@ def create_parser() -> ArgumentParser:
     return parser
 
 
-def parse_flags(parser: ArgumentParser) -> tuple[CHART_INFO, Iterator[date]]:
-    try:
-        args: Namespace = parser.parse_args()
+def parse_flags(parser: ArgumentParser, argv: Optional[list[str]] = None) -> Namespace:
+    args: Namespace = parser.parse_args(argv)
+
+    if (
+        args.work and args.refresh
+    ):  # unmodified weeks are only tracked by a local journal
+        raise parser.error(message="--refresh cannot be combined with --work")
+
+    if (args.full or args.from_parquet) and not args.transform:
+        raise parser.error(message="--full and --from-parquet require --transform")
+
+    if args.full and args.from_parquet:  # an export only replaces the songs it holds
+        raise parser.error(message="--full cannot be combined with --from-parquet")
+
+    if (args.song or args.artist or args.limit) and not (args.query or args.search):
+        raise parser.error(
+            message="--artist, --song and --limit require --query or --search"
+        )
+
+    if args.after and not args.query:
+        raise parser.error(message="--after requires --query")
+
+    if args.query in ("chart", "top", "changes") and (
+        args.chart is None or len(args.chart) > 1
+    ):
+        raise parser.error(message=f"--query {args.query} requires a single --chart")
+
+    if args.query == "artist" and not args.artist:
+        raise parser.error(message="--query artist requires --artist")
 
-        if args.single:  # --single takes precedence, immediately propagate target date
-            return args.chart, date_generator(args.single, args.single)
+    if args.query == "song" and not args.song:
+        raise parser.error(message="--query song requires --song")
 
+    if args.search == "artist" and not args.artist:
+        raise parser.error(message="--search artist requires --artist")
+
+    if args.search == "song" and not args.song:
+        raise parser.error(message="--search song requires --song")
+
+    if args.storage == "delta" and args.sink != "postgres":
+        raise parser.error(message="--storage delta requires --sink postgres")
+
+    if args.import_:  # an import overwrites stored weeks like --all
+        args.loader = "upsert"
+
+    if (
+        args.resume
+        or args.work
+        or args.transform
+        or args.export
+        or args.import_
+        or args.query
+        or args.search
+    ):
+        # the plan comes from a journal or the jobs table, the other commands need no plan
+        return args
+
+    if args.chart is None:
+        raise parser.error(
+            message="--chart is required unless --resume or --work is passed"
+        )
+
+    if args.enqueue and args.reparse:  # reparsing never leaves the local archive
+        raise parser.error(message="--enqueue cannot be combined with --reparse")
+
+    # the jobs table only holds the weeks, --work nodes write them with the loader they were
+    # started with and would fail on every week --all finds already stored
+    if args.enqueue and args.all:
+        raise parser.error(message="--enqueue cannot be combined with --all")
+
+    if args.refresh and (args.reparse or args.enqueue):
+        raise parser.error(
+            message="--refresh cannot be combined with --reparse or --enqueue"
+        )
+
+    if (
+        args.all or args.refresh or args.reparse
+    ):  # overwriting stored weeks needs the upsert loader
+        args.loader = "upsert"
+
+    # drop charts passed more than once, keeping the order they were given in
+    args.chart = list({c.name: c for c in args.chart}.values())
+
+    if not args.single:
         if args.start > args.end:  # date range sanity check
             raise parser.error(message="--start cannot be recent than --end")
 
@@ -144,62 +403,4 @@ def parse_flags(parser: ArgumentParser) -> tuple[CHART_INFO, Iterator[date]]:
         ):  # encourage the use of --single flag if only targeting one chart
             print("Warning: to parse a single chart use '--single [YYYY-MM-DD]")
 
-        if args.all:  # targeting every chart in the optional range
-            return args.chart, date_generator(args.start, args.end)
-
-        elif (
-            args.missing
-        ):  # targeting charts not in the database and in the optional range
-            with Session() as s:
-                existing = s.scalars(select(Chart.date)).all()
-            return args.chart, date_generator(
-                args.start, args.end, lambda x: x not in existing
-            )
-
-        elif args.new:  # targeting charts newer than the newest chart in the database and within the optional range
-            with Session() as s:
-                newest: Optional[date] = s.scalars(
-                    select(func.max(Chart.date))
-                ).one_or_none()
-
-            if (
-                newest is None
-            ):  # --new is relative to the database so it must contain at least one chart
-                raise parser.error(
-                    message="Cannot pass --new when no charts currently exist in the database."
-                )
-
-            elif args.end <= newest:  # functional date range sanity check
-                raise parser.error(
-                    message=f"the newest chart cannot be newer than the --end constraint. you passed --end={args.end} while newest={newest}"
-                )
-
-            return args.chart, date_generator(
-                args.start, args.end, lambda x: x > newest
-            )
-
-        elif args.older:  # targeting charts older than the oldest chart in the database and within the optional range
-            with Session() as s:
-                oldest: Optional[date] = s.scalars(
-                    select(func.min(Chart.date))
-                ).one_or_none()
-
-            if (
-                oldest is None
-            ):  # --older is relative to the database so it must contain at least one chart
-                raise parser.error(
-                    message="Cannot pass --older when no charts currently exist in the database."
-                )
-
-            elif args.start >= oldest:  # functional date range sanity check
-                raise parser.error(
-                    message=f"the oldest chart cannot be older than the --start constraint. you passed --start={args.start} while oldest={oldest}"
-                )
-            return args.chart, date_generator(
-                args.start, args.end, lambda x: x < oldest
-            )
-        else:  # if no pattern flag is passed use specified date range or default
-            return args.chart, date_generator(args.start, args.end)
-
-    finally:
-        engine.dispose()  # close database connection
+    return args
@@ -1,28 +1,48 @@
+from billboard_fetch.configs import CHART_INFO
 from datetime import date, timedelta
-from typing import Iterator, Callable, Optional
+from typing import Container, Iterator, Callable, Optional
+
+
+def to_weekday(date_: date, weekday: int = 5, round_up: bool = False) -> date:
+    # will return the nearest weekday to the date_ arg, 5 is saturday
+    # return the previous one by default unless round_up=True then returns the next one
+    if round_up:
+        return date_ + timedelta(days=(weekday - date_.weekday()) % 7)
+    return date_ - timedelta(days=(date_.weekday() - weekday) % 7)
 
 
 def to_saturday(date_: date, round_up: bool = False) -> date:
-    # will return the nearest saturday to the date_ arg
-    delta: int = 1 if round_up else -1
-    # return the previous saturday by default unless round_up=True then returns the next saturday
-    while date_.weekday() != 5:
-        # 5 is saturday
-        date_ += timedelta(days=delta)
-    return date_
+    return to_weekday(date_, 5, round_up)
 
 
 def date_generator(
     start_date: date,
     end_date: date,
     cond: Optional[Callable[[date], bool]] = None,
+    weekday: int = 5,
 ) -> Iterator[date]:
-    # infintite generator for dates incremented by one week
-    date_ = to_saturday(start_date)
-    end_date = to_saturday(end_date)
+    # generator for dates incremented by one week, every weekday from start_date to end_date
+    first: date = to_weekday(start_date, weekday)
+    num_weeks: int = (to_weekday(end_date, weekday) - first).days // 7 + 1
     # yield one day per week until end_date is reached
-    while date_ <= end_date:
+    for i in range(num_weeks):
+        date_: date = first + timedelta(weeks=i)
         if cond is None or cond(date_):
             # if condition is not passed then always yield, otherwise check against condition
             yield date_
-        date_ += timedelta(days=7)
+
+
+def chart_weeks(
+    chart: CHART_INFO,
+    start_date: date,
+    end_date: date,
+    learned: Container[date] = frozenset(),
+) -> Iterator[date]:
+    # the weeks of the chart's calendar between two dates, none before its first chart
+    # and none of its known or learned gaps
+    return date_generator(
+        max(start_date, to_weekday(chart.inception, chart.weekday, round_up=True)),
+        end_date,
+        lambda date_: date_ not in chart.gaps and date_ not in learned,
+        chart.weekday,
+    )
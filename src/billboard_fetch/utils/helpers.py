@@ -1,10 +1,19 @@
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 import time
 import random
-from aiohttp import ClientHandlerType, ClientRequest, ClientResponse
+from aiohttp import (
+    ClientHandlerType,
+    ClientMiddlewareType,
+    ClientRequest,
+    ClientResponse,
+)
 import asyncio
 from pathlib import Path
+from typing import Optional
 from .counter_class import AsyncCounter
+from .limiter_class import AdaptiveLimiter
+from .metrics import Metrics
 
 
 def calc_num_charts(start_date: date, end_date: date) -> int:
@@ -22,13 +31,86 @@ async def progress_report(num_charts: int, counter: AsyncCounter):
         await asyncio.sleep(15)
 
 
-async def retry_middleware(
-    req: ClientRequest, handler: ClientHandlerType
-) -> ClientResponse:
-    for i in range(5):
-        r: ClientResponse = await handler(req)
-        if r.ok:
-            return r
-        backoff: float = 2**i + random.expovariate(1.0 / 0.3)
-        await asyncio.sleep(backoff)
-    return r
+async def monitor_queues(
+    queues: dict[str, asyncio.Queue],
+    gauges: dict[str, list[int]],
+    sample_every: float = 1.0,
+    report_every: float = 15.0,
+):
+    # samples the depth of every pipeline queue until cancelled
+    #   gauges[name] = [samples, summed depth, max depth]
+    # a queue that sits at its bound marks the stage after it as the bottleneck
+    for name in queues:
+        gauges.setdefault(name, [0, 0, 0])
+    last_report: float = time.monotonic()
+    while True:
+        for name, queue in queues.items():
+            depth: int = queue.qsize()
+            gauge: list[int] = gauges[name]
+            gauge[0] += 1
+            gauge[1] += depth
+            gauge[2] = max(gauge[2], depth)
+        if time.monotonic() - last_report >= report_every:
+            last_report = time.monotonic()
+            print(
+                "queue depths -- "
+                + ", ".join(
+                    f"{name}: {queue.qsize()}/{queue.maxsize or 'inf'}"
+                    for name, queue in queues.items()
+                )
+            )
+        await asyncio.sleep(sample_every)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    # Retry-After is either a number of seconds or an http date
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at: datetime = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def retry_middleware(
+    limiter: AdaptiveLimiter, attempts: int = 5, metrics: Optional[Metrics] = None
+) -> ClientMiddlewareType:
+    # every attempt waits on the shared limiter and reports its outcome back to it
+    #   the response returned keeps its slot until the caller read the body and called
+    #   limiter.done, so the window counts bodies still streaming in
+    async def middleware(
+        req: ClientRequest, handler: ClientHandlerType
+    ) -> ClientResponse:
+        for i in range(attempts):
+            wait_start: float = time.monotonic()
+            async with limiter.slot() as start_time:
+                r: ClientResponse = await handler(req)
+            latency: float = time.monotonic() - start_time
+            retry_after: Optional[float] = parse_retry_after(
+                r.headers.get("Retry-After")
+            )
+            if metrics is not None:
+                metrics.observe("limiter_wait_seconds", start_time - wait_start)
+                metrics.observe("response_seconds", latency)
+                metrics.inc("responses_total", status=str(r.status))
+            if (r.status != 429 and r.status < 500) or i == attempts - 1:
+                # success, a client error that retrying will not fix, or the last attempt
+                limiter.hold(r, start_time, retry_after)
+                return r
+            limiter.record(r.status, latency, retry_after)
+            await limiter.release()
+            if metrics is not None:
+                metrics.inc("retries_total")
+            r.release()
+            if retry_after is None:
+                # without a Retry-After only this request backs off, the limiter already slowed everyone down
+                await asyncio.sleep(2**i + random.expovariate(1.0 / 0.3))
+
+    return middleware
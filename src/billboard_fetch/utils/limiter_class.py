@@ -0,0 +1,159 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Hashable, Optional
+
+
+class AdaptiveLimiter:
+    # AIMD controller shared by every request of a run
+    #   limit: number of requests allowed in flight at once
+    #   rate: tokens per second refilled into one global token bucket
+    # both grow additively while responses are healthy and are cut multiplicatively
+    # on 429/5xx, connection errors or latency rising above the observed baseline
+    def __init__(
+        self,
+        max_limit: int = 16,
+        max_rate: float = 10.0,
+        start_limit: float = 4.0,
+        start_rate: float = 2.0,
+        min_limit: float = 1.0,
+        min_rate: float = 0.2,
+        backoff: float = 0.5,
+        latency_tolerance: float = 2.0,
+    ):
+        if not min_limit <= start_limit <= max_limit:
+            raise Exception(
+                "AdaptiveLimiter requires min_limit <= start_limit <= max_limit"
+            )
+        if not min_rate <= start_rate <= max_rate:
+            raise Exception(
+                "AdaptiveLimiter requires min_rate <= start_rate <= max_rate"
+            )
+        self.limit: float = start_limit
+        self.min_limit: float = min_limit
+        self.max_limit: int = max_limit
+        self.rate: float = start_rate
+        self.min_rate: float = min_rate
+        self.max_rate: float = max_rate
+        self.backoff: float = backoff
+        self.latency_tolerance: float = latency_tolerance
+        self.in_flight: int = 0
+        # smoothed time to response headers and the lowest smoothed value seen
+        self.latency: Optional[float] = None
+        self.baseline: Optional[float] = None
+        # token bucket state, burst is capped at one second of tokens
+        self.tokens: float = 1.0
+        self.refilled_at: float = time.monotonic()
+        self.paused_until: float = 0.0
+        self.cut_at: float = 0.0
+        # responses handed back with their slot still taken, (start time, Retry-After)
+        self.held: dict[Hashable, tuple[float, Optional[float]]] = {}
+        self.cond: asyncio.Condition = asyncio.Condition()
+        self.bucket_lock: asyncio.Lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        try:
+            await self.take_token()
+        except BaseException:
+            await self.release()
+            raise
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[float]:
+        # takes a slot for one request and yields when it was sent, a request that raised
+        # gives the slot back here, one that got a response is released by done
+        await self.acquire()
+        try:
+            yield time.monotonic()
+        except asyncio.CancelledError:
+            await self.release()
+            raise
+        except BaseException:
+            self.decrease()  # timeouts and connection errors count as congestion
+            await self.release()
+            raise
+
+    async def release(self):
+        async with self.cond:
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+    def hold(self, response: Hashable, start_time: float, retry_after: Optional[float]):
+        # the response's body is still to be read, its slot stays taken until done
+        self.held[response] = (start_time, retry_after)
+
+    async def done(self, response: Hashable, congested: bool = False):
+        # called once the body of a held response was read or given up on, the time to its
+        # last byte is the latency reported
+        held: Optional[tuple[float, Optional[float]]] = self.held.pop(response, None)
+        if held is None:
+            return
+        start_time, retry_after = held
+        if congested:  # the body broke off or timed out
+            self.decrease()
+        else:
+            self.record(response.status, time.monotonic() - start_time, retry_after)
+        await self.release()
+
+    async def take_token(self):
+        # waiters queue fairly on the lock so the bucket is drained in arrival order
+        async with self.bucket_lock:
+            while True:
+                now: float = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(
+                    max(self.rate, 1.0),
+                    self.tokens + (now - self.refilled_at) * self.rate,
+                )
+                self.refilled_at = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                await asyncio.sleep((1.0 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        # stops every worker from sending until the server's Retry-After has passed
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+    def increase(self):
+        # roughly +1 request in flight and +1 request/sec per round of healthy responses
+        self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+        self.rate = min(self.max_rate, self.rate + 1.0 / self.rate)
+
+    def decrease(self):
+        now: float = time.monotonic()
+        # responses already in flight report the same congestion, only cut once per round trip
+        if now - self.cut_at < (self.latency or 1.0):
+            return
+        self.cut_at = now
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+        self.rate = max(self.min_rate, self.rate * self.backoff)
+
+    def record(self, status: int, latency: float, retry_after: Optional[float] = None):
+        if status == 429 or status >= 500:
+            self.decrease()
+            if retry_after is not None:
+                self.pause(retry_after)
+            return
+        if status >= 400:  # client errors say nothing about server load
+            return
+
+        self.latency = (
+            latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        )
+        # let the baseline drift slowly upwards so a permanently slower site is tolerated
+        self.baseline = (
+            self.latency
+            if self.baseline is None
+            else min(self.latency, self.baseline * 1.01)
+        )
+        if self.latency > self.latency_tolerance * self.baseline:
+            self.decrease()
+        else:
+            self.increase()
@@ -0,0 +1,175 @@
+from bisect import bisect_left
+from pathlib import Path
+from typing import Any, Callable, Optional
+import json
+import os
+import time
+
+# upper bounds in seconds of every latency histogram, observations above the last one land in +Inf
+LATENCY_BUCKETS: tuple[float, ...] = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+# prefix of every exported metric name
+METRIC_PREFIX: str = "billboard_fetch_"
+
+# metric name and its sorted label pairs
+MetricKey = tuple[str, tuple[tuple[str, str], ...]]
+
+
+def timed_call(fn: Callable, *args) -> tuple[Any, float]:
+    # runs fn inside a pool process and returns its result with the time spent in the process
+    # the caller subtracts that time from the round trip to get the ipc overhead
+    start_time: float = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start_time
+
+
+class Histogram:
+    # cumulative prometheus style histogram with fixed bucket bounds
+    __slots__ = ("buckets", "counts", "count", "sum", "max")
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets: tuple[float, ...] = buckets
+        self.counts: list[int] = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.count: int = 0
+        self.sum: float = 0.0
+        self.max: float = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        # interpolates linearly inside the bucket that holds the q-th observation
+        rank: float = q * self.count
+        seen: int = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower: float = self.buckets[i - 1] if i else 0.0
+                upper: float = self.buckets[i] if i < len(self.buckets) else self.max
+                return lower + (min(upper, self.max) - lower) * (rank - seen) / n
+            seen += n
+        return self.max
+
+    def summary(self) -> dict[str, float]:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else 0.0,
+            "p50": round(self.quantile(0.5), 6),
+            "p95": round(self.quantile(0.95), 6),
+            "p99": round(self.quantile(0.99), 6),
+            "max": round(self.max, 6),
+        }
+
+
+def render_key(key: MetricKey) -> str:
+    name, labels = key
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class Metrics:
+    # counters, gauges and histograms of one run
+    # every update is a plain dict or attribute update made on the event loop thread with no
+    # await in between, so the hot path needs no lock
+    def __init__(self):
+        self.started_at: float = time.time()
+        self.counters: dict[MetricKey, float] = {}
+        self.gauges: dict[MetricKey, float] = {}
+        self.histograms: dict[MetricKey, Histogram] = {}
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        key: MetricKey = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: str):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name: str, value: float, **labels: str):
+        key: MetricKey = (name, tuple(sorted(labels.items())))
+        histogram: Optional[Histogram] = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def counter(self, name: str) -> float:
+        # summed over every label combination
+        return sum(v for (n, _), v in self.counters.items() if n == name)
+
+    def histogram(self, name: str, **labels: str) -> Histogram:
+        return self.histograms.get((name, tuple(sorted(labels.items()))), Histogram())
+
+    def to_prometheus(self) -> str:
+        # text exposition format, readable by the node_exporter textfile collector
+        lines: list[str] = []
+        typed: set[str] = set()
+
+        def declare(name: str, kind: str):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} {kind}")
+
+        for key, value in sorted(self.counters.items()):
+            declare(key[0], "counter")
+            lines.append(f"{METRIC_PREFIX}{render_key(key)} {value}")
+        for key, value in sorted(self.gauges.items()):
+            declare(key[0], "gauge")
+            lines.append(f"{METRIC_PREFIX}{render_key(key)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            declare(name, "histogram")
+            cumulative: int = 0
+            bounds: list[str] = [str(b) for b in histogram.buckets] + ["+Inf"]
+            for bound, n in zip(bounds, histogram.counts):
+                cumulative += n
+                key: MetricKey = (f"{name}_bucket", labels + (("le", bound),))
+                lines.append(f"{METRIC_PREFIX}{render_key(key)} {cumulative}")
+            lines.append(
+                f"{METRIC_PREFIX}{render_key((f'{name}_sum', labels))} {histogram.sum}"
+            )
+            lines.append(
+                f"{METRIC_PREFIX}{render_key((f'{name}_count', labels))} {histogram.count}"
+            )
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> dict:
+        return {
+            "started_at": self.started_at,
+            "counters": {render_key(k): v for k, v in sorted(self.counters.items())},
+            "gauges": {render_key(k): v for k, v in sorted(self.gauges.items())},
+            "histograms": {
+                render_key(k): h.summary() for k, h in sorted(self.histograms.items())
+            },
+        }
+
+    def write(self, path: str | Path):
+        # .json gets a summary per run, anything else the prometheus text format
+        path = Path(path)
+        body: str = (
+            json.dumps(self.to_json(), indent=2)
+            if path.suffix == ".json"
+            else self.to_prometheus()
+        )
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # written next to the target and renamed so a scraper never reads half a file
+        tmp_path: Path = path.with_name(f".{path.name}.tmp")
+        tmp_path.write_text(body, encoding="utf-8")
+        os.replace(tmp_path, path)
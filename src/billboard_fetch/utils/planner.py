@@ -0,0 +1,114 @@
+from billboard_fetch.configs import ARCHIVE_DIR, CHART_INFO
+from billboard_fetch.database import Chart, get_engine
+from billboard_fetch.database.gaps import load_gaps
+from billboard_fetch.database.plan import missing_weeks
+from billboard_fetch.etl.archive import ResponseArchive
+from .date_utils import chart_weeks, date_generator, to_weekday
+from sqlalchemy import Select, select, func
+from datetime import date, timedelta
+from argparse import ArgumentParser, Namespace
+from typing import AsyncIterator, Iterable, Optional
+
+
+async def iter_dates(dates: Iterable[date]) -> AsyncIterator[date]:
+    # gives plans generated locally the same shape as plans streamed from the database
+    for date_ in dates:
+        yield date_
+
+
+async def stream_dates(stmt: Select) -> AsyncIterator[date]:
+    # reads the planned dates through a server side cursor as postgres produces them
+    async with get_engine().connect() as conn:
+        result = await conn.stream_scalars(stmt, execution_options={"yield_per": 1000})
+        async for date_ in result:
+            yield date_
+
+
+async def plan_chart(
+    parser: ArgumentParser, args: Namespace, chart: CHART_INFO
+) -> AsyncIterator[date]:
+    # returns the dates to fetch for one chart according to the pattern flag
+    if args.single:  # --single takes precedence, immediately propagate target date
+        # an explicit week is fetched even where the calendar has no chart
+        return iter_dates(
+            date_generator(args.single, args.single, weekday=chart.weekday)
+        )
+
+    if args.reparse:  # targeting every archived chart in the optional range
+        # stored weeks stay in place until the upsert loader replaces them as they are
+        # written, a stored week without an archived page is kept as it is
+        return iter_dates(
+            ResponseArchive(ARCHIVE_DIR).dates(chart.name, args.start, args.end)
+        )
+
+    # every other pattern only plans weeks of the chart's calendar, never a week before its
+    # first chart or one already known to have no chart
+    learned: set[date] = await load_gaps(chart.name)
+
+    if args.all:  # targeting every chart in the optional range
+        return iter_dates(chart_weeks(chart, args.start, args.end, learned))
+
+    elif args.missing:  # targeting charts not in the database and in the optional range
+        return stream_dates(
+            missing_weeks(
+                chart.name,
+                to_weekday(max(args.start, chart.inception), chart.weekday),
+                to_weekday(args.end, chart.weekday),
+                chart.gaps,
+            )
+        )
+
+    elif (
+        args.new
+    ):  # targeting charts newer than the newest chart in the database and within the optional range
+        async with get_engine().connect() as conn:
+            newest: Optional[date] = await conn.scalar(
+                select(func.max(Chart.date)).where(Chart.chart_name == chart.name)
+            )
+
+        if (
+            newest is None
+        ):  # --new is relative to the database so it must contain at least one chart
+            raise parser.error(
+                message=f"Cannot pass --new when no {chart.name} charts currently exist in the database."
+            )
+
+        # charts are weekly so the range simply starts the week after the newest chart,
+        # or at the newest chart itself when refreshing since billboard may still revise it
+        first: date = newest if args.refresh else newest + timedelta(days=7)
+
+        if args.end < newest or (
+            args.end == newest and not args.refresh
+        ):  # functional date range sanity check
+            raise parser.error(
+                message=f"the newest {chart.name} chart cannot be newer than the --end constraint. you passed --end={args.end} while newest={newest}"
+            )
+
+        return iter_dates(chart_weeks(chart, max(args.start, first), args.end, learned))
+
+    elif (
+        args.older
+    ):  # targeting charts older than the oldest chart in the database and within the optional range
+        async with get_engine().connect() as conn:
+            oldest: Optional[date] = await conn.scalar(
+                select(func.min(Chart.date)).where(Chart.chart_name == chart.name)
+            )
+
+        if (
+            oldest is None
+        ):  # --older is relative to the database so it must contain at least one chart
+            raise parser.error(
+                message=f"Cannot pass --older when no {chart.name} charts currently exist in the database."
+            )
+
+        elif args.start >= oldest:  # functional date range sanity check
+            raise parser.error(
+                message=f"the oldest {chart.name} chart cannot be older than the --start constraint. you passed --start={args.start} while oldest={oldest}"
+            )
+        return iter_dates(
+            chart_weeks(
+                chart, args.start, min(args.end, oldest - timedelta(days=7)), learned
+            )
+        )
+    else:  # if no pattern flag is passed use specified date range or default
+        return iter_dates(chart_weeks(chart, args.start, args.end, learned))